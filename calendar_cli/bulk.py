@@ -0,0 +1,141 @@
+"""Running many requests towards the caldav server concurrently.
+
+Used by the commands that may operate on thousands of objects at the
+time, like calendar addics and the todo edit, postpone, complete and
+delete commands.  The work is done by a bounded pool of worker threads
+sharing one DAVClient (and hence one HTTP connection pool).
+
+Modifications of existing objects are sent with If-Match when the ETag
+is known, so objects changed by someone else since they were fetched
+are reported as conflicts rather than silently overwritten.
+"""
+
+import concurrent.futures
+import json
+import logging
+import sys
+
+def set_connection_pool_size(caldav_conn, size):
+    """
+    Makes room for size concurrent connections in the connection pool
+    """
+    if caldav_conn is None:
+        return
+    from calendar_cli.transport import set_pool_size
+    set_pool_size(caldav_conn, size)
+
+def run_concurrently(items, func, jobs, limit=None):
+    """
+    Calls func(item) for each item, with up to jobs calls running in
+    parallel.  Yields (item, exception) as the calls are completed,
+    exception being None on success.  The items are consumed lazily, so
+    it's fine to pass a generator.
+
+    If limit (an AdaptiveLimit) is given, the number of calls running
+    at the same time is further capped by it.
+    """
+    if limit is not None:
+        unlimited = func
+        def func(item):
+            with limit:
+                return unlimited(item)
+    items = iter(items)
+    pending = {}
+    end = object()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            ## keep the workers busy, without reading all the items into memory
+            while len(pending) < jobs*2:
+                item = next(items, end)
+                if item is end:
+                    break
+                pending[executor.submit(func, item)] = item
+            if not pending:
+                return
+            (done, not_done) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                if error is not None and not isinstance(error, Exception):
+                    ## SystemExit, KeyboardInterrupt, etc
+                    raise error
+                yield (item, error)
+
+def is_conflict(error):
+    """
+    Returns True if error is the server refusing a conditional request
+    (412 Precondition Failed), meaning the object was modified by
+    someone else
+    """
+    import caldav.lib.error
+    return isinstance(error, (caldav.lib.error.ETagMismatchError, caldav.lib.error.ScheduleTagMismatchError))
+
+def conditional_delete(obj):
+    """
+    Deletes obj, with If-Match if the ETag is known.  (The caldav
+    library does the same for PUT, but not for DELETE.)
+    """
+    import caldav.lib.error
+    headers = {'If-Match': obj.etag} if obj.etag else {}
+    r = obj.client.request(str(obj.url), 'DELETE', '', headers)
+    if r.status == 412:
+        raise caldav.lib.error.ETagMismatchError(caldav.lib.error.errmsg(r))
+    if r.status not in (200, 204, 404):
+        raise caldav.lib.error.DeleteError(caldav.lib.error.errmsg(r))
+
+class BulkReport():
+    """
+    Keeps track of the outcome for each object in a bulk operation.
+
+    If a file name is given, one json line per object is appended to
+    the file.  Objects recorded as successful in an earlier run are
+    listed in ``done``, so an interrupted or partly failed run can be
+    resumed without redoing the work.
+    """
+    def __init__(self, file_name=None):
+        self.done = set()
+        self.counts = {}
+        self.file = None
+        if file_name:
+            try:
+                with open(file_name, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            ## probably a partially written line from a crash
+                            continue
+                        if entry.get('status') == 'ok':
+                            self.done.add(entry['uid'])
+            except FileNotFoundError:
+                pass
+            self.file = open(file_name, 'a')
+
+    def skip(self, uid):
+        """
+        Returns True (and counts it as skipped) if uid was completed in an earlier run
+        """
+        if uid in self.done:
+            self.counts['skipped'] = self.counts.get('skipped', 0) + 1
+            return True
+        return False
+
+    def record(self, uid, status, error=None):
+        self.counts[status] = self.counts.get(status, 0) + 1
+        entry = {'uid': uid, 'status': status}
+        if error is not None:
+            entry['error'] = "%s: %s" % (error.__class__.__name__, error)
+            sys.stderr.write("%s %s: %s\n" % (status, uid, entry['error']))
+            logging.debug("%s failed" % uid, exc_info=error)
+        if self.file:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        if self.counts:
+            sys.stderr.write(", ".join("%s: %i" % x for x in sorted(self.counts.items())) + "\n")
+
+    def failed(self):
+        return sum(self.counts.get(x, 0) for x in self.counts if not x in ('ok', 'skipped'))
@@ -0,0 +1,288 @@
+"""Persistent local cache of calendar objects.
+
+The cache is stored as one json file per config section and calendar
+URL.  It is revalidated through the collection ctag (a cheap PROPFIND)
+and - if the ctag has changed - through an RFC 6578 sync-collection
+REPORT, so only objects that have been changed or deleted since the
+last run are downloaded from the server.  Servers supporting neither
+ctag nor sync-token will get a full download on every run, which is
+no worse than running without the cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+def default_cache_dir():
+    return os.path.join(os.getenv('XDG_CACHE_HOME', os.getenv('HOME', '~') + '/.cache'), 'calendar-cli')
+
+def _cache_file_name(cache_dir, config_section, calendar_url):
+    key = hashlib.sha1(("%s\n%s" % (config_section, calendar_url)).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.json')
+
+def _component_type(data):
+    """
+    Cheap way of finding the component type of an icalendar object
+    without parsing it
+    """
+    for comp in ('VTODO', 'VEVENT', 'VJOURNAL'):
+        if 'BEGIN:' + comp in data:
+            return comp
+    return None
+
+class SyncCache():
+    """
+    The cached state of one calendar.  ``objects`` is a dict from the
+    (path part of the) object URL to a dict with the keys ``etag`` and
+    ``data``.
+    """
+    def __init__(self, cache_dir, config_section, calendar_url):
+        self.file_name = _cache_file_name(cache_dir, config_section, calendar_url)
+        self.config_section = config_section
+        self.calendar_url = calendar_url
+        self.ctag = None
+        self.sync_token = None
+        self.objects = {}
+        self.modified = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.error("cache file %s is broken, it will be ignored" % self.file_name)
+            return
+        ## The file name is a hash, so we double-check that we got the right one
+        if state.get('calendar_url') != self.calendar_url or state.get('config_section') != self.config_section:
+            return
+        self.ctag = state.get('ctag')
+        self.sync_token = state.get('sync_token')
+        self.objects = state.get('objects', {})
+
+    def save(self):
+        if not self.modified:
+            return
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        tmp_file_name = "%s.%s.tmp" % (self.file_name, os.getpid())
+        with open(tmp_file_name, 'w') as f:
+            json.dump({
+                'config_section': self.config_section,
+                'calendar_url': self.calendar_url,
+                'ctag': self.ctag,
+                'sync_token': self.sync_token,
+                'objects': self.objects}, f)
+        os.replace(tmp_file_name, self.file_name)
+        self.modified = False
+
+    def _store(self, obj):
+        from caldav.elements import dav
+        data = obj.data
+        if not data:
+            return
+        etag = None
+        if getattr(obj, 'props', None):
+            etag = obj.props.get(dav.GetEtag.tag)
+        self.objects[obj.url.path] = {'etag': etag, 'data': data}
+        self.modified = True
+
+    def _collection_state(self, calendar):
+        """
+        Returns (ctag, sync_token) for the calendar collection, fetched by
+        one PROPFIND.  Either may be None if the server doesn't support it.
+        """
+        from caldav.elements import dav
+        from caldav.elements.base import BaseElement
+        class GetCtag(BaseElement):
+            tag = '{http://calendarserver.org/ns/}getctag'
+        try:
+            props = calendar.get_properties([GetCtag(), dav.SyncToken()])
+        except Exception:
+            logging.info("could not fetch ctag/sync-token", exc_info=True)
+            return (None, None)
+        return (props.get(GetCtag.tag), props.get(dav.SyncToken.tag))
+
+    def _fetch(self, calendar, hrefs):
+        """
+        Downloads the given objects through one calendar-multiget REPORT.
+        Returns the set of hrefs that could not be found on the server.
+        """
+        missing = set(hrefs)
+        if not hrefs:
+            return missing
+        for obj in calendar.multiget([calendar.url.join(x) for x in hrefs], raise_notfound=False):
+            ## some library versions yield data-less objects for 404s
+            if obj.data:
+                self._store(obj)
+                missing.discard(obj.url.path)
+        return missing
+
+    def _full_sync(self, calendar):
+        logging.debug("sync cache: full download of %s" % calendar.url)
+        self.objects = {}
+        self.modified = True
+        self.sync_token = None
+        try:
+            updates = calendar.objects_by_sync_token(load_objects=False)
+            self.sync_token = updates.sync_token
+            to_fetch = []
+            for obj in updates:
+                if obj.data:
+                    self._store(obj)
+                else:
+                    to_fetch.append(obj.url.path)
+            self._fetch(calendar, to_fetch)
+        except Exception:
+            ## sync-collection not supported - resort to a full search
+            logging.info("sync-collection REPORT failed, falling back to full search", exc_info=True)
+            self.objects = {}
+            self.sync_token = None
+            for obj in calendar.search():
+                self._store(obj)
+
+    def _incremental_sync(self, calendar):
+        logging.debug("sync cache: incremental sync of %s" % calendar.url)
+        updates = calendar.objects_by_sync_token(sync_token=self.sync_token, load_objects=False)
+        to_fetch = []
+        for obj in updates:
+            if obj.data:
+                self._store(obj)
+            else:
+                to_fetch.append(obj.url.path)
+        ## objects in the sync report that cannot be fetched have been deleted
+        for href in self._fetch(calendar, to_fetch):
+            self.objects.pop(href, None)
+        self.sync_token = updates.sync_token
+        self.modified = True
+
+    def revalidate(self, calendar):
+        """
+        Brings the cache up to date with the server
+        """
+        (ctag, sync_token) = self._collection_state(calendar)
+        if self.objects or self.ctag or self.sync_token:
+            if ctag and ctag == self.ctag:
+                return
+            if sync_token and sync_token == self.sync_token:
+                return
+        if self.sync_token and sync_token:
+            try:
+                self._incremental_sync(calendar)
+            except Exception:
+                logging.info("incremental sync failed, falling back to full download", exc_info=True)
+                self._full_sync(calendar)
+        else:
+            self._full_sync(calendar)
+        self.ctag = ctag
+        if sync_token and not self.sync_token:
+            self.sync_token = sync_token
+        self.modified = True
+
+    def objects_of_type(self, calendar, comp_type):
+        """
+        Yields caldav objects of the given component type (i.e. 'VTODO')
+        from the cache.  The objects are bound to the calendar, so they
+        may be saved, completed or deleted as usual.
+        """
+        for href, entry in self.objects.items():
+            if _component_type(entry['data']) != comp_type:
+                continue
+            yield self._object(calendar, href, entry)
+
+    def objects_by_href(self, calendar, hrefs):
+        """
+        Yields caldav objects for the given hrefs (i.e. as selected
+        through the columnar index), like objects_of_type
+        """
+        for href in hrefs:
+            entry = self.objects.get(href)
+            if entry is not None:
+                yield self._object(calendar, href, entry)
+
+    def _object(self, calendar, href, entry):
+        import caldav
+        from caldav.elements import dav
+        cls = {'VTODO': caldav.Todo, 'VEVENT': caldav.Event, 'VJOURNAL': caldav.Journal}.get(_component_type(entry['data']), caldav.CalendarObjectResource)
+        props = {dav.GetEtag.tag: entry['etag']} if entry.get('etag') else None
+        return cls(client=calendar.client, url=calendar.url.join(href), data=entry['data'], parent=calendar, props=props)
+
+class DiscoveryCache():
+    """
+    Cache of the principal URL, calendar home set and the list of
+    calendars found for each config section, so the PROPFINDs needed
+    for finding them can be skipped.  Entries expire after the given
+    time-to-live (in seconds), and are ignored if the server URL or
+    username has changed.
+    """
+    def __init__(self, cache_dir):
+        self.file_name = os.path.join(cache_dir, 'discovery.json')
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.error("cache file %s is broken, it will be ignored" % self.file_name)
+            return {}
+
+    def get(self, config_section, caldav_url, caldav_user, ttl):
+        entry = self.entries.get(config_section)
+        if not entry:
+            return None
+        if entry.get('caldav_url') != caldav_url or entry.get('caldav_user') != caldav_user:
+            return None
+        if entry.get('timestamp', 0) + ttl < time.time():
+            return None
+        return entry
+
+    def set(self, config_section, caldav_url, caldav_user, entry):
+        entry = dict(entry, caldav_url=caldav_url, caldav_user=caldav_user, timestamp=time.time())
+        self._update(lambda entries: entries.__setitem__(config_section, entry))
+        return entry
+
+    def invalidate(self, config_section):
+        if config_section in self.entries:
+            self._update(lambda entries: entries.pop(config_section, None))
+
+    def _update(self, change):
+        """
+        Applies change to the entries on disk and writes them back.  The
+        config sections of --config-section patterns are run in
+        parallel threads, each with its own DiscoveryCache, so the file
+        is reread under a lock rather than overwritten with the entries
+        read when this one was created.
+        """
+        with _discovery_lock:
+            entries = self._load()
+            change(entries)
+            _write_json(self.file_name, entries)
+            self.entries = entries
+
+## Serializes the updates of the discovery cache within the process
+_discovery_lock = threading.Lock()
+
+def _write_json(file_name, state):
+    """
+    Writes the json file atomically, through a temporary file of its own
+    """
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    (fd, tmp_file_name) = tempfile.mkstemp(dir=os.path.dirname(file_name), prefix=os.path.basename(file_name) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file_name, file_name)
+    except BaseException:
+        try:
+            os.unlink(tmp_file_name)
+        except FileNotFoundError:
+            pass
+        raise
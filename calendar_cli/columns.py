@@ -0,0 +1,375 @@
+"""Columnar index over the objects in the sync cache.
+
+With --sync-cache, the todo and agenda commands used to parse every
+cached object to find the few that should be listed.  The columnar
+index holds the properties the selection is done on, one fixed-width
+array per property and one row per cached object:
+
+* component type, and flags telling if the object could be indexed,
+  if it is recurring, if it has floating times and if it's pending
+* dtstart, dtend, due and completed as seconds since the epoch (UTC;
+  floating times as if they were in UTC)
+* priority, and the status as an id into a list of status values
+* the categories as ids into a list of category names, stored as one
+  array of ids and one of offsets into it for each row
+
+The arrays are written to one file in the cache directory, next to the
+sync cache, and memory-mapped when read.  If numpy is installed, the
+selection is done through vectorized masks over the arrays, otherwise
+row by row in Python - still without parsing anything.  Only the
+objects selected are parsed, and the usual filtering is then applied
+to them, so the index only has to rule out the objects that certainly
+won't match.
+
+Rows are reused for the objects whose ETag hasn't changed since the
+index was written, so after an incremental sync, only the changed
+objects are parsed.  The index is an optimization only - it may be
+deleted at any time.
+"""
+
+import array
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+## Bump when the format changes; the index is then rebuilt
+_format_version = 1
+_magic = b'CCLI-COLUMNS\n'
+_header = struct.Struct('<II')
+
+## Events and tasks with floating times or dates are stored as if they
+## were in UTC, and compared with this much slack
+_floating_slack = 86400
+## Stored for missing timestamps - far from any real timestamp, with
+## room for adding or subtracting the slack
+_missing = -2**62
+
+_components = (None, 'VEVENT', 'VTODO', 'VJOURNAL')
+
+## Flags
+_indexed = 1
+_floating = 2
+_recurring = 4
+_pending = 8
+
+## (name, array typecode) of the columns with one value per row, widest
+## first so that all the columns are aligned
+_row_columns = (
+    ('dtstart', 'q'), ('dtend', 'q'), ('due', 'q'), ('completed', 'q'),
+    ('category_offsets', 'i'), ('status', 'h'), ('component', 'b'),
+    ('flags', 'b'), ('priority', 'b'))
+
+def _index_file_name(cache):
+    return os.path.splitext(cache.file_name)[0] + '.columns'
+
+def _version(entry):
+    """
+    Identifies the version of a cached object: the ETag, or a hash of
+    the data if the server didn't give one
+    """
+    return entry.get('etag') or hashlib.sha1(entry['data'].encode('utf-8')).hexdigest()
+
+def _epoch_or_missing(value):
+    return _missing if value is None else int(value)
+
+def _row(entry):
+    """
+    Converts an index entry from calendar_cli.vdir._index_entry to a
+    row, i.e. a dict with a value for each column plus the uid and the
+    categories and status as strings
+    """
+    row = {'uid': entry.get('uid'), 'status_value': entry.get('status'),
+           'category_values': entry.get('categories', []), 'flags': 0,
+           'component': _components.index(entry['component']) if entry['component'] in _components else 0}
+    if 'uid' in entry:
+        row['flags'] |= _indexed
+        for (flag, key) in ((_floating, 'floating'), (_recurring, 'recurring'), (_pending, 'pending')):
+            if entry.get(key):
+                row['flags'] |= flag
+    row['dtstart'] = _epoch_or_missing(entry.get('start', entry.get('dtstart')))
+    row['dtend'] = _epoch_or_missing(entry.get('end'))
+    row['due'] = _epoch_or_missing(entry.get('due'))
+    row['completed'] = _epoch_or_missing(entry.get('completed'))
+    ## priorities are 0-9 by RFC 5545
+    row['priority'] = max(-128, min(127, entry.get('priority') or 0))
+    return row
+
+class ColumnIndex():
+    """
+    The columnar index of one SyncCache.  ``hrefs`` gives the href of
+    the object of each row.  Created through ColumnIndex.update(cache).
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.hrefs = []
+        self.versions = []
+        self.uids = []
+        self.statuses = [None]
+        self.categories = []
+        self.columns = {}
+        self._mmap = None
+
+    @classmethod
+    def update(cls, cache):
+        """
+        Returns the index for the sync cache, brought up to date with
+        the objects in it.  Objects new or changed since the index was
+        written are parsed, and the index file rewritten.
+        """
+        index = cls(_index_file_name(cache))
+        index._load()
+        versions = {href: _version(entry) for (href, entry) in cache.objects.items()}
+        if versions == dict(zip(index.hrefs, index.versions)):
+            return index
+        rows = index._rows(versions, cache.objects)
+        index.close()
+        index._write(rows)
+        index._load()
+        return index
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            ## ValueError: an empty file can't be mapped
+            return
+        try:
+            self._map()
+        except (ValueError, KeyError, TypeError, struct.error):
+            logging.error("columnar index %s is broken, it will be rebuilt" % self.file_name)
+            self.close()
+            self.__init__(self.file_name)
+
+    def _map(self):
+        buf = self._mmap
+        if buf[:len(_magic)] != _magic:
+            raise ValueError("not a columnar index")
+        (version, header_length) = _header.unpack_from(buf, len(_magic))
+        if version != _format_version:
+            raise ValueError("columnar index version %i" % version)
+        start = len(_magic) + _header.size
+        header = json.loads(bytes(buf[start:start+header_length]).decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("columnar index written on another architecture")
+        numpy = _numpy()
+        columns = {}
+        for (name, typecode, offset, count) in header['columns']:
+            if numpy is not None:
+                columns[name] = numpy.frombuffer(buf, dtype=typecode, count=count, offset=offset)
+            else:
+                columns[name] = memoryview(buf)[offset:offset+count*array.array(typecode).itemsize].cast(typecode)
+        self.hrefs = header['hrefs']
+        self.versions = header['versions']
+        self.uids = header['uids']
+        self.statuses = header['statuses']
+        self.categories = header['categories']
+        self.columns = columns
+
+    def _rows(self, versions, objects):
+        """
+        Returns the rows for the cached objects, reusing the current ones
+        for the objects that haven't changed
+        """
+        from calendar_cli.cache import _component_type
+        from calendar_cli.vdir import _index_entry
+        current = {href: i for (i, href) in enumerate(self.hrefs)}
+        rows = []
+        for (href, version) in versions.items():
+            i = current.get(href)
+            if i is not None and self.versions[i] == version:
+                row = {name: int(self.columns[name][i]) for (name, typecode) in _row_columns if name != 'category_offsets'}
+                row['uid'] = self.uids[i]
+                row['status_value'] = self.statuses[row['status']]
+                offsets = self.columns['category_offsets']
+                row['category_values'] = [self.categories[x] for x in self.columns['category_ids'][offsets[i]:offsets[i+1]]]
+            else:
+                data = objects[href]['data']
+                try:
+                    row = _row(_index_entry(data))
+                except Exception:
+                    logging.info("could not index %s" % href, exc_info=True)
+                    row = _row({'component': _component_type(data)})
+            row['href'] = href
+            row['version'] = version
+            rows.append(row)
+        return rows
+
+    def _write(self, rows):
+        statuses = [None]
+        categories = []
+        status_ids = {None: 0}
+        category_ids = {}
+        def intern(value, ids, values):
+            if not value in ids:
+                ids[value] = len(values)
+                values.append(value)
+            return ids[value]
+        arrays = {name: array.array(typecode) for (name, typecode) in _row_columns}
+        arrays['category_ids'] = array.array('i')
+        for row in rows:
+            row['status'] = intern(row['status_value'], status_ids, statuses)
+            arrays['category_offsets'].append(len(arrays['category_ids']))
+            arrays['category_ids'].extend(intern(x, category_ids, categories) for x in row['category_values'])
+            for (name, typecode) in _row_columns:
+                if name != 'category_offsets':
+                    arrays[name].append(row[name])
+        arrays['category_offsets'].append(len(arrays['category_ids']))
+        header = {
+            'byteorder': sys.byteorder,
+            'hrefs': [x['href'] for x in rows],
+            'versions': [x['version'] for x in rows],
+            'uids': [x['uid'] for x in rows],
+            'statuses': statuses,
+            'categories': categories,
+            'columns': []}
+        names = [x[0] for x in _row_columns] + ['category_ids']
+        ## the offsets depend on the header length, which depends on the
+        ## offsets - so the offsets are given relative to the end of the
+        ## header first, and the header padded to a multiple of 8
+        offset = 0
+        for name in names:
+            header['columns'].append([name, arrays[name].typecode, offset, len(arrays[name])])
+            offset += (len(arrays[name]) * arrays[name].itemsize + 7) // 8 * 8
+        header_start = len(_magic) + _header.size
+        data_start = 0
+        while True:
+            header_bytes = json.dumps(header).encode('utf-8')
+            length = (header_start + len(header_bytes) + 7) // 8 * 8
+            if length == data_start:
+                break
+            for column in header['columns']:
+                column[2] += length - data_start
+            data_start = length
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        tmp_file_name = "%s.%s.tmp" % (self.file_name, os.getpid())
+        with open(tmp_file_name, 'wb') as f:
+            f.write(_magic)
+            f.write(_header.pack(_format_version, len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (data_start - header_start - len(header_bytes)))
+            for name in names:
+                data = arrays[name].tobytes()
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 8))
+        os.replace(tmp_file_name, self.file_name)
+
+    def close(self):
+        self.columns = {}
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                ## some array still refers to it; it's closed when
+                ## collected
+                pass
+            self._mmap = None
+
+    def todos(self, uid=None, category=None, due_before=None):
+        """
+        Returns the hrefs of the task with the given uid, or of the
+        pending tasks (optionally only those with the given category
+        and/or a due timestamp before due_before, a datetime).  Objects
+        that couldn't be indexed are always included.
+        """
+        if uid is not None:
+            rows = [i for (i, x) in enumerate(self.uids) if x == uid]
+            return [self.hrefs[i] for i in rows + self._rows_not_indexed('VTODO')]
+        category_id = None
+        if category is not None:
+            if not category in self.categories:
+                return [self.hrefs[i] for i in self._rows_not_indexed('VTODO')]
+            category_id = self.categories.index(category)
+        due_before = due_before and int(due_before.timestamp())
+        numpy = _numpy()
+        if numpy is None:
+            return self._todos_by_row(category_id, due_before)
+        c = self.columns
+        mask = (c['component'] == _components.index('VTODO')) & (c['flags'] & _pending != 0)
+        if category_id is not None:
+            mask &= self._has_category(numpy, category_id)
+        if due_before is not None:
+            slack = numpy.where(c['flags'] & _floating != 0, _floating_slack, 0)
+            mask &= (c['due'] != _missing) & (c['due'] - slack < due_before)
+        mask |= (c['component'] == _components.index('VTODO')) & (c['flags'] & _indexed == 0)
+        return [self.hrefs[i] for i in numpy.flatnonzero(mask)]
+
+    def _has_category(self, numpy, category_id):
+        """
+        Returns a mask of the rows having the category
+        """
+        c = self.columns
+        mask = numpy.zeros(len(self.hrefs), dtype=bool)
+        positions = numpy.flatnonzero(c['category_ids'] == category_id)
+        mask[numpy.searchsorted(c['category_offsets'], positions, side='right') - 1] = True
+        return mask
+
+    def _todos_by_row(self, category_id, due_before):
+        c = self.columns
+        component = _components.index('VTODO')
+        offsets = c['category_offsets']
+        ret = []
+        for i in range(len(self.hrefs)):
+            if c['component'][i] != component:
+                continue
+            flags = c['flags'][i]
+            if flags & _indexed:
+                if not flags & _pending:
+                    continue
+                if category_id is not None and not category_id in c['category_ids'][offsets[i]:offsets[i+1]].tolist():
+                    continue
+                if due_before is not None:
+                    slack = _floating_slack if flags & _floating else 0
+                    if c['due'][i] == _missing or c['due'][i] - slack >= due_before:
+                        continue
+            ret.append(self.hrefs[i])
+        return ret
+
+    def _rows_not_indexed(self, comp_name):
+        component = _components.index(comp_name)
+        c = self.columns
+        return [i for i in range(len(self.hrefs)) if c['component'][i] == component and not c['flags'][i] & _indexed]
+
+    def events(self, search_dtstart, search_dtend):
+        """
+        Returns the hrefs of the events that may overlap the interval.
+        Recurring events and events that couldn't be indexed are always
+        included.
+        """
+        start = int(search_dtstart.timestamp())
+        end = int(search_dtend.timestamp())
+        component = _components.index('VEVENT')
+        c = self.columns
+        numpy = _numpy()
+        if numpy is None:
+            ret = []
+            for i in range(len(self.hrefs)):
+                if c['component'][i] != component:
+                    continue
+                flags = c['flags'][i]
+                if flags & _indexed and not flags & _recurring:
+                    if c['dtstart'][i] == _missing:
+                        continue
+                    slack = _floating_slack if flags & _floating else 0
+                    if not (c['dtstart'][i] - slack < end and c['dtend'][i] + slack >= start):
+                        continue
+                ret.append(self.hrefs[i])
+            return ret
+        slack = numpy.where(c['flags'] & _floating != 0, _floating_slack, 0)
+        overlaps = (c['dtstart'] != _missing) & (c['dtstart'] - slack < end) & (c['dtend'] + slack >= start)
+        mask = (c['component'] == component) & ((c['flags'] & (_recurring | _indexed) != _indexed) | overlaps)
+        return [self.hrefs[i] for i in numpy.flatnonzero(mask)]
+
+def _numpy():
+    """
+    Returns the numpy module, or None if it's not installed
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
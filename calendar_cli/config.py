@@ -1,6 +1,5 @@
 import logging
 import json
-import yaml
 from fnmatch import fnmatch
 
 def interactive_config(args, config, remaining_argv):
@@ -124,7 +123,7 @@ def expand_config_section(config, section='default', blacklist=None):
             return results
         else:
             ## Disabled sections should be ignored
-            if config.get('section', {}).get('disable', False):
+            if config.get(section, {}).get('disable', False):
                 return []
 
             ## NORMAL CASE - return [ section ]
@@ -156,6 +155,7 @@ def read_config(fn, interactive_error=False):
             with open(fn, 'rb') as config_file:
                 return json.load(config_file)
         except json.decoder.JSONDecodeError:
+            import yaml
             try:
                 with open(fn, 'rb') as config_file:
                     return yaml.load(config_file, yaml.Loader)
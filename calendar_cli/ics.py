@@ -0,0 +1,382 @@
+"""Streaming splitting and lightweight parsing of icalendar data.
+
+RFC 4791 demands that components with different UIDs are stored as
+separate calendar object resources, so an imported calendar has to be
+split into one object per UID.  The splitter works on the content
+lines (RFC 5545, section 3.1) rather than on a parsed calendar tree,
+and yields each object as soon as all its components have been read,
+so memory usage doesn't grow with the size of the input, and the
+upload can start before the input has been fully read.
+
+parse_calendar builds a minimal vobject look-alike from the same
+content lines, for the read-only listings where building full vobject
+trees for thousands of objects would dominate the run time.  Even
+cheaper, scan_properties picks a few properties out of the raw data by
+regular expressions, for ruling out objects before they're parsed at
+all.
+"""
+
+import functools
+import re
+
+_name_re = re.compile(r'[^;:]*')
+
+def unfolded_lines(f):
+    """
+    Yields (line, raw) for each content line in f, line being the
+    unfolded content line and raw being the line as found in the input
+    (possibly spanning several physical lines), without line endings.
+    """
+    raw = []
+    for physical in f:
+        physical = physical.rstrip('\r\n')
+        if raw and physical[:1] in (' ', '\t'):
+            raw.append(physical)
+            continue
+        if raw:
+            yield (''.join([raw[0]] + [x[1:] for x in raw[1:]]), "\r\n".join(raw))
+        raw = [physical] if physical else []
+    if raw:
+        yield (''.join([raw[0]] + [x[1:] for x in raw[1:]]), "\r\n".join(raw))
+
+def _split_unquoted(text, sep, maxsplit=-1):
+    """
+    Like text.split(sep, maxsplit), but not splitting inside double quotes
+    """
+    ret = []
+    start = 0
+    quoted = False
+    for i, c in enumerate(text):
+        if c == '"':
+            quoted = not quoted
+        elif c == sep and not quoted and maxsplit != len(ret):
+            ret.append(text[start:i])
+            start = i+1
+    ret.append(text[start:])
+    return ret
+
+def split_property(line):
+    """
+    Splits an unfolded content line into (name, params, value), where
+    name is upper case and params is a dict from upper case parameter
+    names to the (unquoted) parameter values
+    """
+    head = _split_unquoted(line, ':', 1)
+    value = head[1] if len(head) > 1 else ''
+    head = _split_unquoted(head[0], ';')
+    params = {}
+    for param in head[1:]:
+        (key, _, pvalue) = param.partition('=')
+        params[key.upper()] = pvalue.strip('"')
+    return (head[0].upper(), params, value)
+
+def _components(f):
+    """
+    Yields (header, name, uid, tzids, text) for each top level
+    component of each VCALENDAR in f.  header is the list of VCALENDAR
+    property lines, name the component name (i.e. VEVENT), uid the UID
+    of the component (None if it has no UID), tzids the set of TZIDs
+    referenced by the component (or, for a VTIMEZONE, its own TZID) and
+    text the component, including its subcomponents, as found in the
+    input.
+    """
+    depth = 0
+    header = []
+    current = None
+    for (line, raw) in unfolded_lines(f):
+        ## The name can neither contain ';' nor ':', so there is no need
+        ## for parsing the complete line unless it's one we care about
+        name = _name_re.match(line).group(0).upper()
+        if name in ('BEGIN', 'END', 'UID', 'TZID') or line[len(name):len(name)+1] == ';':
+            (_, params, value) = split_property(line)
+        else:
+            params = {}
+        if name == 'BEGIN':
+            depth += 1
+            if depth == 1:
+                header = []
+                continue
+            if depth == 2:
+                current = [raw]
+                comp_name = value.strip().upper()
+                uid = None
+                tzids = set()
+                continue
+        elif name == 'END':
+            depth -= 1
+            if depth < 0:
+                raise ValueError("unexpected %s in icalendar data" % line)
+            if depth == 1:
+                current.append(raw)
+                yield (header, comp_name, uid, tzids, "\r\n".join(current))
+                current = None
+                continue
+            if depth == 0:
+                continue
+        if depth == 1:
+            header.append(raw)
+        elif depth >= 2:
+            current.append(raw)
+            if depth == 2 and name == 'UID':
+                uid = value
+            elif depth == 2 and name == 'TZID':
+                tzids.add(value)
+            elif 'TZID' in params:
+                tzids.add(params['TZID'])
+    if depth:
+        raise ValueError("icalendar data ended inside a component")
+
+def scan_calendar(f):
+    """
+    Reads through f, returning (uid_counts, timezones), uid_counts
+    being a dict from UID to the number of components with that UID,
+    and timezones a dict from TZID to the VTIMEZONE component.
+    """
+    uid_counts = {}
+    timezones = {}
+    for (header, name, uid, tzids, text) in _components(f):
+        if name == 'VTIMEZONE':
+            timezones.update((x, text) for x in tzids)
+        elif uid is not None:
+            uid_counts[uid] = uid_counts.get(uid, 0) + 1
+    return (uid_counts, timezones)
+
+def _seekable(f):
+    try:
+        return f.seekable()
+    except (AttributeError, ValueError, OSError):
+        return False
+
+def _calendar_object(header, timezones, tzids, components):
+    ## Only the time zones actually used are included - exports tend to
+    ## carry lots of time zones, and duplicating all of them into every
+    ## object would blow up the size of each upload.  The VTIMEZONE
+    ## blocks are kept as text, so they are not reserialized every time
+    timezones = [timezones[x] for x in sorted(tzids) if x in timezones]
+    return "\r\n".join(['BEGIN:VCALENDAR'] + header + timezones + components + ['END:VCALENDAR']) + "\r\n"
+
+def split_calendar(f):
+    """
+    Yields (uid, ics) for each UID in the icalendar data in f, ics
+    being a self-contained VCALENDAR with all the components carrying
+    that UID (i.e. a recurring event with its overrides), and the time
+    zones referenced by them.  Components without UID are skipped.
+
+    If f is seekable, it's first scanned for the number of components
+    per UID and for time zones, so the components with the same UID
+    don't need to be next to each other.  Otherwise (i.e. a pipe), the
+    components with the same UID are assumed to be adjacent, as they
+    are in the exports from all calendar software we've seen, and the
+    time zones are expected to be given before the components using
+    them.
+    """
+    uid_counts = None
+    timezones = {}
+    if _seekable(f):
+        start = f.tell()
+        (uid_counts, timezones) = scan_calendar(f)
+        f.seek(start)
+
+    ## uid -> (header, tzids, components)
+    pending = {}
+    done = set()
+    for (header, name, uid, tzids, text) in _components(f):
+        if name == 'VTIMEZONE':
+            if uid_counts is None:
+                timezones.update((x, text) for x in tzids)
+            continue
+        if uid is None:
+            continue
+        if uid_counts is None:
+            if uid in done:
+                raise ValueError("the components with UID %s are not next to each other in the input - please give the input as a file rather than through a pipe" % uid)
+            if pending and not uid in pending:
+                (prev_uid, prev) = pending.popitem()
+                done.add(prev_uid)
+                yield (prev_uid, _calendar_object(prev[0], timezones, prev[1], prev[2]))
+        entry = pending.setdefault(uid, (header, set(), []))
+        entry[1].update(tzids)
+        entry[2].append(text)
+        if uid_counts is not None and len(entry[2]) == uid_counts[uid]:
+            del pending[uid]
+            yield (uid, _calendar_object(header, timezones, entry[1], entry[2]))
+    for (uid, entry) in pending.items():
+        yield (uid, _calendar_object(entry[0], timezones, entry[1], entry[2]))
+
+## Properties parsed into dates or timestamps by parse_calendar
+_time_props = {'DTSTART', 'DTEND', 'DUE', 'COMPLETED', 'RECURRENCE-ID', 'DTSTAMP', 'CREATED', 'LAST-MODIFIED', 'DTCREATED'}
+## Properties parsed into lists of dates or timestamps by parse_calendar
+_time_list_props = {'RDATE', 'EXDATE'}
+## Properties parsed into timedeltas by parse_calendar
+_duration_props = {'DURATION'}
+## Text properties, that needs to be unescaped
+_text_props = {'SUMMARY', 'DESCRIPTION', 'LOCATION', 'COMMENT', 'CONTACT'}
+## Text properties holding a comma separated list
+_list_props = {'CATEGORIES', 'RESOURCES'}
+
+_unescape_re = re.compile(r'\\(.)')
+_duration_re = re.compile(r'([-+])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+_list_split_re = re.compile(r'(?<!\\),')
+
+def _unescape(value):
+    return _unescape_re.sub(lambda m: "\n" if m.group(1) in 'nN' else m.group(1), value)
+
+def split_list(value):
+    """
+    Splits a comma separated text value, like CATEGORIES, into the
+    unescaped items
+    """
+    return [_unescape(x) for x in _list_split_re.split(value)]
+
+def _time_value(value, params):
+    from datetime import date, datetime
+    value = value.strip()
+    if params.get('VALUE') == ['DATE'] or len(value) == 8:
+        return date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+    ts = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        import pytz
+        return ts.replace(tzinfo=pytz.utc)
+    if 'TZID' in params:
+        import pytz
+        try:
+            return pytz.timezone(params['TZID'][0]).localize(ts)
+        except pytz.UnknownTimeZoneError:
+            raise ValueError("unknown time zone %s" % params['TZID'][0])
+    return ts
+
+def _duration_value(value):
+    from datetime import timedelta
+    rx = _duration_re.match(value.strip().upper())
+    if not rx:
+        raise ValueError("invalid duration %s" % value)
+    (weeks, days, hours, minutes, seconds) = (int(x or 0) for x in rx.groups()[1:])
+    duration = timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+    return -duration if rx.group(1) == '-' else duration
+
+class Property():
+    __slots__ = ('name', 'params', 'value')
+    def __init__(self, name, params, value):
+        self.name = name
+        self.params = params
+        self.value = value
+
+class Component():
+    """
+    A minimal stand-in for a vobject component, supporting the parts of
+    the vobject interface used by calendar-cli: name, contents (a dict
+    from lower case property or subcomponent name to a list of them),
+    attribute access to the first property or subcomponent with a given
+    name (i.e. comp.summary.value, cal.vtodo) and components().
+    """
+    def __init__(self, name):
+        self.name = name
+        self.contents = {}
+        self.subcomponents = []
+
+    def components(self):
+        return iter(self.subcomponents)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        found = self.contents.get(attr.replace('_', '-'))
+        if not found:
+            raise AttributeError(attr)
+        return found[0]
+
+def parse_calendar(data):
+    """
+    Parses icalendar data into Component objects, without building a
+    complete vobject tree.  Only the properties calendar-cli is using
+    for filtering, sorting and output are converted to python types;
+    the others are left as strings.  Raises ValueError on anything it
+    cannot handle, like time zones not known by pytz, so the caller
+    may fall back to vobject.
+    """
+    stack = []
+    root = None
+    for (line, raw) in unfolded_lines(data.splitlines()):
+        (name, params, value) = split_property(line)
+        if name == 'BEGIN':
+            comp = Component(value.strip().upper())
+            if stack:
+                stack[-1].subcomponents.append(comp)
+                stack[-1].contents.setdefault(comp.name.lower(), []).append(comp)
+            stack.append(comp)
+            continue
+        if name == 'END':
+            if not stack:
+                raise ValueError("unexpected %s in icalendar data" % line)
+            root = stack.pop()
+            continue
+        if not stack:
+            continue
+        params = {key: [pvalue] for (key, pvalue) in params.items()}
+        if name in _time_props:
+            value = _time_value(value, params)
+        elif name in _time_list_props:
+            if params.get('VALUE') == ['PERIOD']:
+                raise ValueError("RDATE periods are not supported")
+            value = [_time_value(x, params) for x in value.split(',')]
+        elif name in _duration_props:
+            value = _duration_value(value)
+        elif name in _text_props:
+            value = _unescape(value)
+        elif name in _list_props:
+            value = split_list(value)
+        stack[-1].contents.setdefault(name.lower(), []).append(Property(name, params, value))
+    if stack or root is None:
+        raise ValueError("incomplete icalendar data")
+    return root
+
+_unfold_re = re.compile(r'\r?\n[ \t]')
+_subcomponent_re = re.compile(r'^BEGIN:.*?^END:[^\r\n]*', re.M | re.S | re.I)
+_scan_time_re = re.compile(r'\s*(\d{4})(\d\d)(\d\d)(?:T(\d\d)(\d\d)(\d\d))?')
+
+@functools.lru_cache()
+def _component_re(comp_name):
+    return re.compile(r'^BEGIN:%s\r?\n(.*?)^END:%s\r?$' % (comp_name, comp_name), re.M | re.S | re.I)
+
+@functools.lru_cache()
+def _properties_re(names):
+    return re.compile(r'^(?:%s)[;:][^\r\n]*(?:\r?\n[ \t][^\r\n]*)*' % '|'.join(re.escape(x) for x in names), re.M | re.I)
+
+def scan_properties(data, comp_name, names):
+    """
+    Picks the properties with the given (upper case) names out of the
+    first comp_name component in the icalendar data, without parsing
+    the rest of it.  Returns a dict from property name to a list of
+    (params, value) tuples, as given by split_property, or None if
+    there is no such component.  The values are not converted in any
+    way.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    found = _component_re(comp_name).search(data)
+    if not found:
+        return None
+    text = found.group(1)
+    if 'BEGIN:' in text.upper():
+        ## i.e. a VALARM, which may have properties like UID of its own
+        text = _subcomponent_re.sub('', text)
+    ret = {}
+    for match in _properties_re(tuple(names)).finditer(text):
+        (name, params, value) = split_property(_unfold_re.sub('', match.group(0)))
+        ret.setdefault(name, []).append((params, value))
+    return ret
+
+def scan_time(value):
+    """
+    Returns the date or timestamp in a DTSTART, DUE, etc value as a
+    naive datetime in whatever time zone it is given in, or None if it
+    cannot be read
+    """
+    from datetime import datetime
+    found = _scan_time_re.match(value)
+    if not found:
+        return None
+    try:
+        return datetime(*(int(x) for x in found.groups() if x is not None))
+    except ValueError:
+        return None
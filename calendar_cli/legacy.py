@@ -14,36 +14,41 @@ Copyright (C) 2013-2023 Tobias Brox and other contributors.
 See https://www.gnu.org/licenses/gpl-3.0.en.html for license information.
 """
 import argparse
-import tzlocal
+## The heavy libraries (caldav, icalendar, vobject, dateutil, pytz, etc)
+## are imported by the functions needing them, to keep the startup
+## time for simple commands and --help down.
 ## we still need to use pytz, see https://github.com/collective/icalendar/issues/333
 #try:
 #    import zoneinfo
 #except:
 #    from backports import zoneinfo
-import pytz
 import time
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
 from datetime import time as time_
-import dateutil.parser
-from dateutil.rrule import rrulestr
-from icalendar import Calendar,Event,Todo,Journal,Alarm
-from calendar_cli.config import interactive_config, config_section, read_config
-import vobject
-import caldav
+from calendar_cli.config import interactive_config, config_section, read_config, expand_config_section
+from calendar_cli.cache import SyncCache, DiscoveryCache, default_cache_dir
+from calendar_cli.query import todo_filters, todo_query, pending_filters, uid_filters, event_query
+from calendar_cli.tasks import TaskRecord, TaskGraph, to_utc, text_attributes
+from calendar_cli.ics import split_calendar, parse_calendar, scan_properties, scan_time, split_list
+from calendar_cli.template import Template
+from calendar_cli import profile
+from calendar_cli.profile import phase
 import uuid
 import json
 import os
 import logging
 import sys
 import re
-import urllib3
+import shlex
+import heapq
+import itertools
 from getpass import getpass
 from six import PY3
 
 from calendar_cli.metadata import metadata
 __version__ = metadata["version"]
 
-UTC = pytz.utc
+UTC = timezone.utc
 #UTC = zoneinfo.ZoneInfo('UTC')
 
 def to_normal_str(text):
@@ -103,6 +108,8 @@ def _tz(timezone=None):
     gives the local time zone if no time zone is given,
     otherwise should return the timezone (or some canonical time zone object)
     """
+    import pytz
+    import tzlocal
     if timezone is None:
         try:
             ## should not be needed - but see
@@ -156,6 +163,7 @@ def niy(*args, **kwargs):
     raise NotImplementedError
 
 def caldav_connect(args):
+    import caldav
     ## args.ssl_verify_cert is a string and can be a path or 'yes'/'no'.
     ## the library expects a path or a boolean.
     ## Translate 'yes' and 'no' to True and False, or pass the raw string:
@@ -164,7 +172,10 @@ def caldav_connect(args):
         'no': False
     }.get(args.ssl_verify_cert, args.ssl_verify_cert)
     # Create the account
-    return caldav.DAVClient(url=args.caldav_url, username=args.caldav_user, password=args.caldav_pass, ssl_verify_cert=ssl_verify_cert, proxy=args.caldav_proxy)
+    caldav_conn = caldav.DAVClient(url=args.caldav_url, username=args.caldav_user, password=args.caldav_pass, ssl_verify_cert=ssl_verify_cert, proxy=args.caldav_proxy)
+    from calendar_cli.transport import configure
+    configure(caldav_conn, args.retries, args.retry_backoff)
+    return caldav_conn
 
 def parse_time_delta(delta_string):
     # TODO: handle bad strings more gracefully
@@ -173,15 +184,111 @@ def parse_time_delta(delta_string):
     num = int(delta_string[:-1])
     return timedelta(0, num*time_units[delta_string[-1].lower()])
 
+## calendars already looked up, by connection and calendar url.  Used
+## for sharing the calendar objects between commands in batch mode.
+_calendars = {}
+
 def find_calendar(caldav_conn, args):
+    if args.vdir:
+        from calendar_cli.vdir import Vdir
+        key = ('vdir', args.vdir)
+        if not key in _calendars:
+            _calendars[key] = Vdir(args.vdir, args.cache_dir)
+        return _calendars[key]
+    key = (id(caldav_conn), args.calendar_url)
+    if not key in _calendars:
+        with phase('discovery'):
+            _calendars[key] = _find_calendar(caldav_conn, args)
+    return _calendars[key]
+
+## urls of calendars found through the discovery cache
+_calendars_from_discovery_cache = set()
+
+def _discovery(caldav_conn, args):
+    """
+    Returns the cached discovery results for the config section,
+    doing the discovery if needed.  Returns None if the discovery cache
+    is not enabled.
+    """
+    import caldav.lib.error
+    if not args.discovery_ttl:
+        return None
+    cache = DiscoveryCache(args.cache_dir or default_cache_dir())
+    if not args.refresh_discovery:
+        entry = cache.get(args.config_section, args.caldav_url, args.caldav_user, args.discovery_ttl)
+        if entry:
+            return entry
+    ## refresh only once per command
+    args.refresh_discovery = False
+    principal = caldav.Principal(caldav_conn)
+    calendars = []
+    for cal in principal.calendars():
+        try:
+            components = cal.get_supported_components()
+        except caldav.lib.error.DAVError:
+            components = None
+        calendars.append({'url': str(cal.url), 'name': getattr(cal, 'name', None), 'components': components})
+    return cache.set(args.config_section, args.caldav_url, args.caldav_user, {
+        'principal_url': str(principal.url),
+        'calendar_home_set_url': str(principal.calendar_home_set.url),
+        'calendars': calendars})
+
+def _principal(caldav_conn, args):
+    import caldav
+    discovery = _discovery(caldav_conn, args)
+    if not discovery:
+        return caldav.Principal(caldav_conn)
+    principal = caldav.Principal(caldav_conn, url=discovery['principal_url'])
+    principal.calendar_home_set = discovery['calendar_home_set_url']
+    return principal
+
+def _find_calendar_in_discovery_cache(caldav_conn, args):
+    import caldav
+    discovery = _discovery(caldav_conn, args)
+    if not discovery:
+        return None
+    for cal in discovery['calendars']:
+        cal_id = cal['url'].rstrip('/').rsplit('/', 1)[-1]
+        if not args.calendar_url or args.calendar_url in (cal_id, cal['name']):
+            _calendars_from_discovery_cache.add(cal['url'])
+            return caldav.Calendar(client=caldav_conn, url=cal['url'], name=cal['name'])
+    return None
+
+def _stale_discovery(caldav_conn, args):
+    """
+    To be called when getting a 404.  Checks if the calendar was found
+    through the discovery cache and has disappeared from the server.  If
+    so, the cache is refreshed and True is returned.
+    """
+    import caldav.lib.error
+    import caldav.elements.dav
+    key = (id(caldav_conn), args.calendar_url)
+    cal = _calendars.get(key)
+    if cal is None or not str(cal.url) in _calendars_from_discovery_cache:
+        return False
+    try:
+        cal.get_properties([caldav.elements.dav.ResourceType()])
+        return False
+    except caldav.lib.error.NotFoundError:
+        pass
+    logging.info("calendar %s not found, refreshing the discovery cache" % cal.url)
+    DiscoveryCache(args.cache_dir or default_cache_dir()).invalidate(args.config_section)
+    _calendars_from_discovery_cache.discard(str(cal.url))
+    del _calendars[key]
+    return True
+
+def _find_calendar(caldav_conn, args):
+    import caldav
+    if args.calendar_url and '/' in args.calendar_url:
+        return caldav.Calendar(client=caldav_conn, url=args.calendar_url)
+    cal = _find_calendar_in_discovery_cache(caldav_conn, args)
+    if cal is not None:
+        return cal
     if args.calendar_url:
-        if '/' in args.calendar_url:
-            return caldav.Calendar(client=caldav_conn, url=args.calendar_url)
-        else:
-            return caldav.Principal(caldav_conn).calendar(cal_id=args.calendar_url)
+        return _principal(caldav_conn, args).calendar(cal_id=args.calendar_url)
     else:
         ## Find default calendar
-        calendars = caldav.Principal(caldav_conn).calendars()
+        calendars = _principal(caldav_conn, args).calendars()
         if not calendars:
             sys.stderr.write("no calendar url given and no default calendar found - can't proceed.  You will need to create a calendar first")
             sys.exit(2)
@@ -189,12 +296,147 @@ def find_calendar(caldav_conn, args):
             sys.stderr.write("no calendar url given and several calendars found; assuming the primary is %s" % calendars[0].url)
         return calendars[0]
 
+def _synced_cache(caldav_conn, args):
+    """
+    Returns the calendar and an up-to-date SyncCache for it
+    """
+    cal = find_calendar(caldav_conn, args)
+    cache = SyncCache(args.cache_dir or default_cache_dir(), args.config_section, str(cal.url))
+    cache.revalidate(cal)
+    cache.save()
+    return (cal, cache)
+
+def _todos_by_query(cal, alternatives, args, props=None):
+    """
+    Lets the server do the filtering through calendar-query REPORTs.
+    Returns None if the server rejects the query.
+    """
+    import caldav.lib.error
+    from caldav.elements import dav
+    tasks = {}
+    try:
+        for filters in alternatives:
+            for task in cal.search(xml=todo_query(filters, props), comp_class=caldav.Todo):
+                ## The caldav library leaves the etag as an XML element
+                etag = task.props.get(dav.GetEtag.tag)
+                if etag is not None and not isinstance(etag, str):
+                    task.props[dav.GetEtag.tag] = etag.text
+                tasks[str(task.url)] = task
+    except caldav.lib.error.DAVError:
+        logging.info("server-side filtering failed, will do the filtering locally", exc_info=True)
+        return None
+    return list(tasks.values())
+
+def _events_by_query(cal, search_dtstart, search_dtend, props, args):
+    """
+    Asks the server for the events in the interval, with only the
+    properties given.  Yields (object, instance), the instance being a
+    calendar_cli.ics.Component where possible and a vobject component
+    otherwise.  Recurring events are expanded locally.
+    """
+    import caldav.lib.error
+    try:
+        events = cal.search(xml=event_query(search_dtstart, search_dtend, props), comp_class=caldav.Event)
+    except caldav.lib.error.DAVError:
+        logging.info("calendar-query failed, falling back to date_search", exc_info=True)
+        if args.local_expansion:
+            events = _expand_locally(cal.date_search(search_dtstart, search_dtend, expand=False), search_dtstart, search_dtend, args)
+        else:
+            events = cal.date_search(search_dtstart, search_dtend, expand=True)
+        return ((x, x.instance) for x in events)
+    return _light_instances(events, search_dtstart, search_dtend, args)
+
+def _light_instances(events, search_dtstart, search_dtend, args):
+    from calendar_cli.ics import Component
+    from calendar_cli.recurrence import expand
+    tzinfo = _tz(args.timezone)
+    for event in events:
+        try:
+            instance = parse_calendar(event.data)
+        except ValueError:
+            ## not understood by the lightweight parser
+            instance = None
+        if instance is None:
+            for expanded in _expand_locally([event], search_dtstart, search_dtend, args):
+                yield (expanded, expanded.instance)
+        elif not any(hasattr(x, 'rrule') or hasattr(x, 'rdate') or hasattr(x, 'recurrence_id') for x in instance.components()):
+            yield (event, instance)
+        else:
+            for expanded in expand([x for x in instance.components() if x.name == 'VEVENT'], search_dtstart, search_dtend, tzinfo):
+                cal = Component('VCALENDAR')
+                cal.subcomponents.append(expanded)
+                cal.contents['vevent'] = [expanded]
+                yield (event, cal)
+
+def _expand_locally(events, search_dtstart, search_dtend, args):
+    """
+    Client side equivalent of a date_search with expand=True.  Yields one
+    caldav Event per event instance overlapping the search interval.
+    """
+    import caldav
+    import vobject
+    from calendar_cli.recurrence import expand
+    tzinfo = _tz(args.timezone)
+    for event in events:
+        comps = [x for x in event.instance.components() if x.name == 'VEVENT']
+        for instance in expand(comps, search_dtstart, search_dtend, tzinfo):
+            cal = vobject.iCalendar()
+            cal.add(instance)
+            yield caldav.Event(client=event.client, url=event.url, data=cal, parent=event.parent)
+
+def _overlaps(event, search_dtstart, search_dtend, args):
+    """
+    Checks if the event (vobject or calendar_cli.ics component) overlaps
+    the search interval
+    """
+    from calendar_cli.recurrence import overlaps
+    return overlaps(event, search_dtstart, search_dtend, _tz(args.timezone))
+
+def _in_interval(instances, search_dtstart, search_dtend, args):
+    """
+    Filters the (object, instance) pairs from _light_instances on the
+    search interval, for when the server hasn't done it
+    """
+    for (event, instance) in instances:
+        if any(x.name == 'VEVENT' and _overlaps(x, search_dtstart, search_dtend, args) for x in instance.components()):
+            yield (event, instance)
+
+def _read_objects(args, comp_name):
+    """
+    Yields a caldav object for each calendar object with a component of
+    the given type (VEVENT or VTODO) in the --icalendar input, read
+    from stdin or from --icalendar-file.  The input is split and
+    yielded while reading it, so it may be larger than the memory.
+    """
+    import caldav
+    comp_class = caldav.Event if comp_name == 'VEVENT' else caldav.Todo
+    ## split_calendar joins the lines with CRLF
+    marker = "\r\nBEGIN:%s\r\n" % comp_name
+    f = sys.stdin if args.icalendar_file == '-' else open(args.icalendar_file, 'r')
+    try:
+        for (uid, ics) in split_calendar(f):
+            if marker in ics:
+                yield comp_class(data=ics)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def _event_duration(event):
+    if hasattr(event, 'dtend'):
+        return event.dtend.value - event.dtstart.value
+    if hasattr(event, 'duration'):
+        return event.duration.value
+    if isinstance(event.dtstart.value, datetime):
+        return timedelta(0)
+    return timedelta(1)
+
 def _calendar_addics(caldav_conn, ics, uid, args):
     """"
     "Internal" method for adding a calendar object item to the caldav
     server through a PUT.  ASSUMES the ics conforms to rfc4791.txt
     section 4.1 Handles --calendar-url and --icalendar from the args
     """
+    import caldav.lib.error
     if args.icalendar and args.nocaldav:
         print(ics)
         return
@@ -237,34 +479,39 @@ def calendar_addics(caldav_conn, args):
     each event as long as the uid is different.
     """
     if args.file == '-':
-        input_ical = sys.stdin.read()
+        _calendar_addics_split(caldav_conn, sys.stdin, args)
     else:
         with open(args.file, 'r') as f:
-            input_ical = f.read()
-
-    c = Calendar.from_ical(input_ical)
+            _calendar_addics_split(caldav_conn, f, args)
 
-    ## unfortunately we need to mess around with the object internals,
-    ## since the icalendar library doesn't offer methods out of the
-    ## hat for doing such kind of things
-    entries = c.subcomponents
+def _calendar_addics_split(caldav_conn, f, args):
+    from calendar_cli.bulk import run_concurrently, set_connection_pool_size, BulkReport
+    from calendar_cli.transport import concurrency_limit
+    ## The objects are split out and uploaded while reading the input
+    objects = split_calendar(f)
 
-    ## Timezones should be duplicated into each ics, ref the RFC
-    timezones = [x for x in entries if x.name == 'VTIMEZONE']
-
-    ## Make a mapping from UID to the other components
-    uids = {}
-    for x in entries:
-        if x.name == 'VTIMEZONE' or not 'UID' in x:
-            continue
-        uid = x['UID'].to_ical()
-        uids[uid] = uids.get(uid, []) + [x]
+    if args.nocaldav or args.icalendar:
+        for (uid, ics) in objects:
+            _calendar_addics(caldav_conn, ics, uid, args)
+        return
 
-    for uid in uids:
-        c.subcomponents = timezones + uids[uid]
-        _calendar_addics(caldav_conn, c.to_ical(), uid, args)
+    ## resolve the calendar once, before starting the workers
+    find_calendar(caldav_conn, args)
+    set_connection_pool_size(caldav_conn, args.jobs)
+    report = BulkReport(args.progress_file)
+    def upload(obj):
+        _calendar_addics(caldav_conn, obj[1], obj[0], args)
+    try:
+        with phase('update'):
+            for (obj, error) in run_concurrently((x for x in objects if not report.skip(x[0])), upload, args.jobs, concurrency_limit(caldav_conn, args.jobs)):
+                report.record(obj[0], 'failed' if error else 'ok', error)
+    finally:
+        report.close()
+    if report.failed():
+        sys.exit(1)
 
 def create_alarm(message, relative_timedelta):
+    from icalendar import Alarm
     alarm = Alarm()
     alarm.add('ACTION', 'DISPLAY')
     alarm.add('DESCRIPTION', message)
@@ -272,6 +519,9 @@ def create_alarm(message, relative_timedelta):
     return alarm
 
 def calendar_add(caldav_conn, args):
+    import dateutil.parser
+    import vobject
+    from icalendar import Calendar, Event
     cal = Calendar()
     cal.add('prodid', '-//{author_short}//{product}//{language}'.format(language=args.language, **metadata))
     cal.add('version', '2.0')
@@ -342,6 +592,7 @@ def calendar_delete(caldav_conn, args):
     event.delete()
 
 def journal_add(caldav_conn, args):
+    from icalendar import Calendar, Journal
     ## TODO: copied from todo_add, should probably be consolidated
     cal = Calendar()
     cal.add('prodid', '-//{author_short}//{product}//{language}'.format(language=args.language, **metadata))
@@ -360,10 +611,13 @@ def journal_add(caldav_conn, args):
     ## FULL STOP - should do some major refactoring before doing more work here!
 
 def todo_add(caldav_conn, args):
+    import dateutil.parser
+    from icalendar import Calendar, Todo
     ## TODO: copied from calendar_add, should probably be consolidated
     if args.icalendar or args.nocaldav:
         niy(feature="add todo item by icalendar raw stdin data or create raw icalendar data to stdout")
-    if args.todo_uid:
+    ## With --is-child, --todo-uid selects the parent
+    if args.todo_uid and not args.is_child:
         uid = args.todo_uid
     else:
         uid = uuid.uuid1()
@@ -385,7 +639,7 @@ def todo_add(caldav_conn, args):
     todo.add('status', 'NEEDS-ACTION')
 
     if args.is_child:
-        for t in todo_select(caldav_conn, args):
+        for t in (x.task for x in todo_select(caldav_conn, args)):
             todo.add('related-to', t.instance.vtodo.uid.value)
             rt = t.instance.vtodo.add('related-to')
             rt.params['RELTYPE']=['CHILD']
@@ -416,13 +670,96 @@ def todo_add(caldav_conn, args):
     _calendar_addics(caldav_conn, cal.to_ical(), uid, args)
     print("Added todo item with uid=%s" % uid)
 
-def calendar_agenda(caldav_conn, args):
-    if args.nocaldav and args.icalendar:
-        niy(feature="Read events from stdin in ical format and list out in prettified format")
+def _agenda_events(caldav_conn, args):
+    """
+    Returns the event instances within the agenda interval as a list of
+    dicts, sorted by dtstart
+    """
+    return list(_agenda_stream(caldav_conn, args, True))
 
-    if args.nocaldav:
+## The windows of _agenda_stream grow up to this many times --window-days
+_max_window_growth = 12
+
+def _agenda_stream(caldav_conn, args, sort):
+    """
+    Yields the event instances within the agenda interval as dicts,
+    sorted by dtstart if sort is set.
+
+    When asking a server for an interval longer than --window-days, the
+    interval is split into windows, fetched --jobs at the time.  The
+    first window is --window-days long, and each following one twice
+    as long as the one before (up to _max_window_growth times the
+    first), so the start of a long agenda arrives quickly without the
+    rest taking many more requests.  The windows are yielded in order
+    as soon as each of them (and the ones before it) has arrived.
+    Events overlapping several windows are returned by the server for
+    each of them, and only yielded the first time.
+    """
+    if args.nocaldav and not args.icalendar:
         raise ValueError("Agenda with --nocaldav only makes sense together with --icalendar")
+    (search_dtstart, search_dtend) = _agenda_interval(args)
+    windows = []
+    start = search_dtstart
+    if args.window_days and not (args.nocaldav or args.vdir or args.sync_cache):
+        step = timedelta(args.window_days)
+        while search_dtend - start > step:
+            windows.append((start, start+step))
+            start += step
+            step = min(step*2, timedelta(args.window_days*_max_window_growth))
+    windows.append((start, search_dtend))
+    def fetch(window):
+        events = _agenda_instances(caldav_conn, args, *window)
+        if sort:
+            ## changed to use the "key"-parameter at 2019-09-18, as needed for python3.
+            ## this will probably cause regression on sufficiently old versions of python
+            events = sorted(events, key=lambda a: a['dtstart'])
+        return events
+    if len(windows) == 1:
+        yield from fetch(windows[0])
+        return
+
+    import concurrent.futures
+    from calendar_cli.bulk import set_connection_pool_size
+    from calendar_cli.transport import concurrency_limit
+    ## resolve the calendar once, before starting the workers
+    find_calendar(caldav_conn, args)
+    set_connection_pool_size(caldav_conn, args.jobs)
+    limit = concurrency_limit(caldav_conn, args.jobs)
+    def fetch_window(window):
+        if limit is None:
+            return list(fetch(window))
+        with limit:
+            return list(fetch(window))
+    seen = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        ## map gives the results in the order of the windows
+        for events in executor.map(fetch_window, windows):
+            for event in events:
+                key = _instance_key(event)
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield event
+    finally:
+        ## don't fetch the remaining windows if the consumer gives up
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _instance_key(event):
+    """
+    Identifies an event instance across the windows of _agenda_stream
+    """
+    instance = event['instance']
+    uid = instance.uid.value if hasattr(instance, 'uid') else None
+    if hasattr(instance, 'recurrence_id'):
+        return (uid, str(instance.recurrence_id.value))
+    return (uid, event['dtstart'])
 
+def _agenda_interval(args):
+    """
+    Returns the agenda interval given by the options
+    """
+    import dateutil.parser
     if args.from_time:
         search_dtstart = dateutil.parser.parse(args.from_time)
         search_dtstart = _localize(search_dtstart, args.timezone)
@@ -436,18 +773,49 @@ def calendar_agenda(caldav_conn, args):
     elif args.agenda_days:
         search_dtend = search_dtstart + timedelta(args.agenda_days)
     ## TODO - error handling if search_dtend is not set above - but agenda_days have a default value, so that probably won't happen
+    return (search_dtstart, search_dtend)
 
+def _agenda_instances(caldav_conn, args, search_dtstart, search_dtend):
+    """
+    Yields the event instances within the interval as dicts, in the
+    order they are found.  With --nocaldav, a vdir or the sync cache,
+    the events are yielded while the objects are being read.
+    """
     ## TODO: time zone
-    events_ = find_calendar(caldav_conn, args).date_search(search_dtstart, search_dtend, expand=True)
-    events = []
-    if args.icalendar:
-        for ical in events_:
-            print(to_normal_str(ical.data).strip())
-    else:
-        for event_cal in events_:
-            tzinfo = _tz(args.timezone)
-            events__ = event_cal.instance.components()
-            for event in events__:
+    props = _agenda_props(args)
+    with phase('fetch'):
+        if args.nocaldav or args.vdir:
+            ## The input is read while iterating over the instances
+            ## below, and only the events within the interval are kept
+            if args.nocaldav:
+                objects = _prefilter_events(_read_objects(args, 'VEVENT'), search_dtstart, search_dtend)
+            else:
+                objects = find_calendar(caldav_conn, args).events(search_dtstart, search_dtend)
+            if props:
+                events_ = None
+                instances = _in_interval(_light_instances(objects, search_dtstart, search_dtend, args), search_dtstart, search_dtend, args)
+            else:
+                events_ = _expand_locally(objects, search_dtstart, search_dtend, args)
+        elif args.sync_cache:
+            from calendar_cli.columns import ColumnIndex
+            (cal, cache) = _synced_cache(caldav_conn, args)
+            hrefs = ColumnIndex.update(cache).events(search_dtstart, search_dtend)
+            events_ = _expand_locally(cache.objects_by_href(cal, hrefs), search_dtstart, search_dtend, args)
+        elif props:
+            events_ = None
+            instances = _events_by_query(find_calendar(caldav_conn, args), search_dtstart, search_dtend, props, args)
+        else:
+            cal = find_calendar(caldav_conn, args)
+            if args.local_expansion:
+                events_ = _expand_locally(cal.date_search(search_dtstart, search_dtend, expand=False), search_dtstart, search_dtend, args)
+            else:
+                events_ = cal.date_search(search_dtstart, search_dtend, expand=True)
+    if events_ is not None:
+        instances = ((x, x.instance) for x in events_)
+    tzinfo = _tz(args.timezone)
+    with phase('parse'):
+        for (event_cal, instance) in instances:
+            for event in instance.components():
                 if event.name != 'VEVENT':
                     continue
                 dtstart = event.dtstart.value if hasattr(event, 'dtstart') else _now()
@@ -455,94 +823,478 @@ def calendar_agenda(caldav_conn, args):
                     dtstart = datetime(dtstart.year, dtstart.month, dtstart.day)
                 dtstart = _localize(dtstart, tzinfo)
 
-                events.append({'dtstart': dtstart, 'instance': event})
+                yield {'dtstart': dtstart, 'instance': event, 'object': event_cal}
 
-        ## changed to use the "key"-parameter at 2019-09-18, as needed for python3.
-        ## this will probably cause regression on sufficiently old versions of python
-        events.sort(key=lambda a: a['dtstart'])
+## The VEVENT properties needed for each of the agenda template fields
+_event_field_props = {
+    'summary': ('SUMMARY', 'LOCATION', 'DESCRIPTION'),
+    'dtcreated': ('DTCREATED',),
+    'location': ('LOCATION',),
+    'description': ('DESCRIPTION',),
+}
+
+## The properties looked at by _prefilter_events
+_prefilter_event_props = ('DTSTART', 'DTEND', 'DURATION', 'RRULE', 'RDATE', 'RECURRENCE-ID')
+
+def _prefilter_events(objects, search_dtstart, search_dtend):
+    """
+    Yields the caldav objects that may have events within the interval,
+    judging from a cheap scan of the raw data.  Like _prefilter_tasks,
+    it only leaves out the events that certainly don't overlap;
+    recurring events are always passed on.
+    """
+    (start, end) = (x.astimezone(timezone.utc).replace(tzinfo=None) for x in (search_dtstart, search_dtend))
+    for obj in objects:
+        props = scan_properties(obj.data, 'VEVENT', _prefilter_event_props)
+        if props is None or 'RRULE' in props or 'RDATE' in props or 'RECURRENCE-ID' in props or obj.data.count('BEGIN:VEVENT') > 1:
+            yield obj
+            continue
+        dtstart = scan_time(props['DTSTART'][0][1]) if 'DTSTART' in props else None
+        if dtstart is None:
+            yield obj
+            continue
+        if dtstart - _prefilter_slack >= end:
+            continue
+        if 'DTEND' in props:
+            dtend = scan_time(props['DTEND'][0][1])
+        elif 'DURATION' in props:
+            dtend = None
+        else:
+            dtend = dtstart if 'T' in props['DTSTART'][0][1] else dtstart + timedelta(1)
+        if dtend is not None and dtend + _prefilter_slack <= start and dtstart + _prefilter_slack < start:
+            continue
+        yield obj
+
+def _agenda_props(args):
+    """
+    Returns the set of VEVENT properties needed for printing the
+    agenda, or None if the complete objects are needed
+    """
+    fields = Template(args.event_template).fields
+    if (args.icalendar and not args.nocaldav) or 'instance' in fields:
+        return None
+    props = {'UID', 'DTSTART', 'DTEND', 'DURATION', 'RECURRENCE-ID', 'RRULE', 'RDATE', 'EXDATE'}
+    if args.format == 'jsonl':
+        props.update(_event_json_props)
+    for field in fields:
+        props.update(_event_field_props.get(field, ()))
+    return props
+
+def calendar_agenda(caldav_conn, args):
+    ## with --no-sort, the events are printed while being read
+    events = _agenda_stream(caldav_conn, args, not args.no_sort)
+    with phase('render'):
+        print_agenda(events, args)
+
+## The VEVENT properties included in the --format jsonl records
+_event_json_props = ('UID', 'SUMMARY', 'LOCATION', 'DESCRIPTION', 'STATUS', 'CATEGORIES', 'DTSTART', 'DTEND', 'RECURRENCE-ID')
+
+def _json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_json_value(x) for x in value]
+    return value
+
+def _event_json(event):
+    """
+    The --format jsonl record for an event instance from _agenda_events
+    """
+    instance = event['instance']
+    record = {'type': 'event'}
+    for prop in _event_json_props:
+        values = instance.contents.get(prop.lower())
+        if not values:
+            continue
+        if prop == 'CATEGORIES':
+            record['categories'] = [str(c) for x in values for c in x.value]
+        else:
+            record[prop.lower().replace('-', '_')] = _json_value(values[0].value)
+    if hasattr(instance, 'dtstart'):
+        record['all_day'] = not isinstance(instance.dtstart.value, datetime)
+        if not 'dtend' in record:
+            record['dtend'] = _json_value(instance.dtstart.value + _event_duration(instance))
+    return record
+
+def _write_jsonl(records):
+    """
+    Writes one json object per line.  The output is flushed after each
+    record, so a consumer gets the records as soon as they are produced.
+    """
+    write = sys.stdout.write
+    try:
+        for record in records:
+            write(json.dumps(record) + "\n")
+            sys.stdout.flush()
+    except BrokenPipeError:
+        ## the consumer has stopped reading (i.e. "| head"), which is
+        ## not an error.  stdout is redirected to avoid another one on
+        ## exit, when python flushes it.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def print_agenda(events, args):
+    """
+    Prints out the events given by _agenda_events
+    """
+    if args.icalendar and not args.nocaldav:
+        printed = set()
         for event in events:
-            event['summary'] = "(no description)"
-            event['dtstart'] = event['dtstart'].strftime(args.timestamp_format)
-            for timeattr in ('dtcreated', 'dtend'):
-                if hasattr(event['instance'], timeattr):
-                    event[timeattr] = getattr(event['instance'], timeattr).value
-                    if hasattr(event[timeattr], 'strftime'):
-                        if hasattr(event[timeattr], 'astimezone'):
-                            event[timeattr] = event[timeattr].astimezone(_tz(args.timezone))
-                        event[timeattr] = event[timeattr].strftime(args.timestamp_format)
-                else:
-                    event[timeattr] = '-'
-            for textattr in vcal_txt_one:
-                if hasattr(event['instance'], textattr):
-                    event[textattr] = getattr(event['instance'], textattr).value
-                else:
-                    event[textattr] = '-'
+            if not id(event['object']) in printed:
+                printed.add(id(event['object']))
+                print(to_normal_str(event['object'].data).strip())
+    elif args.format == 'jsonl':
+        _write_jsonl(_event_json(x) for x in events)
+    else:
+        tzinfo = _tz(args.timezone)
+        def timestamp(attr):
+            def get(event):
+                if not hasattr(event['instance'], attr):
+                    return '-'
+                value = getattr(event['instance'], attr).value
+                if hasattr(value, 'strftime'):
+                    if hasattr(value, 'astimezone'):
+                        value = value.astimezone(tzinfo)
+                    value = value.strftime(args.timestamp_format)
+                return value
+            return get
+        def text(attr):
+            def get(event):
+                if not hasattr(event['instance'], attr):
+                    return '-'
+                return to_normal_str(getattr(event['instance'], attr).value)
+            return get
+        def summary(event):
             for summary_attr in ('summary', 'location', 'description'):
                 if hasattr(event['instance'], summary_attr):
-                    event['summary'] = getattr(event['instance'], summary_attr).value
-                    break
-            event['uid'] = event['instance'].uid.value if hasattr(event['instance'], 'uid') else '<no uid>'
-            for attr in vcal_txt_one + ['summary']:
-                if isinstance(event[attr], unicode):
-                    event[attr] = to_normal_str(event[attr])
-            print(args.event_template.format(**event))
+                    return to_normal_str(getattr(event['instance'], summary_attr).value)
+            return "(no description)"
+        getters = {
+            'instance': lambda x: x['instance'],
+            'dtstart': lambda x: x['dtstart'].strftime(args.timestamp_format),
+            'dtcreated': timestamp('dtcreated'),
+            'dtend': timestamp('dtend'),
+            'summary': summary,
+            'uid': lambda x: x['instance'].uid.value if hasattr(x['instance'], 'uid') else '<no uid>',
+        }
+        for attr in vcal_txt_one:
+            getters[attr] = text(attr)
+        _print_rows(Template(args.event_template), getters, events)
+
+def _print_rows(template, getters, rows, indent=None):
+    """
+    Renders each row through the template.  getters is a dict from
+    field name to a function giving the value of the field for a row;
+    only the fields actually used by the template are computed.  If
+    indent is given, the rows are (depth, row) tuples, and each line is
+    prefixed with indent repeated depth times.
+    """
+    fields = [x for x in template.fields if x in getters]
+    write = sys.stdout.write
+    if indent is None:
+        for row in rows:
+            write(template.format_map({x: getters[x](row) for x in fields}) + "\n")
+    else:
+        for (depth, row) in rows:
+            write(indent*depth + template.format_map({x: getters[x](row) for x in fields}) + "\n")
 
 def create_calendar(caldav_conn, args):
-    cal_obj = caldav.Principal(caldav_conn).make_calendar(cal_id=args.cal_id)
+    cal_obj = _principal(caldav_conn, args).make_calendar(cal_id=args.cal_id)
     if cal_obj:
         print("Created a calendar with id " + args.cal_id)
 
 def create_tasklist(caldav_conn, args):
-    cal_obj = caldav.Principal(caldav_conn).make_calendar(cal_id=args.cal_id, supported_calendar_component_set=['VTODO'])
+    cal_obj = _principal(caldav_conn, args).make_calendar(cal_id=args.cal_id, supported_calendar_component_set=['VTODO'])
     if cal_obj:
         print("Created a task list with id " + args.tasklist_id)
 
-def todo_select(caldav_conn, args):
+## The VTODO properties needed for each of the todo template fields
+_todo_field_props = {
+    'summary': ('SUMMARY', 'LOCATION', 'DESCRIPTION', 'URL'),
+    'location': ('LOCATION',),
+    'description': ('DESCRIPTION',),
+    'url': ('URL',),
+}
+
+def _todo_list_props(args):
+    """
+    Returns the set of VTODO properties needed for selecting and
+    printing the tasks, or None if the complete objects are needed
+    """
+    if args.icalendar and not args.nocaldav:
+        return None
+    props = {'UID', 'DTSTART', 'DUE', 'PRIORITY', 'STATUS', 'COMPLETED', 'RELATED-TO'}
+    if args.format == 'jsonl':
+        props.update(('SUMMARY', 'CATEGORIES') + tuple(x.upper() for x in text_attributes))
+    if getattr(args, 'expand', None):
+        props.update(('RRULE', 'RDATE', 'EXRULE', 'EXDATE', 'RECURRENCE-ID', 'SEQUENCE', 'DURATION'))
+    if args.list_categories:
+        props.add('CATEGORIES')
+    else:
+        fields = Template(args.todo_template).fields
+        if 'instance' in fields:
+            return None
+        for field in fields:
+            props.update(_todo_field_props.get(field, ()))
+    for attr in vtodo_txt_one + vtodo_txt_many:
+        if getattr(args, attr) or getattr(args, 'no'+attr):
+            props.add(attr.upper())
+    return props
+
+def _task_record(task, tzinfo, light):
+    """
+    Creates a TaskRecord, using the lightweight parser rather than
+    vobject if light is set and the parser can handle the data
+    """
+    if light:
+        try:
+            return TaskRecord(task, tzinfo, parse_calendar(task.data).vtodo)
+        except (ValueError, AttributeError):
+            pass
+    return TaskRecord(task, tzinfo)
+
+def todo_select(caldav_conn, args, props=None, stream=False):
+    """
+    Returns a list of TaskRecords for the tasks matching the selection
+    options, sorted by urgency.
+
+    If props is given, only those properties are fetched from the
+    server (if the server supports it), and the tasks are parsed with
+    the lightweight parser.  The returned tasks must then only be used
+    for output, never be saved back to the server.
+
+    If stream is set, an iterator may be returned instead, giving the
+    tasks from --nocaldav input or a vdir unsorted, while they are
+    being read.
+    """
     if args.top+args.limit+args.offset+args.offsetn and args.todo_uid:
         raise ValueError("It doesn't make sense to combine --todo-uid with --top/--limit/--offset/--offsetn")
-    if args.todo_uid:
-        tasks = [ find_calendar(caldav_conn, args).todo_by_uid(args.todo_uid) ]
+    tzinfo = _tz(args.timezone)
+    now = _now()
+    with phase('fetch'):
+        tasks = _fetch_tasks(caldav_conn, args, props, tzinfo, now)
+    with phase('filter'):
+        return _filter_tasks(tasks, args, now, stream)
+
+def _task_records(tasks, tzinfo, light=False):
+    with phase('parse'):
+        return [_task_record(x, tzinfo, light) for x in tasks]
+
+def _fetch_tasks(caldav_conn, args, props, tzinfo, now):
+    """
+    Fetches the tasks for todo_select, letting the server do as much of
+    the filtering as possible.  Returns a list of TaskRecords, or with
+    --nocaldav or a vdir, an unsorted iterator.
+    """
+    if args.nocaldav:
+        ## The tasks are parsed and filtered while reading the input,
+        ## so only the selected ones are kept in memory.  _filter_tasks
+        ## takes care of the sorting.
+        tasks = (_task_record(x, tzinfo, props) for x in _prefilter_tasks(_read_objects(args, 'VTODO'), args, now))
+        if args.todo_uid:
+            tasks = (x for x in tasks if x.uid == args.todo_uid)
+        else:
+            tasks = (x for x in tasks if x.is_pending())
+    elif args.vdir:
+        ## The index is used for skipping the files that certainly
+        ## won't match; the rest is filtered as usual
+        objects = find_calendar(caldav_conn, args).todos(
+            uid=args.todo_uid, category=args.categories or None, due_before=now if args.overdue else None)
+        tasks = (_task_record(x, tzinfo, props) for x in _prefilter_tasks(objects, args, now))
+        if not args.todo_uid:
+            tasks = (x for x in tasks if x.is_pending())
+    elif args.sync_cache:
+        ## The columnar index is used for skipping the tasks that
+        ## certainly won't match, so only the rest is parsed
+        from calendar_cli.columns import ColumnIndex
+        (cal, cache) = _synced_cache(caldav_conn, args)
+        hrefs = ColumnIndex.update(cache).todos(
+            uid=args.todo_uid, category=args.categories or None, due_before=now if args.overdue else None)
+        tasks = _task_records(_prefilter_tasks(cache.objects_by_href(cal, hrefs), args, now), tzinfo)
+        if args.todo_uid:
+            tasks = [x for x in tasks if x.uid == args.todo_uid]
+        else:
+            tasks = [x for x in tasks if x.is_pending()]
+            tasks.sort(key=lambda x: x.sort_key(now))
+    elif args.todo_uid:
+        ## Fetched through a query rather than todo_by_uid, as the
+        ## ETag is needed for the edit commands
+        cal = find_calendar(caldav_conn, args)
+        tasks = _task_records(_todos_by_query(cal, uid_filters(args.todo_uid), args) or [], tzinfo)
+        tasks = [x for x in tasks if x.uid == args.todo_uid]
+        if not tasks:
+            tasks = _task_records([cal.todo_by_uid(args.todo_uid)], tzinfo)
     else:
-        ## TODO: we're fetching everything from the server, and then doing the filtering here.  It would be better to let the server do the filtering, though that requires library modifications.
-        ## TODO: current release of the caldav library doesn't support the multi-key sort_keys attribute.  The try-except construct should be removed at some point in the future, when caldav 0.5 is released.
-        try:
-            tasks = find_calendar(caldav_conn, args).todos(sort_keys=('isnt_overdue', 'hasnt_started', 'due', 'dtstart', 'priority'))
-        except:
-            tasks = find_calendar(caldav_conn, args).todos()
-    for attr in vtodo_txt_one + vtodo_txt_many: ## TODO: now we have _exact_ match on items in the the array attributes, and substring match on items that cannot be duplicated.  Does that make sense?  Probably not.
-        if getattr(args, attr):
-            tasks = [x for x in tasks if hasattr(x.instance.vtodo, attr) and getattr(args, attr) in getattr(x.instance.vtodo, attr).value]
-        if getattr(args, 'no'+attr):
-            tasks = [x for x in tasks if not hasattr(x.instance.vtodo, attr)]
-    if args.overdue:
-        tasks = [x for x in tasks if hasattr(x.instance.vtodo, 'due') and _force_datetime(x.instance.vtodo.due.value, args) < _force_datetime(datetime.now(), args)]
-    if args.hide_future:
-        tasks = [x for x in tasks if not(hasattr(x.instance.vtodo, 'dtstart') and _force_datetime(x.instance.vtodo.dtstart.value, args) > _force_datetime(datetime.now(), args))]
-    if args.hide_parents or args.hide_children:
-        tasks_by_uid = {}
-        for task in tasks:
-            tasks_by_uid[task.instance.vtodo.uid.value] = task
-        for task in tasks:
-            if hasattr(task.instance.vtodo, 'related_to'):
-                uid = task.instance.vtodo.uid.value
-                rel_uid = task.instance.vtodo.related_to.value
-                rel_type = task.instance.vtodo.related_to.params.get('RELTYPE', 'PARENT')
-                if ((rel_type == 'CHILD' and args.hide_parents) or (rel_type == 'PARENT' and args.hide_children)) and \
-                   rel_uid in tasks_by_uid and uid in tasks_by_uid:
-                    del tasks_by_uid[uid]
-                if ((rel_type == 'PARENT' and args.hide_parents) or (rel_type == 'CHILD' and args.hide_children)) and \
-                   rel_uid in tasks_by_uid:
-                    del tasks_by_uid[rel_uid]
-        tasks = [x for x in tasks if x.instance.vtodo.uid.value in tasks_by_uid]
+        ## The server is asked to do as much of the filtering as
+        ## possible.  The filtering below is still needed, as the
+        ## semantics differs slightly, and not all servers support it.
+        ## Even with no filters given, a query for the pending tasks is
+        ## used rather than todos(), as it also gives the ETags.
+        alternatives = todo_filters(args, now, vtodo_txt_one + vtodo_txt_many) or pending_filters()
+        tasks = _todos_by_query(find_calendar(caldav_conn, args), alternatives, args, props)
+        if tasks is not None:
+            tasks = _task_records(_prefilter_tasks(tasks, args, now), tzinfo, props)
+            tasks = [x for x in tasks if x.is_pending()]
+            tasks.sort(key=lambda x: x.sort_key(now))
+        else:
+            ## TODO: current release of the caldav library doesn't support the multi-key sort_keys attribute.  The try-except construct should be removed at some point in the future, when caldav 0.5 is released.
+            try:
+                tasks = find_calendar(caldav_conn, args).todos(sort_keys=('isnt_overdue', 'hasnt_started', 'due', 'dtstart', 'priority'))
+            except:
+                tasks = find_calendar(caldav_conn, args).todos()
+            tasks = _task_records(tasks, tzinfo)
+    return tasks
+
+def _filter_tasks(tasks, args, now, stream=False):
+    """
+    The client side filtering of todo_select
+    """
+    ## The tasks from --nocaldav input or a vdir come as an iterator,
+    ## and are sorted here, after the filtering
+    unsorted = not isinstance(tasks, list)
+    if getattr(args, 'expand', None):
+        tasks = _expand_tasks(tasks, args, now)
+        unsorted = True
+    tasks = (x for x in tasks if _task_matches(x, args, now))
+    if stream and not (args.hide_parents or args.hide_children or args.descendants_of):
+        start = args.offset+args.offsetn
+        return itertools.islice(tasks, start, start+args.top+args.limit if args.top+args.limit else None)
+    tasks = list(tasks)
+    if unsorted:
+        tasks.sort(key=lambda x: x.sort_key(now))
+    if args.hide_parents or args.hide_children or args.descendants_of:
+        graph = TaskGraph(tasks)
+        if args.descendants_of:
+            descendants = graph.descendants(args.descendants_of)
+            tasks = [x for x in tasks if x.uid in descendants]
+        if args.hide_parents:
+            tasks = [x for x in tasks if not graph.has_children(x.uid)]
+        if args.hide_children:
+            tasks = [x for x in tasks if not graph.has_parents(x.uid)]
     if args.top+args.limit:
         tasks = tasks[args.offset+args.offsetn:args.top+args.limit+args.offset+args.offsetn]
     elif args.offset+args.offsetn:
         tasks = tasks[args.offset+args.offsetn:]
     return tasks
 
-def todo_edit(caldav_conn, args):
-    tasks = todo_select(caldav_conn, args)
+def _expand_tasks(tasks, args, now):
+    """
+    Yields the tasks, with each recurring task replaced by its pending
+    occurrences from its current start (which may be overdue) until
+    --expand days from now (if there are any)
+    """
+    from calendar_cli.recurrence import expand
+    tzinfo = _tz(args.timezone)
+    end = now + timedelta(args.expand)
     for task in tasks:
+        if not task.recurring:
+            yield task
+            continue
+        try:
+            comps = parse_calendar(task.task.data).components()
+        except ValueError:
+            comps = task.task.instance.components()
+        ## todo complete moves the start to the next occurrence, so an
+        ## occurrence before now is still pending
+        start = min(now, task.dtstart or task.due or now)
+        instances = [TaskRecord(task.task, tzinfo, x) for x in expand([x for x in comps if x.name == 'VTODO'], start, end, tzinfo)]
+        instances = [x for x in instances if x.is_pending()]
+        if instances:
+            yield from instances
+        else:
+            yield task
+
+def _task_matches(task, args, now):
+    """
+    The filters of _filter_tasks that look at one task at a time
+    """
+    for attr in vtodo_txt_one + vtodo_txt_many: ## TODO: now we have _exact_ match on items in the the array attributes, and substring match on items that cannot be duplicated.  Does that make sense?  Probably not.
+        if getattr(args, attr) and not (getattr(task, attr) and getattr(args, attr) in getattr(task, attr)):
+            return False
+        if getattr(args, 'no'+attr) and getattr(task, attr):
+            return False
+    if args.overdue and not (task.due and task.due < now):
+        return False
+    if args.hide_future and task.dtstart and task.dtstart > now:
+        return False
+    return True
+
+## The properties looked at by _prefilter_tasks
+_prefilter_props = ('UID', 'DTSTART', 'DUE', 'CATEGORIES', 'STATUS', 'COMPLETED', 'RRULE', 'RDATE')
+## The prefilters compare timestamps without looking at the time zone,
+## so they need this much slack
+_prefilter_slack = timedelta(1)
+
+def _prefilter_tasks(objects, args, now):
+    """
+    Yields the caldav objects that may be selected by todo_select,
+    judging from a cheap scan of the raw data for a few properties.
+    Objects are only left out if they certainly won't match, so the
+    rest still has to go through _filter_tasks.  This saves the
+    parsing of the tasks that are completed, in other categories, etc.
+    """
+    now = now.astimezone(timezone.utc).replace(tzinfo=None)
+    for obj in objects:
+        props = scan_properties(obj.data, 'VTODO', _prefilter_props)
+        if props is None or _task_may_match(props, args, now):
+            yield obj
+
+def _task_may_match(props, args, now):
+    """
+    The filters of _prefilter_tasks.  now is a naive UTC timestamp.
+    """
+    def first(name):
+        return props[name][0][1] if name in props else None
+    if args.todo_uid:
+        uid = first('UID')
+        return uid is None or uid.strip() == args.todo_uid.strip()
+    if 'COMPLETED' in props or first('STATUS') in ('COMPLETED', 'CANCELLED'):
+        return False
+    if args.categories:
+        categories = [x.strip() for (params, value) in props.get('CATEGORIES', []) for x in split_list(value)]
+        if not args.categories.strip() in categories:
+            return False
+    if getattr(args, 'expand', None) and ('RRULE' in props or 'RDATE' in props):
+        ## the occurrences are filtered on their own timestamps
+        return True
+    if args.overdue:
+        if first('DUE') is None:
+            return False
+        due = scan_time(first('DUE'))
+        if due is not None and due - _prefilter_slack >= now:
+            return False
+    if args.hide_future and first('DTSTART') is not None:
+        dtstart = scan_time(first('DTSTART'))
+        if dtstart is not None and dtstart - _prefilter_slack > now:
+            return False
+    return True
+
+def _todo_bulk(caldav_conn, args, func):
+    """
+    Calls func(task) for each task selected, with up to --jobs calls
+    running in parallel.  Tasks modified by others since they were
+    fetched are reported as conflicts and left untouched.  A summary is
+    written to stderr, and the exit code is 1 if anything failed.
+    """
+    from calendar_cli.bulk import run_concurrently, set_connection_pool_size, is_conflict, BulkReport
+    from calendar_cli.transport import concurrency_limit
+    tasks = todo_select(caldav_conn, args)
+    set_connection_pool_size(caldav_conn, args.jobs)
+    report = BulkReport()
+    try:
+        with phase('update'):
+            for (task, error) in run_concurrently(tasks, lambda x: func(x.task), args.jobs, concurrency_limit(caldav_conn, args.jobs)):
+                report.record(task.uid, 'ok' if error is None else 'conflict' if is_conflict(error) else 'failed', error)
+    finally:
+        report.close()
+    if report.failed():
+        sys.exit(1)
+
+def todo_edit(caldav_conn, args):
+    if args.nocaldav:
+        raise ValueError("No caldav connection, aborting")
+    if args.pdb:
+        args.jobs = 1
+    def edit(task):
         ## TODO: code duplication - can we refactor this?
         for attr in vtodo_txt_one:
             if getattr(args, 'set_'+attr):
@@ -565,9 +1317,10 @@ def todo_edit(caldav_conn, args):
             ## you may now access task.data to edit the raw ical, or
             ## task.instance.vtodo to edit a vobject instance
         task.save()
-
+    _todo_bulk(caldav_conn, args, edit)
 
 def todo_postpone(caldav_conn, args):
+    import dateutil.parser
     if args.nocaldav:
         raise ValueError("No caldav connection, aborting")
     rel_skew = None
@@ -581,8 +1334,7 @@ def todo_postpone(caldav_conn, args):
         if not new_ts.time():
             new_ts = _date(new_ts)
 
-    tasks = todo_select(caldav_conn, args)
-    for task in tasks:
+    def postpone(task):
         if new_ts:
             attr = 'due' if args.due else 'dtstart'
             if not hasattr(task.instance.vtodo, attr):
@@ -605,174 +1357,236 @@ def todo_postpone(caldav_conn, args):
                     if _force_datetime(task.instance.vtodo.dtstart.value, args) > _force_datetime(task.instance.vtodo.due.value, args):
                         task.instance.vtodo.due.value = task.instance.vtodo.dtstart.value
         task.save()
+    _todo_bulk(caldav_conn, args, postpone)
 
 def todo_list(caldav_conn, args):
-    if args.nocaldav and args.icalendar:
-        niy(feature="display a prettified tasklist based on stdin ical")
-    if args.nocaldav:
+    if args.nocaldav and not args.icalendar:
         raise ValueError("Todo-listing with --nocaldav only makes sense together with --icalendar")
-    tasks = todo_select(caldav_conn, args)
-    if args.icalendar:
-        for ical in tasks:
-            print(to_normal_str(ical.data))
+    tasks = todo_select(caldav_conn, args, _todo_list_props(args), args.no_sort)
+    with phase('render'):
+        print_todo_list(tasks, args)
+
+def todo_tree(caldav_conn, args):
+    """
+    Lists the tasks with the children indented below their parents
+    """
+    if args.nocaldav and not args.icalendar:
+        raise ValueError("Todo-listing with --nocaldav only makes sense together with --icalendar")
+    tasks = todo_select(caldav_conn, args, _todo_list_props(args))
+    rows = TaskGraph(tasks).walk()
+    with phase('render'):
+        if args.format == 'jsonl':
+            _write_jsonl(dict(_task_json(task), depth=depth) for (depth, task) in rows)
+        else:
+            _print_rows(Template(args.todo_template), _todo_getters(args), rows, args.indent)
+
+def print_todo_list(tasks, args):
+    if args.icalendar and not args.nocaldav:
+        for task in tasks:
+            print(to_normal_str(task.task.data))
     elif args.list_categories:
         categories = set()
         for task in tasks:
-            if hasattr(task.instance.vtodo, 'categories'):
-                categories.update(task.instance.vtodo.categories.value)
+            categories.update(task.categories)
         for c in categories:
             print(c)
+    elif args.format == 'jsonl':
+        _write_jsonl(_task_json(x) for x in tasks)
     else:
-        for task in tasks:
-            t = {'instance': task}
-            t['dtstart'] = task.instance.vtodo.dtstart.value if hasattr(task.instance.vtodo,'dtstart') else date.today()
-            t['dtstart_passed_mark'] = '!' if _force_datetime(t['dtstart'], args) <= _now() else ' '
-            t['due'] = task.instance.vtodo.due.value if hasattr(task.instance.vtodo,'due') else date.today()+timedelta(args.default_due)
-            t['due_passed_mark'] = '!' if _force_datetime(t['due'], args) < _now() else ' '
-            for timeattr in ('dtstart', 'due'):
-                t[timeattr] = t[timeattr].strftime(args.timestamp_format)
-            for summary_attr in ('summary', 'location', 'description', 'url', 'uid'):
-                if hasattr(task.instance.vtodo, summary_attr):
-                    t['summary'] = getattr(task.instance.vtodo, summary_attr).value
-                    t['summary'] = to_normal_str(t['summary'])
-                    break
-            for attr in ('location', 'description', 'url'):
-                if hasattr(task.instance.vtodo, attr):
-                    t[attr] = getattr(task.instance.vtodo, attr).value
-                else:
-                    t[attr] = ""
-                t[attr] = to_normal_str(t[attr])
-            t['uid'] = task.instance.vtodo.uid.value
-            print(args.todo_template.format(**t))
+        _print_rows(Template(args.todo_template), _todo_getters(args), tasks)
+
+def _task_json(task):
+    """
+    The --format jsonl record for a TaskRecord
+    """
+    record = {
+        'type': 'todo',
+        'uid': task.uid,
+        'summary': task.summary,
+        'dtstart': _json_value(task.dtstart_value),
+        'due': _json_value(task.due_value),
+        'priority': task.priority,
+        'status': task.status,
+        'completed': task.completed,
+        'categories': list(task.categories),
+        'related_to': [{'reltype': reltype, 'uid': uid} for (reltype, uid) in task.related_to],
+    }
+    for attr in text_attributes:
+        value = getattr(task, attr)
+        if value is not None:
+            record[attr] = _json_value(value)
+    return record
+
+def _todo_getters(args):
+    """
+    Returns the getters for the todo template fields, for _print_rows
+    """
+    now = _now()
+    tzinfo = _tz(args.timezone)
+    today = date.today()
+    default_due = today+timedelta(args.default_due)
+    default_due_passed = to_utc(default_due, tzinfo) < now
+    def summary(task):
+        for summary_attr in ('summary', 'location', 'description', 'url', 'uid'):
+            if getattr(task, summary_attr):
+                return to_normal_str(getattr(task, summary_attr))
+        return ""
+    def text(attr):
+        return lambda x: to_normal_str(getattr(x, attr) or "")
+    getters = {
+        'instance': lambda x: x.task,
+        'dtstart': lambda x: (x.dtstart_value if x.dtstart_value is not None else today).strftime(args.timestamp_format),
+        'dtstart_passed_mark': lambda x: '!' if not x.dtstart or x.dtstart <= now else ' ',
+        'due': lambda x: (x.due_value if x.due_value is not None else default_due).strftime(args.timestamp_format),
+        'due_passed_mark': lambda x: '!' if (x.due < now if x.due else default_due_passed) else ' ',
+        'summary': summary,
+        'location': text('location'),
+        'description': text('description'),
+        'url': text('url'),
+        'uid': lambda x: x.uid,
+    }
+    return getters
 
 def todo_complete(caldav_conn, args):
     if args.nocaldav:
         raise ValueError("No caldav connection, aborting")
-    tasks = todo_select(caldav_conn, args)
-    for task in tasks:
-        if hasattr(task.instance.vtodo, 'rrule'):
-            rrule = rrulestr(task.instance.vtodo.rrule.value)
-            try:
-                next = rrule.after(datetime.now())
-            except TypeError: ## pesky problem with comparition of timestamps with and without tzinfo
-                next = rrule.after(datetime.now(tz=tzlocal.get_localzone()))
-            if next:
-                ## new_task is to be completed and we keep the original task open
-                completed_task = task.copy()
-                remaining_task = task
-
-                ## the remaining task should have recurrence id set to next start time, and range THISANDFUTURE
-                if hasattr(remaining_task.instance.vtodo, 'recurrence_id'):
-                    del remaining_task.instance.vtodo.recurrence_id
-                remaining_task.instance.vtodo.add('recurrence-id')
-                remaining_task.instance.vtodo.dtstart.value = next ## TODO: should be same type as dtstart (date or datetime)
-                remaining_task.instance.vtodo.recurrence_id.params['RANGE'] = [ 'THISANDFUTURE' ]
-                remaining_task.instance.vtodo.rrule
-                count_search = re.search('COUNT=(\d+)', completed_task.instance.vtodo.rrule.value)
-                if count_search:
-                    remaining_task.instance.vtodo.rrule.value = re.replace('COUNT=(\d+)', 'COUNT=%d' % int(count_search.group(1))-1)
+    tzinfo = _tz(args.timezone)
+    _todo_bulk(caldav_conn, args, lambda task: _complete_task(task, tzinfo, _now()))
+
+def _complete_task(task, tzinfo, now):
+    """
+    Marks the task as completed.  A recurring task with occurrences left
+    is split in two: a completed, non-recurring copy, and the task
+    itself moved on to the next occurrence.
+    """
+    from calendar_cli.recurrence import aware, next_occurrence
+    vtodo = task.instance.vtodo
+    if hasattr(vtodo, 'rrule'):
+        ## a task already moved into the future is moved on from there.
+        ## The compiled rule is cached, so tasks sharing a rule don't
+        ## have it parsed again.
+        after = now
+        if hasattr(vtodo, 'dtstart'):
+            after = max(after, aware(vtodo.dtstart.value, tzinfo))
+        next = next_occurrence(vtodo, after, tzinfo)
+        if next:
+            ## new_task is to be completed and we keep the original task open
+            completed_task = task.copy()
+            remaining_task = task
+
+            ## the remaining task should have recurrence id set to next start time, and range THISANDFUTURE
+            if hasattr(vtodo, 'recurrence_id'):
+                del vtodo.recurrence_id
+            vtodo.add('recurrence-id').value = next
+            vtodo.recurrence_id.params['RANGE'] = [ 'THISANDFUTURE' ]
+            if hasattr(vtodo, 'dtstart'):
+                ## the due timestamp moves along with the start
+                if hasattr(vtodo, 'due') and isinstance(vtodo.due.value, datetime) == isinstance(next, datetime):
+                    vtodo.due.value += next - vtodo.dtstart.value
+                vtodo.dtstart.value = next
+            elif hasattr(vtodo, 'due'):
+                ## the recurrences are counted from the due timestamp
+                vtodo.due.value = next
+            count_search = re.search(r'COUNT=(\d+)', vtodo.rrule.value)
+            if count_search:
+                vtodo.rrule.value = re.sub(r'COUNT=\d+', 'COUNT=%d' % (int(count_search.group(1))-1), vtodo.rrule.value)
+            ## it replaces the whole object; newer caldav versions would
+            ## otherwise merge it into the object as an override
+            if _accepts_keyword(remaining_task.save, 'only_this_recurrence'):
+                remaining_task.save(only_this_recurrence=False)
+            else:
                 remaining_task.save()
 
-                ## the completed task should have recurrence id set to current time
-                ## count in rrule should decrease
-                completed_task.instance.vtodo.remove(completed_task.instance.vtodo.rrule)
-                if hasattr(completed_task.instance.vtodo, 'recurrence_id'):
-                    del completed_task.instance.vtodo.recurrence_id
-                completed_task.instance.vtodo.add('recurrence-id')
-                completed_task.instance.vtodo.recurrence_id.value = datetime.now()
-                completed_task.instance.vtodo.dtstart.value = datetime.now()
-                completed_task.complete()
+            ## the completed task is a separate, non-recurring object
+            ## (with a new UID - a RECURRENCE-ID would make the caldav
+            ## library look for a parent that doesn't exist)
+            completed_vtodo = completed_task.instance.vtodo
+            completed_vtodo.remove(completed_vtodo.rrule)
+            if hasattr(completed_vtodo, 'recurrence_id'):
+                del completed_vtodo.recurrence_id
+            if hasattr(completed_vtodo, 'dtstart'):
+                completed_vtodo.dtstart.value = datetime.now()
+            completed_task.complete()
+            return
+    task.complete()
 
-                continue
-        task.complete()
+def _accepts_keyword(func, name):
+    """
+    Checks if func takes the named parameter (older caldav versions
+    lack some of them)
+    """
+    import inspect
+    try:
+        return name in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
 
 
 def todo_delete(caldav_conn, args):
     if args.nocaldav:
         raise ValueError("No caldav connection, aborting")
-    tasks = todo_select(caldav_conn, args)
-    for task in tasks:
-        task.delete()
+    from calendar_cli.bulk import conditional_delete
+    _todo_bulk(caldav_conn, args, (lambda x: x.delete()) if args.vdir else conditional_delete)
 
-def main():
+def search(caldav_conn, args):
     """
-    the main function does (almost) nothing but parsing command line parameters
+    Full text search through the local search index, which is first
+    brought up to date with the sync cache or the vdir
     """
-    #    sys.stderr.write("""
-    #The calendar-cli command is slowly being deprecated in favor of plann
-    #Check https://github.com/tobixen/calendar-cli/issues/88
-    #""")
-
-    ## This boilerplate pattern is from
-    ## http://stackoverflow.com/questions/3609852
-    ## We want defaults for the command line options to be fetched from the config file
-
-    # Parse any conf_file specification
-    # We make this parser with add_help=False so that
-    # it doesn't parse -h and print help.
-    conf_parser = argparse.ArgumentParser(
-        prog=metadata["product"],
-        description=__doc__, # printed with -h/--help
-        # Don't mess with format of description
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        # Turn off help, so we print all options in response to -h
-        add_help=False
-        )
-    conf_parser.add_argument("--config-file",
-                             help="Specify config file", metavar="FILE", default=os.getenv('XDG_CONFIG_HOME', os.getenv('HOME', '~') + '/.config')+'/calendar.conf')
-    conf_parser.add_argument("--config-section",
-                             help="Specify config section; allows several caldav servers to be configured in the same config file",  default='default')
-    conf_parser.add_argument("--interactive-config",
-                             help="Interactively ask for configuration", action="store_true")
-    args, remaining_argv = conf_parser.parse_known_args()
-    conf_parser.add_argument("--version", action='version', version='%%(prog)s %s' % metadata["version"])
-
-    config = read_config(args.config_file)
-
-    if args.interactive_config:
-        defaults = interactive_config(args, config, remaining_argv)
-        if not remaining_argv:
-            return
-    else:
-        defaults = config_section(config, args.config_section)
-        if not 'ssl_verify_cert' in defaults:
-            defaults['ssl_verify_cert'] = 'yes'
-        if not 'language' in defaults:
-            ## TODO: shouldn't this be lower case?
-            defaults['language'] = 'EN'
-
-    # Parse rest of arguments
-    # Don't suppress add_help here so it will handle -h
-    parser = argparse.ArgumentParser(
-        description=__doc__,
-        prog=metadata["product"],
-        # Inherit options from config_parser
-        parents=[conf_parser]
-        )
-    parser.set_defaults(**defaults)
-
-    ## Global options
-    parser.add_argument("--nocaldav", help="Do not connect to CalDAV server, but read/write icalendar format from stdin/stdout", action="store_true")
-    parser.add_argument("--icalendar", help="Read/write icalendar format from stdin/stdout", action="store_true")
-    parser.add_argument("--timezone", help="Timezone to use")
-    parser.add_argument('--language', help="language used")
-    parser.add_argument("--caldav-url", help="Full URL to the caldav server", metavar="URL")
-    parser.add_argument("--caldav-user", help="username to log into the caldav server", metavar="USER")
-    parser.add_argument("--caldav-pass", help="password to log into the caldav server", metavar="PASS")
-    parser.add_argument("--caldav-proxy", help="HTTP proxy server to use (if any)")
-    parser.add_argument("--file-pass", help="Absolute path to file containing the password")
-    parser.add_argument("--ssl-verify-cert", help="verification of the SSL cert - 'yes' to use the OS-provided CA-bundle, 'no' to trust any cert and the path to a CA-bundle")
-    parser.add_argument("--debug-logging", help="turn on debug logging", action="store_true")
-    parser.add_argument("--calendar-url", help="URL for calendar to be used (may be absolute or relative to caldav URL, or just the name of the calendar)")
-    parser.add_argument("--ignoremethod", help="Ignores METHOD property if exists in the request. This violates RFC4791 but is sometimes appended by some calendar servers", action="store_true")
-    parser.set_defaults(print_help=parser.print_help)
-
-    ## TODO: check sys.argv[0] to find command
-    ## TODO: set up logging
-    subparsers = parser.add_subparsers(title='command')
-
-    ## Tasks
-    todo_parser = subparsers.add_parser('todo')
+    import hashlib
+    from calendar_cli.search import SearchIndex
+    if args.nocaldav:
+        raise ValueError("Searching needs a caldav server or a vdir")
+    cal = find_calendar(caldav_conn, args)
+    index = SearchIndex(args.cache_dir or default_cache_dir(), args.config_section, str(cal.url))
+    try:
+        if not args.no_update:
+            with phase('fetch'):
+                if args.vdir:
+                    versions = cal.versions()
+                    def load(names):
+                        for name in names:
+                            obj = cal.read(name)
+                            if obj is not None:
+                                yield (name, obj.data)
+                else:
+                    (cal, cache) = _synced_cache(caldav_conn, args)
+                    versions = {href: x['etag'] or hashlib.sha1(x['data'].encode('utf-8')).hexdigest() for (href, x) in cache.objects.items()}
+                    load = lambda hrefs: ((x, cache.objects[x]['data']) for x in hrefs)
+            with phase('parse'):
+                index.update(versions, load)
+        with phase('filter'):
+            components = ['V' + x.upper() for x in args.type] if args.type else None
+            rows = index.search(' '.join(args.query), components, args.limit)
+    finally:
+        index.close()
+
+    def timestamp(attr):
+        def get(row):
+            if not row[attr]:
+                return '-'
+            value = datetime.fromisoformat(row[attr])
+            if isinstance(value, datetime) and value.tzinfo is not None:
+                value = value.astimezone(_tz(args.timezone))
+            return value.strftime(args.timestamp_format)
+        return get
+    getters = {x: (lambda attr: lambda row: row[attr] or '-')(x) for x in ('summary', 'description', 'location', 'categories', 'uid', 'href', 'rank')}
+    getters['type'] = lambda row: row['component'][1:].lower()
+    getters['dtstart'] = timestamp('dtstart')
+    getters['due'] = timestamp('due')
+    with phase('render'):
+        _print_rows(Template(args.search_template), getters, rows)
+
+def _build_search_parser(search_parser):
+    search_parser.add_argument('query', nargs='+', help="Words to search for.  Supports prefix matching (meet*), phrases (\"project plan\"), AND/OR/NOT and field scoped queries (summary:meeting, categories:work)")
+    search_parser.add_argument('--type', help="Only search for this kind of objects (may be given several times)", choices=('event', 'todo', 'journal'), action='append')
+    search_parser.add_argument('--limit', help="Maximum number of results (default: 20, 0 for no limit)", type=int, default=20)
+    search_parser.add_argument('--no-update', help="Search the local index without checking the calendar for changes first", action='store_true')
+    search_parser.add_argument('--search-template', help="Template for printing out the results", default="{type:7} {dtstart} {summary}")
+    search_parser.add_argument('--timestamp-format', help="strftime-style format string for the output timestamps", default="%Y-%m-%d %H:%M")
+    search_parser.set_defaults(func=search)
+
+def _build_todo_parser(todo_parser):
     todo_parser.add_argument('--top', '-1', action='count', default=0)
     todo_parser.add_argument('--offset', action='count', default=0)
     todo_parser.add_argument('--offsetn', type=int, default=0)
@@ -780,6 +1594,7 @@ def main():
     todo_parser.add_argument('--todo-uid')
     todo_parser.add_argument('--hide-parents', help='Hide the parent if you need to work on children tasks first (parent task depends on children tasks to be done first)', action='store_true')
     todo_parser.add_argument('--hide-children', help='Hide the parent if you need to work on children tasks first (parent task depends on children tasks to be done first)', action='store_true')
+    todo_parser.add_argument('--descendants-of', help='Only select the tasks below the task with the given uid (children, grandchildren, etc)', metavar='UID')
     todo_parser.add_argument('--overdue', help='Only show overdue tasks', action='store_true')
     todo_parser.add_argument('--hide-future', help='Hide events with future dtstart', action='store_true')
 
@@ -817,8 +1632,18 @@ def main():
     todo_list_parser.add_argument('--default-due', help="If a task has no due date set, list it with the due date set N days from today", type=int, default=14)
     todo_list_parser.add_argument('--list-categories', help="Instead of listing the todo-items, list the unique categories used", action='store_true')
     todo_list_parser.add_argument('--timestamp-format', help="strftime-style format string for the output timestamps", default="%Y-%m-%d (%a)")
+    todo_list_parser.add_argument('--expand', help="List recurring tasks once for each occurrence within the next N days (default: 30) rather than once", type=int, nargs='?', const=30, metavar='N')
+    _add_format_arguments(todo_list_parser)
     todo_list_parser.set_defaults(func=todo_list)
 
+    todo_tree_parser = todo_subparsers.add_parser('tree')
+    todo_tree_parser.add_argument('--todo-template', help="Template for printing out the event", default="{dtstart}{dtstart_passed_mark} {due}{due_passed_mark} {summary}")
+    todo_tree_parser.add_argument('--default-due', help="If a task has no due date set, list it with the due date set N days from today", type=int, default=14)
+    todo_tree_parser.add_argument('--timestamp-format', help="strftime-style format string for the output timestamps", default="%Y-%m-%d (%a)")
+    todo_tree_parser.add_argument('--indent', help="String used for indenting child tasks, once per level", default="    ")
+    todo_tree_parser.add_argument('--format', help="Output format: text (through --todo-template) or jsonl (one json object per task, with a depth field)", choices=('text', 'jsonl'), default='text')
+    todo_tree_parser.set_defaults(func=todo_tree, list_categories=False)
+
     todo_edit_parser = todo_subparsers.add_parser('edit')
     for attr in vtodo_txt_one + vtodo_txt_many:
         todo_edit_parser.add_argument('--set-'+attr, help="Set "+attr)
@@ -826,27 +1651,55 @@ def main():
         todo_edit_parser.add_argument('--add-'+attr, help="Add an "+attr)
     todo_edit_parser.add_argument('--pdb', help='Allow interactive edit through the python debugger', action='store_true')
     todo_edit_parser.set_defaults(func=todo_edit)
+    _add_jobs_argument(todo_edit_parser)
 
     todo_postpone_parser = todo_subparsers.add_parser('postpone')
     todo_postpone_parser.add_argument('until', help="either a new date or +interval to add some interval to the existing time, or i.e. 'in 3d' to set the time to a new time relative to the current time.  interval is a number postfixed with a one character unit (any of smhdwy).  If the todo-item has a dtstart, this field will be modified, else the due timestamp will be modified.    If both timestamps exists and dstart will be moved beyond the due time, the due time will be set to dtime.")
     todo_postpone_parser.add_argument('--due', help="move the due, not the dtstart", action='store_true')
     todo_postpone_parser.set_defaults(func=todo_postpone)
+    _add_jobs_argument(todo_postpone_parser)
 
     todo_complete_parser = todo_subparsers.add_parser('complete')
     todo_complete_parser.set_defaults(func=todo_complete)
+    _add_jobs_argument(todo_complete_parser)
 
     todo_delete_parser = todo_subparsers.add_parser('delete')
     todo_delete_parser.set_defaults(func=todo_delete)
+    _add_jobs_argument(todo_delete_parser)
+
+def _add_format_arguments(parser):
+    parser.add_argument('--format', help="Output format: text (through the template) or jsonl (one json object per line, with ISO 8601 timestamps)", choices=('text', 'jsonl'), default='text')
+    parser.add_argument('--no-sort', help="Print out the results in the order they are read rather than sorted.  With --nocaldav or a vdir, the output starts before everything is read", action='store_true')
+
+def _add_jobs_argument(parser):
+    parser.add_argument('--jobs', help="Number of tasks to update in parallel", type=_positive_int, default=1)
 
-    ## journal
-    journal_parser = subparsers.add_parser('journal')
+def _positive_int(value):
+    """
+    argparse type for counts that must be at least 1
+    """
+    return _int_at_least(value, 1)
+
+def _non_negative_int(value):
+    return _int_at_least(value, 0)
+
+def _int_at_least(value, minimum):
+    try:
+        ret = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: %r" % value)
+    if ret < minimum:
+        raise argparse.ArgumentTypeError("must be at least %i, got %i" % (minimum, ret))
+    return ret
+
+def _build_journal_parser(journal_parser):
     journal_parser.set_defaults(print_help=journal_parser.print_help)
     journal_subparsers = journal_parser.add_subparsers(title='journal subcommand')
     journal_add_parser = journal_subparsers.add_parser('add')
     journal_add_parser.add_argument('summaryline', nargs='+')
     journal_add_parser.set_defaults(func=journal_add)
 
-    calendar_parser = subparsers.add_parser('calendar')
+def _build_calendar_parser(calendar_parser):
     calendar_parser.set_defaults(print_help=calendar_parser.print_help)
     calendar_subparsers = calendar_parser.add_subparsers(title='cal subcommand')
 
@@ -866,6 +1719,8 @@ def main():
 
     calendar_addics_parser = calendar_subparsers.add_parser('addics')
     calendar_addics_parser.add_argument('--file', help="ICS file to upload", default='-')
+    calendar_addics_parser.add_argument('--jobs', help="Number of objects to upload in parallel", type=_positive_int, default=1)
+    calendar_addics_parser.add_argument('--progress-file', help="Log the outcome for each UID to this file.  UIDs logged as successfully uploaded will be skipped, so a failed import can be resumed by running the same command again", metavar="FILE")
     calendar_addics_parser.set_defaults(func=calendar_addics)
 
     calendar_agenda_parser = calendar_subparsers.add_parser('agenda')
@@ -875,6 +1730,10 @@ def main():
     calendar_agenda_parser.add_argument('--agenda-days', help="Fetch calendar for so many days", type=int, default=7)
     calendar_agenda_parser.add_argument('--event-template', help="Template for printing out the event. Defaults to '{dtstart} {summary}'", default="{dtstart} {summary}")
     calendar_agenda_parser.add_argument('--timestamp-format', help="strftime-style format string for the output timestamps", default="%Y-%m-%d %H:%M (%a)")
+    calendar_agenda_parser.add_argument('--window-days', help="Split intervals longer than this many days into windows (of growing length), fetched separately from the server, so the start of the agenda can be printed before the rest has arrived.  0 to always fetch the whole interval at once (default: 31)", type=_non_negative_int, default=31)
+    calendar_agenda_parser.add_argument('--jobs', help="Number of windows to fetch in parallel", type=_positive_int, default=4)
+    calendar_agenda_parser.add_argument('--local-expansion', help="Expand recurring events locally rather than asking the server to do it, for servers not supporting it (or doing it wrong)", action='store_true')
+    _add_format_arguments(calendar_agenda_parser)
     calendar_agenda_parser.set_defaults(func=calendar_agenda)
 
     calendar_delete_parser = calendar_subparsers.add_parser('delete')
@@ -882,19 +1741,245 @@ def main():
     calendar_delete_parser.add_argument('--event-url')
     calendar_delete_parser.set_defaults(func=calendar_delete)
 
-    args = parser.parse_args(remaining_argv)
+_command_builders = {
+    'todo': _build_todo_parser,
+    'journal': _build_journal_parser,
+    'calendar': _build_calendar_parser,
+    'search': _build_search_parser,
+}
+
+def parse_args(parser, argv):
+    """
+    Like parser.parse_args(argv), but only the parser for the command
+    given is built.  The command is found through a first pass, where
+    all the options to the command are left unparsed.
+    """
+    (args, _) = parser.parse_known_args(argv)
+    command = getattr(args, 'command', None)
+    command_parser = parser.command_parsers.get(command)
+    if command_parser is not None and not command in parser.built_commands:
+        command_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
+        _command_builders[command](command_parser)
+        parser.built_commands.add(command)
+    return parser.parse_args(argv)
+
+def main():
+    """
+    the main function does (almost) nothing but parsing command line parameters
+    """
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    #    sys.stderr.write("""
+    #The calendar-cli command is slowly being deprecated in favor of plann
+    #Check https://github.com/tobixen/calendar-cli/issues/88
+    #""")
+
+    ## This boilerplate pattern is from
+    ## http://stackoverflow.com/questions/3609852
+    ## We want defaults for the command line options to be fetched from the config file
+
+    # Parse any conf_file specification
+    # We make this parser with add_help=False so that
+    # it doesn't parse -h and print help.
+    conf_parser = argparse.ArgumentParser(
+        prog=metadata["product"],
+        description=__doc__, # printed with -h/--help
+        # Don't mess with format of description
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        # Turn off help, so we print all options in response to -h
+        add_help=False
+        )
+    conf_parser.add_argument("--config-file",
+                             help="Specify config file", metavar="FILE", default=os.getenv('XDG_CONFIG_HOME', os.getenv('HOME', '~') + '/.config')+'/calendar.conf')
+    conf_parser.add_argument("--config-section",
+                             help="Specify config section; allows several caldav servers to be configured in the same config file",  default='default')
+    conf_parser.add_argument("--interactive-config",
+                             help="Interactively ask for configuration", action="store_true")
+    args, remaining_argv = conf_parser.parse_known_args()
+    conf_parser.add_argument("--version", action='version', version='%%(prog)s %s' % metadata["version"])
+
+    config = read_config(args.config_file)
+
+    if args.interactive_config:
+        defaults = interactive_config(args, config, remaining_argv)
+        if not remaining_argv:
+            return
+    else:
+        defaults = _section_defaults(config, args.config_section)
+
+    # Parse rest of arguments
+    # Don't suppress add_help here so it will handle -h
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        prog=metadata["product"],
+        # Inherit options from config_parser
+        parents=[conf_parser]
+        )
+    parser.set_defaults(**defaults)
+    parser.set_defaults(config_section=args.config_section)
+    sections = _config_sections(config, args.config_section)
+
+    ## Global options
+    parser.add_argument("--nocaldav", help="Do not connect to CalDAV server, but read/write icalendar format from stdin/stdout", action="store_true")
+    parser.add_argument("--icalendar", help="Read/write icalendar format from stdin/stdout", action="store_true")
+    parser.add_argument("--icalendar-file", help="With --nocaldav --icalendar, read the icalendar data for calendar agenda and todo list from FILE rather than stdin", metavar="FILE", default='-')
+    parser.add_argument("--timezone", help="Timezone to use")
+    parser.add_argument('--language', help="language used")
+    parser.add_argument("--caldav-url", help="Full URL to the caldav server", metavar="URL")
+    parser.add_argument("--caldav-user", help="username to log into the caldav server", metavar="USER")
+    parser.add_argument("--caldav-pass", help="password to log into the caldav server", metavar="PASS")
+    parser.add_argument("--caldav-proxy", help="HTTP proxy server to use (if any)")
+    parser.add_argument("--file-pass", help="Absolute path to file containing the password")
+    parser.add_argument("--ssl-verify-cert", help="verification of the SSL cert - 'yes' to use the OS-provided CA-bundle, 'no' to trust any cert and the path to a CA-bundle")
+    parser.add_argument("--debug-logging", help="turn on debug logging", action="store_true")
+    parser.add_argument("--retries", help="Number of times to retry a request failing with a connection error or a 408, 429, 502, 503 or 504 status (default: 3)", type=int, default=3)
+    parser.add_argument("--retry-backoff", help="Seconds to wait before the first retry, doubled for each following retry, with jitter.  A Retry-After header from the server takes precedence (default: 0.5)", type=float, default=0.5)
+    parser.add_argument("--calendar-url", help="URL for calendar to be used (may be absolute or relative to caldav URL, or just the name of the calendar)")
+    parser.add_argument("--ignoremethod", help="Ignores METHOD property if exists in the request. This violates RFC4791 but is sometimes appended by some calendar servers", action="store_true")
+    parser.add_argument("--vdir", help="Use the vdir (a directory with one .ics file per calendar object, as synchronized by vdirsyncer) at DIR rather than a caldav server.  Typically set per config section", metavar="DIR")
+    parser.add_argument("--sync-cache", help="Keep a local cache of the calendar, revalidated through ctag/sync-token, so only changed objects are downloaded by todo and agenda commands", action="store_true")
+    parser.add_argument("--cache-dir", help="Directory for the local cache (defaults to $XDG_CACHE_HOME/calendar-cli)")
+    parser.add_argument("--discovery-ttl", help="Cache the principal and calendar discovery results for this many seconds (default: 0, no caching)", type=int, default=0)
+    parser.add_argument("--refresh-discovery", help="Refresh the cached principal and calendar discovery results", action="store_true")
+    parser.add_argument("--batch", help="Read commands from FILE (or stdin if FILE is -), one command line per line, and run them all over the same connection", metavar="FILE")
+    parser.add_argument("--batch-status", help="Where to write the json status lines in batch mode (default: stderr)", metavar="FILE", default='-')
+    parser.add_argument("--profile", help="Report the time spent in each phase (config, connect, discovery, fetch, parse, filter, render, update) and statistics for the HTTP requests as json", action="store_true")
+    parser.add_argument("--profile-file", help="Where to write the --profile report (default: stderr)", metavar="FILE", default='-')
+    parser.set_defaults(print_help=parser.print_help)
 
+    ## TODO: check sys.argv[0] to find command
+    ## TODO: set up logging
+    subparsers = parser.add_subparsers(title='command', dest='command')
+    ## The options for each command are added by parse_args when needed
+    parser.command_parsers = {}
+    parser.built_commands = set()
+    for command in _command_builders:
+        parser.command_parsers[command] = subparsers.add_parser(command, add_help=False)
+
+    args = parse_args(parser, remaining_argv)
+    if args.profile:
+        prof = profile.start(wall_start, cpu_start)
+        prof.add_phase('config', time.perf_counter() - wall_start, time.process_time() - cpu_start)
+        try:
+            return _main(parser, remaining_argv, config, sections, args)
+        finally:
+            prof.write(args.profile_file)
+    return _main(parser, remaining_argv, config, sections, args)
+
+def _main(parser, remaining_argv, config, sections, args):
+    """
+    Runs the command line parsed by main
+    """
     if args.debug_logging:
+        import caldav
         ## TODO: set up more proper logging in a more proper way
         logging.getLogger().setLevel(logging.DEBUG)
         caldav.log.setLevel(logging.DEBUG)
         caldav.log.addHandler(logging.StreamHandler())
 
+    if args.batch:
+        return run_batch(parser, remaining_argv, args)
+    if sections != [args.config_section]:
+        return run_sections(parser, remaining_argv, config, sections, args)
+    return run_command(args)
+
+def _section_defaults(config, section):
+    defaults = config_section(config, section)
+    if not 'ssl_verify_cert' in defaults:
+        defaults['ssl_verify_cert'] = 'yes'
+    if not 'language' in defaults:
+        ## TODO: shouldn't this be lower case?
+        defaults['language'] = 'EN'
+    return defaults
+
+def _config_sections(config, section):
+    """
+    Returns the list of config sections to use.  This is normally just
+    the section given, but it may also be a glob pattern or a "meta"
+    section containing other sections.
+    """
+    if section in config and not 'contains' in config[section]:
+        return [section]
+    if not section in config and set(section).isdisjoint(set('[*?')):
+        return [section]
+    return sorted(x for x in expand_config_section(config, section) if not 'contains' in config.get(x, {}))
+
+def run_sections(parser, argv, config, sections, args):
+    """
+    Runs calendar agenda or todo list towards several config sections
+    in parallel, and prints out the merged results.  The results from
+    each section are sorted already, so they are merged with a k-way
+    merge.
+    """
+    import concurrent.futures
+    ## The options given on the command line takes precedence over
+    ## the config from each section, so the command line has to be
+    ## parsed once for each section
+    keys = set()
+    for section in sections:
+        keys.update(_section_defaults(config, section))
+    base_defaults = {x: parser.get_default(x) for x in keys}
+    section_args = []
+    for section in sections:
+        parser.set_defaults(**base_defaults)
+        parser.set_defaults(**_section_defaults(config, section))
+        parser.set_defaults(config_section=section)
+        section_args.append(parse_args(parser, argv))
+
+    func = getattr(args, 'func', None)
+    if len(section_args) == 1:
+        return run_command(section_args[0])
+    if not func in (calendar_agenda, todo_list):
+        raise ValueError("Only calendar agenda and todo list can be run towards several config sections at once")
+
+    if func == calendar_agenda:
+        fetch = _agenda_events
+        sort_key = lambda x: x['dtstart']
+    else:
+        ## --limit and --offset are applied after merging
+        for a in section_args:
+            a.top = a.limit = a.offset = a.offsetn = 0
+        now = _now()
+        def fetch(caldav_conn, a):
+            return sorted(todo_select(caldav_conn, a, _todo_list_props(a)), key=lambda x: x.sort_key(now))
+        sort_key = lambda x: x.sort_key(now)
+
+    results = []
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(sections)) as executor:
+        futures = [executor.submit(run_command, a, func=fetch) for a in section_args]
+        for (section, future) in zip(sections, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.debug("config section %s failed" % section, exc_info=True)
+                sys.stderr.write("config section %s: %s: %s\n" % (section, e.__class__.__name__, e))
+                failed = True
+
+    merged = heapq.merge(*results, key=sort_key)
+    with phase('render'):
+        if func == calendar_agenda:
+            print_agenda(merged, args)
+        else:
+            start = args.offset+args.offsetn
+            stop = start+args.top+args.limit if args.top+args.limit else None
+            print_todo_list(list(itertools.islice(merged, start, stop)), args)
+    if failed:
+        sys.exit(1)
+
+def run_command(args, connections=None, func=None):
+    """
+    Connects to the caldav server and runs the command given in args
+    (or func, if given).  If a connections dict is given, connections
+    are reused between calls
+    """
+    import caldav.lib.error
+    import urllib3
     if args.file_pass:
         with open(args.file_pass, 'r') as f:
             args.caldav_pass = f.read().strip()
 
-    if not args.nocaldav:
+    if not args.nocaldav and not args.vdir:
         if not args.calendar_url and not args.caldav_url:
             sys.stderr.write("missing mandatory arguments ... either "
                               "calendar_url or caldav_url needs to be set\n"
@@ -903,7 +1988,15 @@ def main():
                               "create a config file\n"
                               )
             sys.exit(1)
-        caldav_conn = caldav_connect(args)
+        with phase('connect'):
+            if connections is None:
+                caldav_conn = caldav_connect(args)
+            else:
+                conn_key = (args.caldav_url, args.caldav_user, args.caldav_pass, args.caldav_proxy, args.ssl_verify_cert)
+                if not conn_key in connections:
+                    connections[conn_key] = caldav_connect(args)
+                caldav_conn = connections[conn_key]
+        profile.instrument(caldav_conn)
     else:
 
         caldav_conn = None
@@ -911,8 +2004,20 @@ def main():
     if args.ssl_verify_cert == 'no':
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    if hasattr(args, 'func'):
-        return args.func(caldav_conn, args)
+    func = func or getattr(args, 'func', None)
+    if func:
+        try:
+            return func(caldav_conn, args)
+        except caldav.lib.error.NotFoundError:
+            if not _stale_discovery(caldav_conn, args):
+                raise
+            if not args.calendar_url:
+                ## running the command again would silently pick
+                ## whatever calendar is found first
+                raise caldav.lib.error.NotFoundError(
+                    "the calendar found through the discovery cache has disappeared from the server - "
+                    "give --calendar-url to choose another one")
+            return func(caldav_conn, args)
     else:
         ## We get here if a subcommand is not given - in that case we should print a friendly
         ## help message.  With python2 this goes automatically, with python3 we get here.
@@ -920,5 +2025,50 @@ def main():
         ## in python3.  However, setting required=True gave a traceback rather than a friendly error message.
         args.print_help()
 
+def run_batch(parser, argv, args):
+    """
+    Reads one command line per line from the batch file and runs them
+    all in the same process, sharing the caldav connections and the
+    resolved calendars.  The global options given on the real command
+    line are prepended to each line.  The exit status of each line is
+    reported as a json object per line.
+    """
+    connections = {}
+    failures = 0
+    batch_file = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+    status_file = sys.stderr if args.batch_status == '-' else open(args.batch_status, 'w')
+    try:
+        for (lineno, line) in enumerate(batch_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            ## argv stays None if the line can't even be split
+            status = {'line': lineno, 'argv': None, 'status': 0}
+            try:
+                status['argv'] = shlex.split(line)
+                run_command(parse_args(parser, argv + status['argv']), connections)
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    status['status'] = e.code
+                elif e.code:
+                    status['status'] = 1
+                    status['error'] = str(e.code)
+            except Exception as e:
+                logging.debug("batch line %i failed" % lineno, exc_info=True)
+                status['status'] = 1
+                status['error'] = "%s: %s" % (e.__class__.__name__, e)
+            if status['status']:
+                failures += 1
+            sys.stdout.flush()
+            status_file.write(json.dumps(status) + "\n")
+            status_file.flush()
+    finally:
+        if batch_file is not sys.stdin:
+            batch_file.close()
+        if status_file is not sys.stderr:
+            status_file.close()
+    if failures:
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()
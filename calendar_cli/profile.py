@@ -0,0 +1,129 @@
+"""Phase timing and HTTP request statistics, for the --profile option.
+
+The code is divided into phases (config, connect, discovery, fetch,
+parse, filter, render, update), timed by wrapping them in
+``with phase('name'):``.  Phases may be nested; the time spent in an
+inner phase is not counted in the outer one, so the phase timings add
+up to (at most) the total.  CPU time is measured per thread, so the
+phases run in worker threads are accounted for correctly, but with
+concurrency the sum of the wall clock times may exceed the total.
+
+The HTTP requests are counted through a response hook on the session
+of the caldav client, grouped by HTTP method.
+
+When profiling is not enabled, phase() returns a shared no-op context
+manager, so the instrumentation costs next to nothing.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+_active = None
+_nothing = contextlib.nullcontext()
+
+class Profile():
+    def __init__(self, wall_start=None, cpu_start=None):
+        self.wall_start = time.perf_counter() if wall_start is None else wall_start
+        self.cpu_start = time.process_time() if cpu_start is None else cpu_start
+        self.phases = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add_phase(self, name, wall, cpu):
+        with self._lock:
+            entry = self.phases.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            entry['count'] += 1
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        now = (time.perf_counter(), time.thread_time())
+        if stack:
+            ## pause the outer phase
+            outer = stack[-1]
+            outer[1] += now[0] - outer[3]
+            outer[2] += now[1] - outer[4]
+        ## [name, wall, cpu, wall started, cpu started]
+        stack.append([name, 0.0, 0.0, now[0], now[1]])
+        try:
+            yield
+        finally:
+            current = stack.pop()
+            now = (time.perf_counter(), time.thread_time())
+            self.add_phase(name, current[1] + now[0] - current[3], current[2] + now[1] - current[4])
+            if stack:
+                stack[-1][3:5] = now
+
+    def add_request(self, method, status, sent, received, seconds):
+        with self._lock:
+            entry = self.requests.setdefault(method, {'count': 0, 'bytes_sent': 0, 'bytes_received': 0, 'seconds': 0.0, 'status': {}})
+            entry['count'] += 1
+            entry['bytes_sent'] += sent
+            entry['bytes_received'] += received
+            entry['seconds'] += seconds
+            entry['status'][str(status)] = entry['status'].get(str(status), 0) + 1
+
+    def instrument(self, caldav_conn):
+        """
+        Adds a response hook to the HTTP session of the caldav client
+        """
+        session = getattr(caldav_conn, 'session', None)
+        hooks = getattr(session, 'hooks', None)
+        if hooks is None or self._on_response in hooks.get('response', []):
+            return
+        hooks.setdefault('response', []).append(self._on_response)
+
+    def _on_response(self, r, *largs, **kwargs):
+        body = r.request.body or b''
+        elapsed = getattr(r, 'elapsed', None)
+        self.add_request(r.request.method, r.status_code, len(body), len(r.content or b''),
+                         elapsed.total_seconds() if elapsed is not None else 0.0)
+        return r
+
+    def report(self):
+        totals = {x: sum(entry[x] for entry in self.requests.values()) for x in ('count', 'bytes_sent', 'bytes_received')}
+        return {
+            'wall': time.perf_counter() - self.wall_start,
+            'cpu': time.process_time() - self.cpu_start,
+            'phases': self.phases,
+            'requests': dict(self.requests, total=totals),
+        }
+
+    def write(self, file_name):
+        """
+        Writes the report as json to the file, or to stderr if file_name is '-'
+        """
+        text = json.dumps(self.report(), indent=2, sort_keys=True) + "\n"
+        if file_name == '-':
+            sys.stderr.write(text)
+        else:
+            with open(file_name, 'w') as f:
+                f.write(text)
+
+def start(wall_start=None, cpu_start=None):
+    """
+    Enables profiling.  The start times may be given, if the profiling
+    is to cover work done before it could be enabled.
+    """
+    global _active
+    _active = Profile(wall_start, cpu_start)
+    return _active
+
+def phase(name):
+    """
+    Returns a context manager timing the named phase, or doing nothing
+    if profiling is not enabled
+    """
+    if _active is None:
+        return _nothing
+    return _active.phase(name)
+
+def instrument(caldav_conn):
+    if _active is not None:
+        _active.instrument(caldav_conn)
@@ -0,0 +1,105 @@
+"""Translation of todo selection options to CalDAV calendar-query
+filters (RFC 4791, section 9.7), so the filtering can be done by the
+server rather than after downloading the complete task list.
+
+The server-side filtering is only used for narrowing down the result
+set - the client-side filtering in todo_select is still applied to the
+result, both because some servers only implement parts of the RFC and
+because the substring semantics of the text-match element is not
+exactly the same as the client-side matching of i.e. categories.
+
+When only a few properties are needed for the output, the calendar-data
+element of the query may also ask the server to return only those
+(RFC 4791, section 9.6), rather than the complete objects.
+"""
+
+def todo_filters(args, now, txt_attrs):
+    """
+    Returns a list of alternatives, each being a list of prop-filter
+    elements to be put into the VTODO comp-filter.  The result is the
+    union of the alternatives (the calendar-query has no OR-operator,
+    so each alternative will be one REPORT).  Returns an empty list if
+    none of the options given can be pushed down to the server.
+    """
+    from caldav.elements import cdav
+    filters = []
+    for attr in txt_attrs:
+        if getattr(args, attr):
+            filters.append(cdav.PropFilter(attr.upper()) + cdav.TextMatch(getattr(args, attr)))
+        if getattr(args, 'no'+attr):
+            filters.append(cdav.PropFilter(attr.upper()) + cdav.NotDefined())
+    if args.overdue:
+        filters.append(cdav.PropFilter("DUE") + cdav.TimeRange(end=now))
+    if not filters and not args.hide_future:
+        return []
+
+    ## Completed tasks should always carry the COMPLETED property.  We
+    ## cannot filter on STATUS, as a text-match on a property requires
+    ## the property to exist
+    filters.append(cdav.PropFilter("COMPLETED") + cdav.NotDefined())
+
+    if args.hide_future:
+        ## either dtstart is in the past, or there is no dtstart
+        return [filters + [cdav.PropFilter("DTSTART") + cdav.TimeRange(end=now)],
+                filters + [cdav.PropFilter("DTSTART") + cdav.NotDefined()]]
+    return [filters]
+
+def pending_filters():
+    """
+    The alternatives for selecting only the tasks that are not completed
+    """
+    from caldav.elements import cdav
+    return [[cdav.PropFilter("COMPLETED") + cdav.NotDefined()]]
+
+def uid_filters(uid):
+    """
+    The alternatives for selecting the task with the given UID
+    """
+    from caldav.elements import cdav
+    return [[cdav.PropFilter("UID") + cdav.TextMatch(uid)]]
+
+def calendar_data(comp_name, props=None):
+    """
+    Builds a calendar-data element.  If props is given, the server is
+    asked to return only those properties of the comp_name components
+    (and the VTIMEZONEs, needed for interpreting the timestamps).
+    """
+    from caldav.elements import cdav
+    from caldav.elements.base import NamedBaseElement
+    class Prop(NamedBaseElement):
+        ## not provided by the caldav library
+        tag = '{urn:ietf:params:xml:ns:caldav}prop'
+    data = cdav.CalendarData()
+    if props:
+        data += cdav.Comp("VCALENDAR") + [
+            Prop("VERSION"),
+            cdav.Comp(comp_name) + [Prop(x) for x in sorted(props)],
+            cdav.Comp("VTIMEZONE") + cdav.Allprop()]
+    return data
+
+def todo_query(filters, props=None):
+    """
+    Builds a calendar-query REPORT body for VTODOs matching all the
+    filters.  If props is given, only those properties are requested.
+    The ETags are always requested, as they are needed for conditional
+    updates.
+    """
+    from caldav.elements import cdav, dav
+    return cdav.CalendarQuery() + [
+        dav.Prop() + [dav.GetEtag(), calendar_data("VTODO", props)],
+        cdav.Filter() + (cdav.CompFilter("VCALENDAR") + (cdav.CompFilter("VTODO") + filters))]
+
+def event_query(start, end, props=None):
+    """
+    Builds a calendar-query REPORT body for the events overlapping the
+    interval between start and end.  If props is given, only those
+    properties are requested.
+
+    The server is not asked to expand recurring events (RFC 4791,
+    section 9.6.5), as at least Radicale drops non-recurring events
+    with time zones from expanded results.
+    """
+    from caldav.elements import cdav, dav
+    return cdav.CalendarQuery() + [
+        dav.Prop() + calendar_data("VEVENT", props),
+        cdav.Filter() + (cdav.CompFilter("VCALENDAR") + (cdav.CompFilter("VEVENT") + cdav.TimeRange(start, end)))]
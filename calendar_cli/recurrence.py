@@ -0,0 +1,284 @@
+"""Client side expansion of recurring events and tasks.
+
+Not all caldav servers support expanding recurring events (the expand
+element of a calendar-query) or get it right, and with the sync cache,
+a vdir or --nocaldav there is no server to ask.  expand() takes the
+components of one calendar object - the master with its RRULE, RDATE
+and EXDATE properties, and the overrides with a RECURRENCE-ID - and
+yields the instances overlapping a time interval.  It works both on
+vobject components and on the lightweight calendar_cli.ics ones.
+
+The recurrence rules are evaluated in the wall clock time of the time
+zone of DTSTART, as demanded by RFC 5545, so an event at 09:00 stays at
+09:00 across daylight saving time changes.  Floating times and dates
+are taken to be in the local time zone when compared with the search
+interval.
+
+Both the compiled rules and the occurrences found within an interval
+are kept in an LRU cache, keyed by UID, SEQUENCE and the recurrence
+properties (and the interval), so repeated queries for the same
+interval - like several config sections, --batch or the windows of a
+long agenda all hitting the same recurring events - don't redo the
+work.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+## The number of compiled rules and of occurrence lists kept
+_cache_size = 1024
+_rules = OrderedDict()
+_occurrences = OrderedDict()
+_lock = threading.Lock()
+
+_until_re = re.compile(r'UNTIL=(\d{8})(T\d{6}Z?)?', re.I)
+## The properties not carried over from the master to the instances
+_master_props = ('rrule', 'rdate', 'exrule', 'exdate', 'recurrence-id', 'dtend', 'due', 'duration')
+
+def _cached(cache, key, compute):
+    with _lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = compute()
+    with _lock:
+        cache[key] = value
+        if len(cache) > _cache_size:
+            cache.popitem(last=False)
+    return value
+
+def _values(comp, name):
+    """
+    Returns the values of all the properties with the given name,
+    RDATE and EXDATE properties holding lists being flattened
+    """
+    ret = []
+    for prop in comp.contents.get(name, []):
+        if isinstance(prop.value, list):
+            ret.extend(prop.value)
+        else:
+            ret.append(prop.value)
+    return ret
+
+def _start_prop(comp):
+    """
+    The name of the property the recurrences are counted from -
+    DTSTART, or DUE for a task without DTSTART
+    """
+    for name in ('dtstart', 'due'):
+        if name in comp.contents:
+            return name
+    return None
+
+def is_recurring(comp):
+    return 'rrule' in comp.contents or 'rdate' in comp.contents
+
+def aware(value, tzinfo):
+    """
+    Returns the date or timestamp as a timestamp with time zone, dates
+    and floating times being taken as local time in tzinfo
+    """
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        return value
+    if hasattr(tzinfo, 'localize'):
+        return tzinfo.localize(value)
+    return value.replace(tzinfo=tzinfo)
+
+def duration(comp):
+    """
+    The duration of an event or task, from DTSTART to DTEND/DUE
+    """
+    start = _start_prop(comp)
+    if start == 'dtstart':
+        for name in ('dtend', 'due'):
+            if name in comp.contents:
+                return comp.contents[name][0].value - comp.contents['dtstart'][0].value
+    if 'duration' in comp.contents:
+        return comp.contents['duration'][0].value
+    if comp.name == 'VEVENT' and not isinstance(comp.contents['dtstart'][0].value, datetime):
+        return timedelta(1)
+    return timedelta(0)
+
+def overlaps(comp, search_dtstart, search_dtend, tzinfo):
+    """
+    Checks if the event or task overlaps the search interval
+    """
+    start = _start_prop(comp)
+    if start is None:
+        return False
+    value = comp.contents[start][0].value
+    dtstart = aware(value, tzinfo)
+    dtend = aware(value + duration(comp), tzinfo) if start == 'dtstart' else dtstart
+    return dtstart < search_dtend and (dtend > search_dtstart or dtstart >= search_dtstart)
+
+def rule_key(comp):
+    """
+    Identifies the recurrence set of a component
+    """
+    uid = comp.contents['uid'][0].value if 'uid' in comp.contents else None
+    sequence = comp.contents['sequence'][0].value if 'sequence' in comp.contents else None
+    return (uid, str(sequence), repr(comp.contents[_start_prop(comp)][0].value),
+            tuple(str(x) for x in _values(comp, 'rrule') + _values(comp, 'exrule')),
+            tuple(repr(x) for x in _values(comp, 'rdate')), tuple(repr(x) for x in _values(comp, 'exdate')))
+
+class _Rule():
+    """
+    A compiled recurrence set.  The dateutil rules work on naive
+    timestamps, in the wall clock time of DTSTART.
+    """
+    def __init__(self, comp):
+        from dateutil import rrule
+        start = comp.contents[_start_prop(comp)][0].value
+        self.is_date = not isinstance(start, datetime)
+        self.tzinfo = None if self.is_date else start.tzinfo
+        self.ruleset = rrule.rruleset()
+        dtstart = self.wall(start, None)
+        for (name, add) in (('rrule', self.ruleset.rrule), ('exrule', self.ruleset.exrule)):
+            for text in _values(comp, name):
+                add(self._rrule(str(text), dtstart))
+        for value in _values(comp, 'rdate'):
+            self.ruleset.rdate(self.wall(value, None))
+        for value in _values(comp, 'exdate'):
+            self.ruleset.exdate(self.wall(value, None))
+
+    def _rrule(self, text, dtstart):
+        from dateutil import rrule
+        rule = rrule.rrulestr(text, dtstart=dtstart, ignoretz=True)
+        until = _until_re.search(text)
+        if until:
+            if not until.group(2):
+                ## the whole last day is included
+                value = datetime.strptime(until.group(1), '%Y%m%d')
+                if not self.is_date:
+                    value += timedelta(1) - timedelta(seconds=1)
+            else:
+                value = datetime.strptime(until.group(1) + until.group(2)[:7].upper(), '%Y%m%dT%H%M%S')
+                if until.group(2).upper().endswith('Z'):
+                    value = self.wall(value.replace(tzinfo=timezone.utc), None)
+            rule = rule.replace(until=value)
+        return rule
+
+    def wall(self, value, tzinfo):
+        """
+        Converts a date or timestamp to the naive wall clock time of the
+        rule.  Timestamps with time zone are converted to the time zone
+        of DTSTART, or to tzinfo if DTSTART is floating.
+        """
+        if isinstance(value, tuple):
+            ## an RDATE period
+            value = value[0]
+        if not isinstance(value, datetime):
+            return datetime(value.year, value.month, value.day)
+        if value.tzinfo is not None:
+            value = value.astimezone(self.tzinfo or tzinfo or value.tzinfo)
+        return value.replace(tzinfo=None)
+
+    def native(self, value):
+        """
+        Converts a naive timestamp from the rule to the type of DTSTART
+        """
+        if self.is_date:
+            return value.date()
+        if self.tzinfo is None:
+            return value
+        if hasattr(self.tzinfo, 'localize'):
+            return self.tzinfo.localize(value)
+        return value.replace(tzinfo=self.tzinfo)
+
+def _rule(comp):
+    return _cached(_rules, rule_key(comp), lambda: _Rule(comp))
+
+def occurrences(comp, search_dtstart, search_dtend, tzinfo):
+    """
+    Returns the start of each occurrence of the recurring component
+    within the interval (both ends included), as dates or timestamps of
+    the same kind as its DTSTART
+    """
+    rule = _rule(comp)
+    (start, end) = (rule.wall(search_dtstart, tzinfo), rule.wall(search_dtend, tzinfo))
+    key = (rule_key(comp), start, end)
+    return _cached(_occurrences, key, lambda: tuple(rule.native(x) for x in rule.ruleset.between(start, end, inc=True)))
+
+def next_occurrence(comp, after, tzinfo):
+    """
+    Returns the start of the first occurrence after the timestamp, or
+    None if the recurrence set is exhausted
+    """
+    if _start_prop(comp) is None:
+        ## nothing to count from; the rule is taken to start now, in
+        ## floating local time
+        from dateutil import rrule
+        start = after.astimezone(tzinfo).replace(tzinfo=None)
+        return rrule.rrulestr(str(comp.contents['rrule'][0].value), dtstart=start, ignoretz=True).after(start)
+    rule = _rule(comp)
+    value = rule.ruleset.after(rule.wall(after, tzinfo))
+    return None if value is None else rule.native(value)
+
+def _instance(master, start, length):
+    """
+    Returns a copy of the master component for the occurrence at start
+    """
+    start_prop = _start_prop(master)
+    end_prop = None
+    if start_prop == 'dtstart':
+        end_prop = 'due' if master.name == 'VTODO' else 'dtend'
+        if master.name == 'VTODO' and not 'due' in master.contents and not 'duration' in master.contents:
+            end_prop = None
+    if hasattr(master, 'duplicate'):
+        ## vobject
+        instance = master.duplicate(master)
+        for name in _master_props:
+            if name != start_prop:
+                instance.contents.pop(name, None)
+        getattr(instance, start_prop).value = start
+        if end_prop:
+            instance.add(end_prop).value = start + length
+        instance.add('recurrence-id').value = start
+        return instance
+    from calendar_cli.ics import Component, Property
+    instance = Component(master.name)
+    instance.subcomponents = master.subcomponents
+    instance.contents = {name: values for (name, values) in master.contents.items() if not name in _master_props}
+    instance.contents[start_prop] = [Property(start_prop.upper(), {}, start)]
+    if end_prop:
+        instance.contents[end_prop] = [Property(end_prop.upper(), {}, start + length)]
+    instance.contents['recurrence-id'] = [Property('RECURRENCE-ID', {}, start)]
+    return instance
+
+def expand(comps, search_dtstart, search_dtend, tzinfo):
+    """
+    Yields the instances of a calendar object overlapping the search
+    interval.  comps are the components of the object (of one type,
+    with the same UID): a master, possibly recurring, and any number
+    of overrides with a RECURRENCE-ID.  The occurrences of the master
+    are yielded as copies of it, with DTSTART, DTEND/DUE and
+    RECURRENCE-ID set, unless they have been overridden.
+    """
+    master = None
+    overrides = []
+    for comp in comps:
+        ## todo complete moves the start of a recurring task by giving
+        ## it a RECURRENCE-ID with RANGE=THISANDFUTURE; it is still the
+        ## master
+        if 'recurrence-id' in comp.contents and not is_recurring(comp):
+            overrides.append(comp)
+        else:
+            master = comp
+    instances = list(overrides)
+    if master is not None and _start_prop(master) is not None:
+        if is_recurring(master):
+            overridden = set(aware(x.contents['recurrence-id'][0].value, tzinfo) for x in overrides)
+            length = duration(master)
+            for start in occurrences(master, search_dtstart - length, search_dtend, tzinfo):
+                if aware(start, tzinfo) in overridden:
+                    continue
+                instances.append(_instance(master, start, length))
+        else:
+            instances.append(master)
+    for instance in instances:
+        if overlaps(instance, search_dtstart, search_dtend, tzinfo):
+            yield instance
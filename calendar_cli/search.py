@@ -0,0 +1,162 @@
+"""Full text search over the events, tasks and journals of a calendar.
+
+The search index is an SQLite FTS5 table, stored in the cache
+directory with one database per config section and calendar URL.  It
+holds the summary, description, location and categories of each
+calendar object, together with the UID, component type and start/due
+time for the output.
+
+The index is updated incrementally: the caller gives the current
+version (ETag, or the mtime and size of a vdir file) of each object,
+and only the objects that are new or have a different version than
+the one indexed are loaded and parsed.  The objects themselves come
+from the sync cache (or the vdir), so an update of an unchanged
+calendar costs one PROPFIND.
+
+The queries use the FTS5 syntax, so besides plain words, prefix
+queries (``meet*``), phrases (``"project plan"``), boolean operators
+and column filters (``summary:meeting``, ``categories:work``) are
+supported.  The results are ranked by bm25, with matches in the
+summary and categories weighing more than matches in the description.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+
+## Bump when the schema changes; the index is then rebuilt
+_schema_version = 1
+_text_columns = ('summary', 'description', 'location', 'categories')
+## bm25 weights, in the same order as the columns of the entries table
+_weights = (10.0, 1.0, 2.0, 5.0)
+
+def _database_file_name(cache_dir, config_section, calendar_url):
+    key = hashlib.sha1(("%s\n%s" % (config_section, calendar_url)).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'search-%s.sqlite' % key)
+
+def _text(comp, name):
+    values = []
+    for prop in comp.contents.get(name, []):
+        value = prop.value
+        if isinstance(value, (list, tuple)):
+            values.extend(str(x) for x in value)
+        elif value is not None:
+            values.append(str(value))
+    return " ".join(values)
+
+def _isoformat(comp, name):
+    prop = comp.contents.get(name)
+    if not prop or not hasattr(prop[0].value, 'isoformat'):
+        return None
+    return prop[0].value.isoformat()
+
+def _parse(data):
+    """
+    Returns the top level components of the icalendar data, through the
+    lightweight parser if possible and vobject otherwise
+    """
+    from calendar_cli.ics import parse_calendar
+    try:
+        return list(parse_calendar(data).components())
+    except ValueError:
+        import vobject
+        return list(vobject.readOne(data).components())
+
+def entry(data):
+    """
+    Extracts the indexed fields from the icalendar data of one calendar
+    object.  The texts of all the components (i.e. a recurring event
+    and its overrides) are included, while uid, component and the
+    timestamps are taken from the first one.
+    """
+    comps = [x for x in _parse(data) if x.name in ('VEVENT', 'VTODO', 'VJOURNAL')]
+    if not comps:
+        return None
+    ret = {x: " ".join(filter(None, (_text(comp, x) for comp in comps))) for x in _text_columns}
+    ret['uid'] = _text(comps[0], 'uid')
+    ret['component'] = comps[0].name
+    ret['dtstart'] = _isoformat(comps[0], 'dtstart')
+    ret['due'] = _isoformat(comps[0], 'due')
+    return ret
+
+class SearchIndex():
+    def __init__(self, cache_dir, config_section, calendar_url):
+        self.file_name = _database_file_name(cache_dir, config_section, calendar_url)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(self.file_name)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != _schema_version:
+            self._create()
+
+    def _create(self):
+        with self.db:
+            self.db.execute("DROP TABLE IF EXISTS objects")
+            self.db.execute("DROP TABLE IF EXISTS entries")
+            ## entry is the rowid in entries, NULL for objects that
+            ## could not be indexed
+            self.db.execute("CREATE TABLE objects (href TEXT PRIMARY KEY, version TEXT, entry INTEGER)")
+            self.db.execute(
+                "CREATE VIRTUAL TABLE entries USING fts5(%s, href UNINDEXED, uid UNINDEXED, component UNINDEXED, "
+                "dtstart UNINDEXED, due UNINDEXED, prefix='2 3')" % ", ".join(_text_columns))
+            self.db.execute("PRAGMA user_version = %i" % _schema_version)
+
+    def update(self, versions, load):
+        """
+        Brings the index up to date.  versions is a dict from href to the
+        current version of each object, and load a function taking a
+        list of hrefs and yielding (href, data) for them.  Returns the
+        number of objects (re)indexed and removed.
+        """
+        known = {x[0]: x[1:] for x in self.db.execute("SELECT href, version, entry FROM objects")}
+        removed = [x for x in known if not x in versions]
+        changed = [x for (x, version) in versions.items() if not x in known or known[x][0] != version]
+        if not removed and not changed:
+            return (0, 0)
+        with self.db:
+            for href in removed + changed:
+                if not href in known:
+                    continue
+                if known[href][1] is not None:
+                    self.db.execute("DELETE FROM entries WHERE rowid = ?", (known[href][1],))
+                self.db.execute("DELETE FROM objects WHERE href = ?", (href,))
+            for (href, data) in load(changed):
+                try:
+                    fields = entry(data)
+                except Exception:
+                    logging.info("could not index %s" % href, exc_info=True)
+                    fields = None
+                rowid = None
+                if fields is not None:
+                    fields['href'] = href
+                    columns = sorted(fields)
+                    rowid = self.db.execute("INSERT INTO entries (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?"*len(columns))),
+                                            [fields[x] for x in columns]).lastrowid
+                ## objects that can't be indexed are recorded anyway,
+                ## so they are not parsed again until they change
+                self.db.execute("INSERT INTO objects (href, version, entry) VALUES (?, ?, ?)", (href, versions[href], rowid))
+        return (len(changed), len(removed))
+
+    def search(self, query, components=None, limit=None):
+        """
+        Returns a list of dicts for the objects matching the query,
+        best match first.  components may be a list of component types
+        to limit the search to, i.e. ['VTODO'].
+        """
+        sql = ("SELECT href, uid, component, dtstart, due, %s, bm25(entries, %s) AS rank FROM entries WHERE entries MATCH ?"
+               % (", ".join(_text_columns), ", ".join(str(x) for x in _weights)))
+        params = [query]
+        if components:
+            sql += " AND component IN (%s)" % ", ".join("?"*len(components))
+            params.extend(components)
+        sql += " ORDER BY rank"
+        if limit:
+            sql += " LIMIT %i" % limit
+        try:
+            cursor = self.db.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            raise ValueError("invalid search query %r: %s" % (query, e))
+        columns = [x[0] for x in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        self.db.close()
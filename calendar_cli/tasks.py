@@ -0,0 +1,168 @@
+"""Compact representation of the tasks selected by the todo commands.
+
+Each VTODO is converted once into a TaskRecord, with the properties
+needed for filtering, sorting and output pulled out of the vobject
+instance and the timestamps normalized to UTC, so the vobject tree
+doesn't have to be probed again and again for every filter.
+"""
+
+from datetime import datetime, timezone
+
+## The extra text attributes (beyond summary, categories, etc) the
+## tasks may be filtered on
+text_attributes = ('location', 'description', 'geo', 'organizer', 'url', 'comment', 'contact', 'resources')
+
+## Used as sort keys for tasks without due or dtstart
+_far_future = datetime(2050, 1, 1, tzinfo=timezone.utc)
+_far_past = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def to_utc(value, tzinfo):
+    """
+    Converts a date or datetime to an UTC datetime.  Dates and naive
+    timestamps are considered to be in the time zone given.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        if hasattr(tzinfo, 'localize'):
+            value = tzinfo.localize(value)
+        else:
+            value = value.replace(tzinfo=tzinfo)
+    return value.astimezone(timezone.utc)
+
+class TaskRecord():
+    """
+    A VTODO with the properties pre-extracted.  ``task`` is the caldav
+    object, needed for saving or deleting the task.  ``dtstart`` and
+    ``due`` are UTC datetimes for comparisons, while ``dtstart_value``
+    and ``due_value`` are the values as given in the task (date or
+    datetime).  ``related_to`` is a list of (reltype, uid) tuples, one
+    for each RELATED-TO property.  ``recurring`` tells if the task has
+    an RRULE or RDATE.
+
+    The properties are read from ``vtodo`` if given (i.e. a component
+    from calendar_cli.ics.parse_calendar), otherwise from the vobject
+    instance of the task.
+    """
+    __slots__ = ('task', 'uid', 'summary', 'dtstart', 'due', 'dtstart_value', 'due_value',
+                 'priority', 'status', 'completed', 'related_to', 'categories', 'recurring') + text_attributes
+
+    def __init__(self, task, tzinfo, vtodo=None):
+        if vtodo is None:
+            vtodo = task.instance.vtodo
+        contents = vtodo.contents
+        def value(name):
+            prop = contents.get(name)
+            return prop[0].value if prop else None
+
+        self.task = task
+        self.uid = value('uid')
+        self.summary = value('summary')
+        self.dtstart_value = value('dtstart')
+        self.due_value = value('due')
+        self.dtstart = to_utc(self.dtstart_value, tzinfo)
+        self.due = to_utc(self.due_value, tzinfo)
+        try:
+            self.priority = int(value('priority') or 0)
+        except ValueError:
+            self.priority = 0
+        self.status = value('status')
+        self.completed = 'completed' in contents
+        self.related_to = [(x.params.get('RELTYPE', ['PARENT'])[0], x.value) for x in contents.get('related-to', [])]
+        self.categories = tuple(c for x in contents.get('categories', []) for c in x.value)
+        self.recurring = 'rrule' in contents or 'rdate' in contents
+        for attr in text_attributes:
+            v = value(attr)
+            setattr(self, attr, tuple(v) if isinstance(v, list) else v)
+
+    def is_pending(self):
+        return not self.completed and not self.status in ('COMPLETED', 'CANCELLED')
+
+    def sort_key(self, now):
+        """
+        Local equivalent of the sort_keys ('isnt_overdue',
+        'hasnt_started', 'due', 'dtstart', 'priority') that may be
+        passed to the caldav library.
+        """
+        return (not (self.due and self.due < now),
+                bool(self.dtstart and self.dtstart > now),
+                self.due or _far_future,
+                self.dtstart or _far_past,
+                self.priority)
+
+class TaskGraph():
+    """
+    Parent/child index over a list of TaskRecords, built in one pass
+    over the RELATED-TO properties.  A relation may be given on either
+    side (RELTYPE=PARENT on the child or RELTYPE=CHILD on the parent),
+    and a task may have several of them.  Relations to tasks not in the
+    list are ignored, so a task whose parents are all missing is
+    considered a root.  Cycles are tolerated; every task is visited
+    once by walk().
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.by_uid = {x.uid: x for x in tasks}
+        self.children = {}
+        self.parents = {}
+        for task in tasks:
+            for (rel_type, rel_uid) in task.related_to:
+                if rel_type == 'PARENT':
+                    self._link(rel_uid, task.uid)
+                elif rel_type == 'CHILD':
+                    self._link(task.uid, rel_uid)
+
+    def _link(self, parent, child):
+        if parent == child or not parent in self.by_uid or not child in self.by_uid:
+            return
+        children = self.children.setdefault(parent, [])
+        if not child in children:
+            children.append(child)
+            self.parents.setdefault(child, []).append(parent)
+
+    def has_children(self, uid):
+        return uid in self.children
+
+    def has_parents(self, uid):
+        return uid in self.parents
+
+    def descendants(self, uid):
+        """
+        Returns the set of UIDs below uid (not including uid itself,
+        unless it's part of a cycle)
+        """
+        found = set()
+        todo = [uid]
+        while todo:
+            for child in self.children.get(todo.pop(), ()):
+                if not child in found:
+                    found.add(child)
+                    todo.append(child)
+        return found
+
+    def walk(self):
+        """
+        Yields (depth, task) for all the tasks, depth first, with the
+        children following their parent.  Siblings are given in the
+        same order as in the task list.  A task with several parents
+        is only given once, below the first parent reached.  Tasks that
+        can only be reached through a cycle are given as roots.
+        """
+        order = {x.uid: i for (i, x) in enumerate(self.tasks)}
+        for children in self.children.values():
+            children.sort(key=order.get)
+        visited = set()
+        roots = [x for x in self.tasks if not x.uid in self.parents]
+        for task in roots + self.tasks:
+            if task.uid in visited:
+                continue
+            visited.add(task.uid)
+            stack = [(0, task)]
+            while stack:
+                (depth, current) = stack.pop()
+                yield (depth, current)
+                children = [x for x in self.children.get(current.uid, ()) if not x in visited]
+                visited.update(children)
+                stack.extend((depth+1, self.by_uid[x]) for x in reversed(children))
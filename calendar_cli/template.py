@@ -3,9 +3,13 @@ template string.
 
 This does not really belong in the calendar-cli package.  I was
 googling a bit, and didn't find anything like this out there ... but
-I'm sure there must exist something like this?"""
+I'm sure there must exist something like this?
+
+The template is parsed once, when the Template object is created.  The
+field names, attribute/index lookups, default values and format specs
+are all resolved at that point, so rendering a row is just a matter of
+looking up the values and formatting them."""
 
-import datetime
 import string
 import re
 
@@ -24,26 +28,103 @@ class NoValue():
 
 no_value = NoValue()
 
-class Template(string.Formatter):
+_formatter = string.Formatter()
+_default_re = re.compile(r'\?([^\?]*)\?(.*)', re.DOTALL)
+_conversions = {'r': repr, 's': str, 'a': ascii}
+_field_first_re = re.compile(r'[^.\[]*')
+_field_rest_re = re.compile(r'\.([^.\[]+)|\[([^\]]+)\]')
+
+def _split_field_name(field_name):
+    """
+    Splits a field name like instance.vtodo.categories[0] into the first
+    part and a list of (is_attr, key) lookups, the way str.format does
+    it.  Numeric names and indexes are converted to ints.
+    """
+    first = _field_first_re.match(field_name).group(0)
+    rest = []
+    pos = len(first)
+    while pos < len(field_name):
+        rx = _field_rest_re.match(field_name, pos)
+        if not rx:
+            raise ValueError("invalid field name %r in template" % field_name)
+        if rx.group(1) is not None:
+            rest.append((True, rx.group(1)))
+        else:
+            key = rx.group(2)
+            rest.append((False, int(key) if key.isdigit() else key))
+        pos = rx.end()
+    return (int(first) if first.isdigit() else first, rest)
+
+def _split_default(format_spec):
+    """
+    Splits a format spec like ?default?%F into ('default', '%F').  The
+    default is None if the spec doesn't start with a default.
+    """
+    rx = _default_re.match(format_spec)
+    if rx:
+        return (rx.group(1), rx.group(2))
+    return (None, format_spec)
+
+class Template():
+    """
+    A compiled template.  ``fields`` is the set of top level field
+    names used in the template (including in nested templates in the
+    format specs), so the caller may avoid computing values that
+    won't be used.
+    """
     def __init__(self, template):
         self.template = template
+        self.fields = set()
+        self._parts = []
+        auto_number = 0
+        for (literal, field_name, format_spec, conversion) in _formatter.parse(template):
+            if literal:
+                self._parts.append(literal)
+            if field_name is None:
+                continue
+            if field_name == '':
+                field_name = str(auto_number)
+                auto_number += 1
+            (first, rest) = _split_field_name(field_name)
+            if isinstance(first, str):
+                self.fields.add(first)
+            if '{' in format_spec:
+                ## The format spec is a template itself, and cannot be
+                ## resolved before the values are known
+                spec = Template(format_spec)
+                self.fields.update(spec.fields)
+                default = None
+            else:
+                (default, spec) = _split_default(format_spec)
+            self._parts.append((first, tuple(rest), _conversions.get(conversion), default, spec))
 
     def format(self, *pargs, **kwargs):
-        return super().format(self.template, *pargs, **kwargs)
+        return self._render(pargs, kwargs)
 
-    def get_value(self, key, args, kwds):
-        try:
-            return string.Formatter.get_value(self, key, args, kwds)
-        except:
-            return no_value
-
-    def format_field(self, value, format_spec):
-        rx = re.match(r'\?([^\?]*)\?(.*)', format_spec)
-        if rx:
-            format_spec = rx.group(2)
-            if value is no_value:
-                value = rx.group(1)
-        try:
-            return string.Formatter.format_field(self, value, format_spec)
-        except:
-            return string.Formatter.format_field(self, value, "")
+    def format_map(self, mapping):
+        return self._render((), mapping)
+
+    def _render(self, pargs, kwargs):
+        out = []
+        for part in self._parts:
+            if part.__class__ is str:
+                out.append(part)
+                continue
+            (first, rest, conversion, default, spec) = part
+            try:
+                value = pargs[first] if isinstance(first, int) else kwargs[first]
+                for (is_attr, key) in rest:
+                    value = getattr(value, key) if is_attr else value[key]
+            except (LookupError, AttributeError, TypeError):
+                value = no_value
+            if conversion and value is not no_value:
+                value = conversion(value)
+            if spec.__class__ is Template:
+                (default, spec) = _split_default(spec._render(pargs, kwargs))
+            if value is no_value and default is not None:
+                value = default
+            try:
+                out.append(format(value, spec))
+            except (ValueError, TypeError):
+                out.append(format(value, ""))
+        return "".join(out)
@@ -0,0 +1,179 @@
+"""Retries and throttling for the HTTP requests to the caldav server.
+
+The caldav library gives up on the first connection reset or 503, which
+aborts long running bulk operations halfway through.  configure() mounts
+an adapter on the HTTP session of the client, with a connection pool
+kept alive between requests and a retry policy:
+
+* Requests failing with a connection error, or answered with 408, 429,
+  502, 503 or 504, are retried up to --retries times.  Failures before
+  the request has been sent are retried for all methods, otherwise only
+  the idempotent methods (GET, HEAD, OPTIONS, PROPFIND, REPORT, PUT and
+  DELETE) are retried.  Modifications are sent with If-Match when the
+  ETag is known, so a repeated PUT or DELETE that was already carried
+  out is reported as a conflict rather than applied twice.
+* The delay between attempts grows exponentially from --retry-backoff
+  seconds, with random jitter so that parallel workers don't retry in
+  lockstep.  A Retry-After header from the server takes precedence.
+
+The bulk commands also get an AdaptiveLimit through
+concurrency_limit(), capping the number of operations in flight.  It
+starts at --jobs, is halved whenever the server signals overload (a
+retry as above) and grows by one per round of successful requests, so
+the throughput follows what the server can take.
+"""
+
+import importlib
+import logging
+import random
+import threading
+import time
+import weakref
+
+_idempotent_methods = frozenset(('GET', 'HEAD', 'OPTIONS', 'PROPFIND', 'REPORT', 'PUT', 'DELETE'))
+_retry_statuses = frozenset((408, 429, 502, 503, 504))
+## Never wait longer than this for a single retry, whatever the
+## Retry-After header says
+_retry_after_max = 300
+_backoff_max = 60
+## Overload signals arriving within this many seconds of a decrease are
+## taken as part of the same episode, and don't decrease the limit again
+_decrease_interval = 1.0
+
+## Transport settings per HTTP session
+_transports = weakref.WeakKeyDictionary()
+
+class AdaptiveLimit():
+    """
+    Caps the number of concurrent operations, adjusted by additive
+    increase/multiplicative decrease.  Used as a context manager around
+    each operation.
+    """
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.active = 0
+        self._condition = threading.Condition()
+        self._last_decrease = None
+
+    def __enter__(self):
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *largs):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def succeeded(self):
+        with self._condition:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1/self.limit)
+                self._condition.notify_all()
+
+    def throttled(self):
+        with self._condition:
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < _decrease_interval:
+                return
+            self._last_decrease = now
+            if self.limit > 1:
+                self.limit = max(1.0, self.limit/2)
+                logging.info("server under pressure, reducing the concurrency to %i" % self.limit)
+
+class _Transport():
+    def __init__(self, retries, backoff):
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = 10
+        self.limits = weakref.WeakSet()
+
+    def throttled(self):
+        for limit in list(self.limits):
+            limit.throttled()
+
+    def on_response(self, r, *largs, **kwargs):
+        if not r.status_code in _retry_statuses:
+            for limit in list(self.limits):
+                limit.succeeded()
+        return r
+
+def _retry_class(base):
+    """
+    Returns a subclass of the Retry class of the HTTP library (urllib3
+    for requests, urllib3-future for niquests) with jittered backoff,
+    reporting the retries to the transport
+    """
+    class _Retry(base):
+        transport = None
+
+        def new(self, **kwargs):
+            retry = super().new(**kwargs)
+            retry.transport = self.transport
+            return retry
+
+        def increment(self, method=None, url=None, response=None, error=None, *largs, **kwargs):
+            if self.transport is not None and (error is not None or getattr(response, 'status', None) in _retry_statuses):
+                self.transport.throttled()
+            logging.debug("%s %s failed: %s" % (method, url, error or getattr(response, 'status', None)))
+            return super().increment(method, url, response, error, *largs, **kwargs)
+
+        def get_backoff_time(self):
+            ## "equal jitter": between half and all of the exponential backoff
+            if not self.history:
+                return 0
+            backoff = min(self.backoff_max, self.backoff_factor * 2**(len(self.history)-1))
+            return backoff/2 + random.uniform(0, backoff/2)
+    return _Retry
+
+def _mount(session, transport):
+    adapters = importlib.import_module(type(session).__module__.split('.')[0] + '.adapters')
+    retry = _retry_class(adapters.Retry)(
+        total=transport.retries, allowed_methods=_idempotent_methods, status_forcelist=_retry_statuses,
+        backoff_factor=transport.backoff, backoff_max=_backoff_max, raise_on_status=False,
+        respect_retry_after_header=True, retry_after_max=_retry_after_max)
+    retry.transport = transport
+    adapter = adapters.HTTPAdapter(pool_maxsize=transport.pool_size, max_retries=retry)
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, adapter)
+
+def configure(caldav_conn, retries, backoff):
+    """
+    Sets up the retry policy on the HTTP session of the client
+    """
+    session = caldav_conn.session
+    transport = _Transport(retries, backoff)
+    _transports[session] = transport
+    _mount(session, transport)
+    session.hooks.setdefault('response', []).append(transport.on_response)
+
+def set_pool_size(caldav_conn, size):
+    """
+    The default connection pool holds 10 connections per host.  With
+    more workers than that, connections would be thrown away and
+    reestablished all the time.
+    """
+    transport = _transports.get(caldav_conn.session)
+    if transport is None:
+        transport = _Transport(0, 0)
+        _transports[caldav_conn.session] = transport
+    if size <= transport.pool_size:
+        return
+    transport.pool_size = size
+    _mount(caldav_conn.session, transport)
+
+def concurrency_limit(caldav_conn, jobs):
+    """
+    Returns an AdaptiveLimit for up to jobs concurrent operations
+    towards the server, or None if there is nothing to limit
+    """
+    if caldav_conn is None or jobs <= 1:
+        return None
+    limit = AdaptiveLimit(jobs)
+    transport = _transports.get(caldav_conn.session)
+    if transport is not None:
+        transport.limits.add(limit)
+    return limit
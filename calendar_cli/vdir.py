@@ -0,0 +1,381 @@
+"""Calendars stored as vdirs rather than on a caldav server.
+
+A vdir is a directory with one .ics file per calendar object, as
+written by vdirsyncer and read by khal and todoman.  A config section
+with "vdir" set (or --vdir on the command line) makes calendar-cli
+read and write the files in the directory directly, without any
+server involved.
+
+To avoid parsing all the files on every run, an index is kept in the
+cache directory, with the modification time, size, UID, component
+type, start/end/due timestamps, status and categories for each file.
+Only the files that have been added or changed since the index was
+written are parsed; the agenda and todo listings then only read the
+files that the index says may match.  The index is an optimization
+only - it may be deleted at any time.
+"""
+
+import calendar
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import caldav
+import caldav.lib.error
+
+from calendar_cli.cache import default_cache_dir, _component_type
+from calendar_cli.ics import split_calendar, parse_calendar
+
+## Events and tasks with floating times or dates are stored in the
+## index as if they were in UTC, and compared with this much slack
+_floating_slack = 86400
+_safe_file_name_re = re.compile(r'^[A-Za-z0-9@._+-]{1,200}$')
+
+class _VdirObject():
+    """
+    Mixin for the caldav object classes, writing to and deleting from
+    the vdir rather than talking to a server.  ``stat`` is the (mtime,
+    size) of the file when it was read, used like an ETag - if the file
+    has been changed by someone else since, saving or deleting it
+    raises an ETagMismatchError.
+    """
+    vdir = None
+    file_name = None
+    stat = None
+
+    def save(self, *largs, **kwargs):
+        self.vdir._write(self)
+        return self
+
+    def delete(self):
+        self.vdir._remove(self)
+
+    def copy(self, keep_uid=False, new_parent=None):
+        obj = self.__class__(data=self.data, id=self.id if keep_uid else str(uuid.uuid4()))
+        obj.vdir = self.vdir
+        if keep_uid:
+            obj.file_name = self.file_name
+            obj.stat = self.stat
+        return obj
+
+class VdirEvent(_VdirObject, caldav.Event):
+    pass
+
+class VdirTodo(_VdirObject, caldav.Todo):
+    pass
+
+class VdirJournal(_VdirObject, caldav.Journal):
+    pass
+
+_object_classes = {'VEVENT': VdirEvent, 'VTODO': VdirTodo, 'VJOURNAL': VdirJournal}
+
+def _index_file_name(cache_dir, path):
+    return os.path.join(cache_dir, 'vdir-%s.json' % hashlib.sha1(path.encode('utf-8')).hexdigest())
+
+def _epoch(value):
+    """
+    Returns (seconds since epoch, floating) for a date or datetime
+    """
+    if not isinstance(value, datetime):
+        return (calendar.timegm(value.timetuple()), True)
+    if value.tzinfo is None:
+        return (calendar.timegm(value.timetuple()), True)
+    return (value.timestamp(), False)
+
+def _index_entry(data):
+    """
+    Extracts the properties kept in the index from the icalendar data.
+    Entries without a 'uid' are for files that couldn't be parsed, and
+    will always be read.
+    """
+    from calendar_cli.tasks import TaskRecord
+    entry = {'component': _component_type(data)}
+    try:
+        comps = [x for x in parse_calendar(data).components() if x.name == entry['component']]
+    except ValueError:
+        return entry
+    if not comps or not hasattr(comps[0], 'uid'):
+        return entry
+    entry['uid'] = comps[0].uid.value
+    floating = False
+    if entry['component'] == 'VEVENT':
+        entry['recurring'] = False
+        (start, end) = (None, None)
+        for comp in comps:
+            if 'rrule' in comp.contents or 'rdate' in comp.contents or 'recurrence-id' in comp.contents:
+                entry['recurring'] = True
+            if not hasattr(comp, 'dtstart'):
+                continue
+            dtstart = comp.dtstart.value
+            if hasattr(comp, 'dtend'):
+                dtend = comp.dtend.value
+            elif hasattr(comp, 'duration'):
+                dtend = dtstart + comp.duration.value
+            else:
+                dtend = dtstart + (timedelta(0) if isinstance(dtstart, datetime) else timedelta(1))
+            (comp_start, start_floating) = _epoch(dtstart)
+            (comp_end, end_floating) = _epoch(dtend)
+            floating = floating or start_floating or end_floating
+            start = comp_start if start is None else min(start, comp_start)
+            end = comp_end if end is None else max(end, comp_end)
+        entry['start'] = start
+        entry['end'] = end
+    elif entry['component'] == 'VTODO':
+        task = TaskRecord(None, None, comps[0])
+        entry['pending'] = task.is_pending()
+        entry['categories'] = list(task.categories)
+        entry['priority'] = task.priority
+        entry['status'] = task.status
+        completed = comps[0].contents.get('completed')
+        entry['completed'] = _epoch(completed[0].value)[0] if completed else None
+        for attr in ('dtstart', 'due'):
+            value = getattr(task, attr + '_value')
+            if value is None:
+                entry[attr] = None
+            else:
+                (entry[attr], is_floating) = _epoch(value)
+                floating = floating or is_floating
+    entry['floating'] = floating
+    return entry
+
+class Vdir():
+    """
+    A vdir, with the same interface as a caldav Calendar for the parts
+    used by calendar-cli (add_event, event_by_uid, todo_by_uid, etc),
+    plus events() and todos() for the index-assisted listings.
+    """
+    def __init__(self, path, cache_dir=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.url = 'file://' + self.path
+        self.index_file_name = _index_file_name(cache_dir or default_cache_dir(), self.path)
+        ## file name -> index entry
+        self.files = None
+        self._uids = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            raise caldav.lib.error.NotFoundError("vdir %s does not exist" % self.path)
+
+    def _load(self):
+        try:
+            with open(self.index_file_name, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.error("vdir index %s is broken, it will be rebuilt" % self.index_file_name)
+            return {}
+        if state.get('path') != self.path:
+            return {}
+        return state.get('files', {})
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_file_name), exist_ok=True)
+        tmp_file_name = "%s.%s.tmp" % (self.index_file_name, os.getpid())
+        with open(tmp_file_name, 'w', encoding='utf-8') as f:
+            json.dump({'path': self.path, 'files': self.files}, f)
+        os.replace(tmp_file_name, self.index_file_name)
+
+    def refresh(self):
+        """
+        Brings the index up to date with the directory, parsing the
+        files that are new or have a different mtime or size than last
+        time.  Done on first use, and again after files have been
+        written or deleted.
+        """
+        if self.files is not None:
+            return
+        files = self._load()
+        modified = False
+        seen = set()
+        with os.scandir(self.path) as entries:
+            for dir_entry in entries:
+                if not dir_entry.name.endswith('.ics') or not dir_entry.is_file():
+                    continue
+                seen.add(dir_entry.name)
+                st = dir_entry.stat()
+                entry = files.get(dir_entry.name)
+                if entry is not None and entry['stat'] == [st.st_mtime_ns, st.st_size]:
+                    continue
+                try:
+                    with open(dir_entry.path, 'r', newline='', encoding='utf-8') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    seen.discard(dir_entry.name)
+                    continue
+                entry = _index_entry(data)
+                entry['stat'] = [st.st_mtime_ns, st.st_size]
+                files[dir_entry.name] = entry
+                modified = True
+        for name in set(files) - seen:
+            del files[name]
+            modified = True
+        self.files = files
+        if modified:
+            self._save()
+
+    def read(self, file_name):
+        """
+        Returns the object stored in the file, or None if it's gone
+        """
+        path = os.path.join(self.path, file_name)
+        try:
+            with open(path, 'r', newline='', encoding='utf-8') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        cls = _object_classes.get(_component_type(data))
+        if cls is None:
+            return None
+        obj = cls(url=path, data=data)
+        obj.vdir = self
+        obj.file_name = file_name
+        obj.stat = (st.st_mtime_ns, st.st_size)
+        return obj
+
+    def versions(self):
+        """
+        Returns a dict from file name to a version string, which changes
+        whenever the file is modified
+        """
+        self.refresh()
+        return {name: "%i:%i" % tuple(entry['stat']) for (name, entry) in self.files.items()}
+
+    def objects(self, comp_name, match=None):
+        """
+        Yields the objects with a component of the given type (VEVENT,
+        VTODO, VJOURNAL), optionally only those whose index entry is
+        accepted by match.  Files that couldn't be indexed are always
+        included.
+        """
+        self.refresh()
+        files = self.files
+        for file_name in sorted(files):
+            entry = files[file_name]
+            if entry['component'] != comp_name:
+                continue
+            if match is not None and 'uid' in entry and not match(entry):
+                continue
+            obj = self.read(file_name)
+            if obj is not None:
+                yield obj
+
+    def events(self, search_dtstart, search_dtend):
+        """
+        Yields the events that may overlap the interval.  Recurring
+        events are always included, as they need to be expanded.
+        """
+        start = search_dtstart.timestamp()
+        end = search_dtend.timestamp()
+        def match(entry):
+            if entry['recurring']:
+                return True
+            if entry['start'] is None:
+                return False
+            slack = _floating_slack if entry['floating'] else 0
+            return entry['start'] - slack < end and entry['end'] + slack >= start
+        return self.objects('VEVENT', match)
+
+    def todos(self, uid=None, category=None, due_before=None):
+        """
+        Yields the task with the given uid, or the pending tasks
+        (optionally only those with the given category and/or a due
+        timestamp before due_before, a datetime)
+        """
+        due_before = due_before and due_before.timestamp()
+        def match(entry):
+            if uid is not None:
+                return entry['uid'] == uid
+            if not entry['pending']:
+                return False
+            if category is not None and not category in entry['categories']:
+                return False
+            if due_before is not None:
+                slack = _floating_slack if entry['floating'] else 0
+                return entry['due'] is not None and entry['due'] - slack < due_before
+            return True
+        return self.objects('VTODO', match)
+
+    def _by_uid(self, uid, comp_name):
+        for obj in self.objects(comp_name, lambda x: x['uid'] == uid):
+            if obj.id == uid:
+                return obj
+        raise caldav.lib.error.NotFoundError("no object with uid %s in %s" % (uid, self.path))
+
+    def event_by_uid(self, uid):
+        return self._by_uid(uid, 'VEVENT')
+
+    def todo_by_uid(self, uid):
+        return self._by_uid(uid, 'VTODO')
+
+    def event_by_url(self, url):
+        obj = self.read(os.path.basename(str(url)))
+        if obj is None:
+            raise caldav.lib.error.NotFoundError("%s not found in %s" % (url, self.path))
+        return obj
+
+    def add_event(self, ics):
+        """
+        Stores the calendar object (of any type, not only events),
+        replacing any existing object with the same UID
+        """
+        (uid, ics) = next(split_calendar(io.StringIO(ics)))
+        obj = _object_classes[_component_type(ics)](data=ics)
+        obj.vdir = self
+        with self._lock:
+            if self._uids is None:
+                self.refresh()
+                self._uids = {x['uid']: name for (name, x) in self.files.items() if 'uid' in x}
+            obj.file_name = self._uids.get(uid)
+            if obj.file_name is None:
+                obj.file_name = uid + '.ics'
+                if not _safe_file_name_re.match(uid) or os.path.exists(os.path.join(self.path, obj.file_name)):
+                    obj.file_name = str(uuid.uuid4()) + '.ics'
+                self._uids[uid] = obj.file_name
+        obj.save()
+        return obj
+
+    def _check_unchanged(self, obj, path):
+        if obj.stat is None:
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is None or (st.st_mtime_ns, st.st_size) != tuple(obj.stat):
+            raise caldav.lib.error.ETagMismatchError("%s has been modified since it was read" % path)
+
+    def _write(self, obj):
+        if obj.file_name is None:
+            obj.file_name = str(uuid.uuid4()) + '.ics'
+        path = os.path.join(self.path, obj.file_name)
+        data = obj.data
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        with self._lock:
+            self._check_unchanged(obj, path)
+            tmp_path = os.path.join(self.path, '.%s.%s.tmp' % (obj.file_name, os.getpid()))
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            st = os.stat(path)
+            obj.stat = (st.st_mtime_ns, st.st_size)
+            obj.url = path
+            ## picked up by the next refresh
+            self.files = None
+
+    def _remove(self, obj):
+        path = os.path.join(self.path, obj.file_name)
+        with self._lock:
+            self._check_unchanged(obj, path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.files = None
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""Benchmarks for calendar-cli, run against generated calendars.
+
+For each size given, a calendar is generated with SIZE objects, half of
+them events (some recurring, in different time zones) and half of them
+tasks (with categories, priorities, due dates and parent/child
+relations), and the main read commands are run against it.
+
+Each command is run in a separate process, like a user would run it.
+The latency (wall clock time), the throughput (objects in the calendar
+per second) and the peak memory usage (max RSS) of each run are
+recorded.
+
+By default, a Radicale server is started with its storage in a
+temporary directory, and the generated objects are written directly
+into the storage.  With --upload, the calendar is rather populated
+through `calendar addics`, and the upload is timed as well.  --url may
+be given to run the benchmarks against some other (local!) server
+instead - a calendar is created for each size, populated through
+`calendar addics`, and deleted afterwards.
+
+The results may be stored with --json and compared with an earlier run
+through --baseline, for measuring the effect of a change:
+
+    python tests/benchmark.py --sizes 1000,10000 --json before.json
+    (... make the change ...)
+    python tests/benchmark.py --sizes 1000,10000 --baseline before.json
+
+Even with the storage populated directly, listing 100000 objects takes
+a long while, hence the default is only 1000.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+## The (name, arguments) of the commands to benchmark, after the
+## calendar has been populated.  {category} is replaced by a category
+## used by roughly 1/20 of the tasks.
+commands = [
+    ('todo list', ['todo', 'list']),
+    ('todo list --categories', ['todo', '--categories', '{category}', 'list']),
+    ('todo list --overdue --hide-parents', ['todo', '--overdue', '--hide-parents', 'list']),
+    ('todo tree', ['todo', 'tree']),
+    ('calendar agenda 30d', ['calendar', 'agenda', '--agenda-days', '30']),
+    ('calendar agenda 30d --sync-cache', ['--sync-cache', 'calendar', 'agenda', '--agenda-days', '30']),
+    ('todo list --sync-cache', ['--sync-cache', 'todo', 'list']),
+]
+
+## tzid -> (standard offset, daylight offset, names, and the rules for
+## the start of the standard and daylight saving time)
+_timezones = {
+    'Europe/Oslo': ('+0100', '+0200', 'CET', 'CEST',
+                    ('19701025T030000', 'BYMONTH=10;BYDAY=-1SU'), ('19700329T020000', 'BYMONTH=3;BYDAY=-1SU')),
+    'America/New_York': ('-0500', '-0400', 'EST', 'EDT',
+                         ('19701101T020000', 'BYMONTH=11;BYDAY=1SU'), ('19700308T020000', 'BYMONTH=3;BYDAY=2SU')),
+}
+
+def _vtimezone(tzid, std_offset, dst_offset, std_name, dst_name, std_rule, dst_rule):
+    return "\r\n".join([
+        "BEGIN:VTIMEZONE", "TZID:%s" % tzid,
+        "BEGIN:STANDARD", "DTSTART:%s" % std_rule[0], "RRULE:FREQ=YEARLY;%s" % std_rule[1],
+        "TZNAME:%s" % std_name, "TZOFFSETFROM:%s" % dst_offset, "TZOFFSETTO:%s" % std_offset, "END:STANDARD",
+        "BEGIN:DAYLIGHT", "DTSTART:%s" % dst_rule[0], "RRULE:FREQ=YEARLY;%s" % dst_rule[1],
+        "TZNAME:%s" % dst_name, "TZOFFSETFROM:%s" % std_offset, "TZOFFSETTO:%s" % dst_offset, "END:DAYLIGHT",
+        "END:VTIMEZONE"])
+
+def _timestamp(ts, tzid=None):
+    if tzid is None:
+        return ":" + ts.strftime("%Y%m%dT%H%M%SZ")
+    return ";TZID=%s:%s" % (tzid, ts.strftime("%Y%m%dT%H%M%S"))
+
+def generate(size, seed=0, today=None):
+    """
+    Returns the icalendar data for a calendar with size objects, half
+    of them events and half of them tasks.  The data is the same for
+    the same seed and date.
+    """
+    rnd = random.Random(seed)
+    today = today or date.today()
+    midnight = datetime(today.year, today.month, today.day, tzinfo=timezone.utc)
+    out = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//calendar-cli//benchmark//EN"]
+    out.extend(_vtimezone(tzid, *x) for (tzid, x) in _timezones.items())
+    stamp = "DTSTAMP:20240101T000000Z"
+    tzids = [None] + list(_timezones)
+
+    for i in range(size//2):
+        start = midnight + timedelta(days=rnd.randint(-180, 180), hours=rnd.randint(7, 20))
+        lines = ["BEGIN:VEVENT", "UID:event-%i@benchmark" % i, stamp, "SUMMARY:event %i" % i]
+        if i % 7 == 0:
+            lines.append("DTSTART;VALUE=DATE:%s" % start.strftime("%Y%m%d"))
+        else:
+            tzid = tzids[i % len(tzids)]
+            lines.append("DTSTART" + _timestamp(start, tzid))
+            lines.append("DTEND" + _timestamp(start + timedelta(minutes=rnd.choice((30, 60, 90))), tzid))
+        if i % 10 == 0:
+            lines.append("RRULE:FREQ=WEEKLY;COUNT=20")
+        if i % 3 == 0:
+            lines.append("LOCATION:room %i" % rnd.randint(1, 50))
+        lines.append("END:VEVENT")
+        out.extend(lines)
+
+    for i in range(size//2):
+        due = midnight + timedelta(days=rnd.randint(-60, 120), hours=rnd.randint(8, 17))
+        lines = ["BEGIN:VTODO", "UID:task-%i@benchmark" % i, stamp, "SUMMARY:task %i" % i,
+                 "DTSTART" + _timestamp(due - timedelta(days=rnd.randint(0, 30))),
+                 "DUE" + _timestamp(due), "PRIORITY:%i" % rnd.randint(0, 9),
+                 "CATEGORIES:cat%i,%s" % (rnd.randint(0, 19), rnd.choice(("work", "home")))]
+        if i % 4 == 0:
+            lines.append("LOCATION:place %i" % rnd.randint(1, 20))
+        ## groups of five tasks: one parent with four children.  Some
+        ## of the children have a second parent
+        if i % 5:
+            lines.append("RELATED-TO;RELTYPE=PARENT:task-%i@benchmark" % (i - i % 5))
+            if i % 5 == 4 and i >= 5:
+                lines.append("RELATED-TO;RELTYPE=PARENT:task-%i@benchmark" % (i - 5))
+        if i % 10 == 9:
+            lines.extend(["STATUS:COMPLETED", "COMPLETED:20240101T000000Z"])
+        else:
+            lines.append("STATUS:NEEDS-ACTION")
+        lines.append("END:VTODO")
+        out.extend(lines)
+    out.append("END:VCALENDAR")
+    return "\r\n".join(out) + "\r\n"
+
+def start_radicale(storage):
+    """
+    Starts a Radicale server as a separate process, on a free port.
+    Returns (url, stop function).  (Running it in a thread in this
+    process makes it several times slower, as it then competes for the
+    GIL with the benchmark driver.)
+    """
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'radicale', '--storage-filesystem-folder', storage,
+         '--server-hosts', 'localhost:%i' % port, '--auth-type', 'none', '--logging-level', 'warning'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://localhost:%i/' % port
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            break
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("could not start radicale (is it installed?)")
+            time.sleep(0.05)
+    def stop():
+        server.terminate()
+        server.wait(5)
+    return (url, stop)
+
+def run(argv, options, cache_dir):
+    """
+    Runs calendar-cli with the given arguments in a separate process.
+    Returns (seconds, peak rss in MB, lines of output).
+    """
+    cmd = [sys.executable, os.path.join(repo_root, 'bin', 'calendar-cli.py'),
+           '--config-file', os.path.join(cache_dir, 'no-config'),
+           '--cache-dir', cache_dir,
+           '--caldav-url', options.url, '--caldav-user', options.user, '--caldav-pass', options.password,
+           '--calendar-url', options.calendar_url] + argv
+    env = dict(os.environ, PYTHONPATH=repo_root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        started = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env)
+        ## wait4 rather than wait, for getting the resource usage of
+        ## this particular process
+        (_, status, rusage) = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - started
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        if proc.returncode:
+            raise RuntimeError("%s failed:\n%s" % (' '.join(argv), stderr.read().decode('utf-8', 'replace')))
+        lines = stdout.read().count(b"\n")
+    ## ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    rss = rusage.ru_maxrss / (1024*1024 if sys.platform == 'darwin' else 1024)
+    return (seconds, rss, lines)
+
+def _result(name, size, runs):
+    seconds = [x[0] for x in runs]
+    median = statistics.median(seconds)
+    return {
+        'command': name,
+        'size': size,
+        'runs': len(runs),
+        'min_seconds': min(seconds),
+        'median_seconds': median,
+        'objects_per_second': size / median if median else None,
+        'peak_rss_mb': max(x[1] for x in runs),
+        'output_lines': runs[-1][2],
+    }
+
+def _populate_storage(storage, calendar, ics_file):
+    """
+    Writes the objects directly into the storage folder of the Radicale
+    server started by start_radicale.  Radicale searches through the
+    whole collection for the UID on every upload, so populating big
+    calendars through the caldav protocol takes ages.
+    """
+    from urllib.parse import urlparse
+    from calendar_cli.ics import split_calendar
+    folder = os.path.join(storage, 'collection-root', urlparse(str(calendar.url)).path.strip('/'))
+    with open(ics_file, 'r') as f:
+        for (uid, ics) in split_calendar(f):
+            with open(os.path.join(folder, uid + '.ics'), 'w', newline='') as out:
+                out.write(ics)
+
+def benchmark_size(size, options):
+    """
+    Creates a calendar with generated data of the given size, runs all
+    the benchmarks against it, and deletes it.  Returns a list of
+    result dicts.
+    """
+    import caldav
+    client = caldav.DAVClient(url=options.url, username=options.user, password=options.password)
+    cal_id = 'calendar-cli-benchmark-%i-%s' % (size, uuid.uuid4().hex[:8])
+    calendar = client.principal().make_calendar(cal_id=cal_id)
+    options.calendar_url = str(calendar.url)
+    work_dir = tempfile.mkdtemp(prefix='calendar-cli-benchmark-')
+    results = []
+    try:
+        ics_file = os.path.join(work_dir, 'calendar.ics')
+        with open(ics_file, 'w') as f:
+            f.write(generate(size, options.seed))
+
+        if options.storage and not options.upload:
+            _populate_storage(options.storage, calendar, ics_file)
+        else:
+            ## the upload is done only once, as it populates the calendar
+            runs = [run(['calendar', 'addics', '--jobs', str(options.jobs), '--file', ics_file], options, work_dir)]
+            results.append(_result('calendar addics --jobs %i' % options.jobs, size, runs))
+            _report(results[-1], options)
+
+        ## Radicale builds its item cache on the first read - that's
+        ## not what we're measuring
+        run(['todo', 'list'], options, work_dir)
+
+        for (name, argv) in commands:
+            argv = [x.format(category='cat3') for x in argv]
+            if '--sync-cache' in argv:
+                ## the first run fills the cache - the benchmark is
+                ## for the runs where the cache is up to date
+                run(argv, options, work_dir)
+            runs = [run(argv, options, work_dir) for _ in range(options.repeat)]
+            results.append(_result(name, size, runs))
+            _report(results[-1], options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not options.keep:
+            calendar.delete()
+    return results
+
+def _report(result, options):
+    line = "%7i  %-36s %9.3f s %9.0f obj/s %8.1f MB" % (
+        result['size'], result['command'], result['median_seconds'],
+        result['objects_per_second'] or 0, result['peak_rss_mb'])
+    baseline = options.baseline_results.get((result['command'], result['size']))
+    if baseline:
+        line += "  %+6.1f%% time %+6.1f%% memory" % (
+            100.0 * (result['median_seconds'] / baseline['median_seconds'] - 1),
+            100.0 * (result['peak_rss_mb'] / baseline['peak_rss_mb'] - 1))
+    print(line)
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', help="Comma separated list of calendar sizes (number of objects), i.e. 1000,10000,100000", default='1000')
+    parser.add_argument('--repeat', help="Number of times to run each command", type=int, default=3)
+    parser.add_argument('--upload', help="Populate the calendar through calendar addics, and time it.  Always done with --url.  Slow, as Radicale uploads are linear in the calendar size", action='store_true')
+    parser.add_argument('--jobs', help="--jobs for calendar addics", type=int, default=8)
+    parser.add_argument('--seed', help="Random seed for the generated data", type=int, default=0)
+    parser.add_argument('--url', help="Run towards this caldav server rather than starting a local Radicale subprocess")
+    parser.add_argument('--user', default='benchmark')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--keep', help="Don't delete the calendars when done", action='store_true')
+    parser.add_argument('--json', help="Write the results to this file", metavar='FILE')
+    parser.add_argument('--baseline', help="Compare with the results in this file, from an earlier --json run", metavar='FILE')
+    options = parser.parse_args()
+
+    options.baseline_results = {}
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            options.baseline_results = {(x['command'], x['size']): x for x in json.load(f)['results']}
+
+    stop = None
+    options.storage = None
+    if not options.url:
+        options.storage = tempfile.mkdtemp(prefix='calendar-cli-benchmark-radicale-')
+        (options.url, stop) = start_radicale(options.storage)
+    results = []
+    try:
+        print("   size  command                                 latency     throughput     peak RSS")
+        for size in [int(x) for x in options.sizes.split(',')]:
+            results.extend(benchmark_size(size, options))
+    finally:
+        if stop:
+            stop()
+            shutil.rmtree(options.storage, ignore_errors=True)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'date': datetime.now().isoformat(), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
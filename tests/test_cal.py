@@ -2,8 +2,21 @@ import pytest
 import sys
 sys.path.insert(0,'.')
 sys.path.insert(1,'..')
-from datetime import datetime, date
+from datetime import datetime, date, timezone
+from argparse import Namespace
 from calendar_cli.template import Template
+from icalendar import Calendar
+from calendar_cli.cache import SyncCache, DiscoveryCache
+from calendar_cli.legacy import _expand_locally, _config_sections, _todo_bulk, main
+import json
+from calendar_cli.query import todo_filters, todo_query, pending_filters
+from calendar_cli.bulk import run_concurrently, BulkReport
+from calendar_cli.ics import split_calendar, unfolded_lines, parse_calendar, scan_properties
+from calendar_cli.tasks import TaskRecord, TaskGraph
+from calendar_cli.profile import Profile
+from calendar_cli.vdir import Vdir
+from calendar_cli.search import SearchIndex
+from calendar_cli.transport import AdaptiveLimit, configure, concurrency_limit
 
 """calendar-cli is a command line utility, and it's an explicit design
 goal that it should contain minimal logic except for parsing and
@@ -61,3 +74,820 @@ class TestTemplate:
         assert text == "Date is maybe 1990-10-10"
         text = template.format()
         assert text == "Date is maybe bar"
+
+    def test_fields_are_known_after_compiling(self):
+        template = Template("{dtstart:%F} {summary!r} {instance.uid.value} {date:?{foo:?bar?}?%F}")
+        assert template.fields == {'dtstart', 'summary', 'instance', 'date', 'foo'}
+        text = template.format_map({'dtstart': self.date, 'summary': 'hello'})
+        assert text == "1990-10-10 'hello'  bar"
+
+    def test_lookups(self):
+        template = Template("{0} {x.year} {d[key]} {l[1]:>3} {0.year}")
+        assert template.fields == {'x', 'd', 'l'}
+        assert template.format(self.date, x=self.date, d={'key': 'v'}, l=['a', 'b']) == "1990-10-10 1990 v   b 1990"
+        with pytest.raises(ValueError):
+            Template("{x[unclosed}")
+
+class TestSyncCache:
+    def test_save_and_load(self, tmp_path):
+        cache = SyncCache(str(tmp_path), 'default', 'http://example.com/cal/')
+        assert not cache.objects
+        cache.ctag = 'ctag1'
+        cache.objects['/cal/foo.ics'] = {'etag': '"1"', 'data': 'BEGIN:VCALENDAR'}
+        cache.modified = True
+        cache.save()
+
+        cache = SyncCache(str(tmp_path), 'default', 'http://example.com/cal/')
+        assert cache.ctag == 'ctag1'
+        assert cache.objects['/cal/foo.ics']['etag'] == '"1"'
+
+        ## cache is keyed by config section and calendar url
+        cache = SyncCache(str(tmp_path), 'work', 'http://example.com/cal/')
+        assert not cache.objects
+        cache = SyncCache(str(tmp_path), 'default', 'http://example.com/cal2/')
+        assert not cache.objects
+
+class TestDiscoveryCache:
+    def test_ttl_and_invalidation(self, tmp_path):
+        cache = DiscoveryCache(str(tmp_path))
+        assert cache.get('default', 'http://example.com/', 'luser', 3600) is None
+        cache.set('default', 'http://example.com/', 'luser', {'principal_url': 'http://example.com/luser/', 'calendars': []})
+
+        cache = DiscoveryCache(str(tmp_path))
+        assert cache.get('default', 'http://example.com/', 'luser', 3600)['principal_url'] == 'http://example.com/luser/'
+        ## changed server or user in the config
+        assert cache.get('default', 'http://example.org/', 'luser', 3600) is None
+        assert cache.get('default', 'http://example.com/', 'luser2', 3600) is None
+        ## expired
+        assert cache.get('default', 'http://example.com/', 'luser', -1) is None
+
+        cache.invalidate('default')
+        assert DiscoveryCache(str(tmp_path)).get('default', 'http://example.com/', 'luser', 3600) is None
+
+    def test_concurrent_sections(self, tmp_path, caplog):
+        import threading
+        errors = []
+        def worker(section):
+            try:
+                for i in range(50):
+                    DiscoveryCache(str(tmp_path)).set(section, 'http://example.com/', 'luser', {'principal_url': section, 'calendars': []})
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=('section%i' % i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert not 'broken' in caplog.text
+        ## the updates from the other sections are merged, not overwritten
+        cache = DiscoveryCache(str(tmp_path))
+        assert [cache.get('section%i' % i, 'http://example.com/', 'luser', 3600)['principal_url'] for i in range(4)] == ['section%i' % i for i in range(4)]
+        assert [x.name for x in tmp_path.iterdir()] == ['discovery.json']
+
+    @pytest.mark.parametrize('calendar_url', [None, 'work'])
+    def test_stale_calendar(self, monkeypatch, calendar_url):
+        import caldav.lib.error
+        import calendar_cli.legacy
+        from calendar_cli.legacy import run_command
+        monkeypatch.setattr(calendar_cli.legacy, '_stale_discovery', lambda *largs: True)
+        calls = []
+        def func(caldav_conn, args):
+            calls.append(args.calendar_url)
+            if len(calls) == 1:
+                raise caldav.lib.error.NotFoundError("gone")
+        args = Namespace(file_pass=None, nocaldav=True, vdir=None, ssl_verify_cert='yes', calendar_url=calendar_url)
+        if calendar_url:
+            ## the calendar is looked up again by its name
+            run_command(args, func=func)
+            assert calls == [calendar_url, calendar_url]
+        else:
+            with pytest.raises(caldav.lib.error.NotFoundError, match='disappeared'):
+                run_command(args, func=func)
+            assert calls == [None]
+
+recurring_event = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//tobixen//calendar-cli tests//EN
+BEGIN:VEVENT
+UID:rec1
+DTSTART:20101001T100000Z
+DTEND:20101001T110000Z
+RRULE:FREQ=DAILY;COUNT=20
+EXDATE:20101011T100000Z
+SUMMARY:recurring
+END:VEVENT
+BEGIN:VEVENT
+UID:rec1
+RECURRENCE-ID:20101010T100000Z
+DTSTART:20101010T150000Z
+DTEND:20101010T160000Z
+SUMMARY:moved
+END:VEVENT
+END:VCALENDAR
+"""
+
+class TestLocalExpansion:
+    def test_expand_with_override_and_exdate(self):
+        import caldav
+        event = caldav.Event(data=recurring_event)
+        args = Namespace(timezone='UTC')
+        instances = _expand_locally([event], datetime(2010, 10, 9, tzinfo=timezone.utc), datetime(2010, 10, 13, tzinfo=timezone.utc), args)
+        found = sorted((x.instance.vevent.dtstart.value, x.instance.vevent.summary.value) for x in instances)
+        assert [(x.day, x.hour, summary) for (x, summary) in found] == [
+            (9, 10, 'recurring'), (10, 15, 'moved'), (12, 10, 'recurring')]
+
+class TestTodoQuery:
+    def _args(self, **kwargs):
+        args = Namespace(categories=None, nocategories=False, location=None, nolocation=False, overdue=False, hide_future=False)
+        for key in kwargs:
+            setattr(args, key, kwargs[key])
+        return args
+
+    def _filter_names(self, filters):
+        return [(x.attributes['name'], x.children[0].tag.split('}')[1]) for x in filters]
+
+    def test_nothing_to_push_down(self):
+        assert todo_filters(self._args(), datetime.now(timezone.utc), ['categories', 'location']) == []
+
+    def test_text_filters(self):
+        alternatives = todo_filters(self._args(categories='scripttest', nolocation=True), datetime.now(timezone.utc), ['categories', 'location'])
+        assert len(alternatives) == 1
+        assert self._filter_names(alternatives[0]) == [
+            ('CATEGORIES', 'text-match'), ('LOCATION', 'is-not-defined'), ('COMPLETED', 'is-not-defined')]
+        assert b'scripttest' in todo_query(alternatives[0]).xmlelement().xpath('string()').encode('utf-8')
+
+    def test_hide_future_gives_two_queries(self):
+        alternatives = todo_filters(self._args(hide_future=True, overdue=True), datetime.now(timezone.utc), ['categories'])
+        assert len(alternatives) == 2
+        assert self._filter_names(alternatives[0])[-1] == ('DTSTART', 'time-range')
+        assert self._filter_names(alternatives[1])[-1] == ('DTSTART', 'is-not-defined')
+        assert ('DUE', 'time-range') in self._filter_names(alternatives[1])
+
+    def test_property_subset(self):
+        caldav_ns = '{urn:ietf:params:xml:ns:caldav}'
+        xml = todo_query(pending_filters()[0], {'UID', 'DUE'}).xmlelement()
+        assert sorted(x.get('name') for x in xml.iter(caldav_ns + 'prop')) == ['DUE', 'UID', 'VERSION']
+        assert 'VTIMEZONE' in [x.get('name') for x in xml.iter(caldav_ns + 'comp')]
+        assert not list(todo_query([]).xmlelement().iter(caldav_ns + 'comp'))
+
+class TestBatch:
+    def test_batch_status(self, tmp_path, monkeypatch, capsys):
+        batch_file = tmp_path / 'batch'
+        status_file = tmp_path / 'status'
+        batch_file.write_text("""# comment line
+calendar add '2010-10-09 20:00:00+2h' 'testing testing'
+
+todo bogus
+calendar add 'unbalanced quote
+calendar add '2010-10-10 20:00:00+1h' 'testing again'
+""")
+        monkeypatch.setattr(sys, 'argv', ['calendar-cli', '--config-file', str(tmp_path / 'nonexistent'), '--nocaldav', '--icalendar', '--batch', str(batch_file), '--batch-status', str(status_file)])
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 1
+        status = [json.loads(x) for x in status_file.read_text().split("\n") if x]
+        assert [(x['line'], x['status']) for x in status] == [(2, 0), (4, 2), (5, 1), (6, 0)]
+        assert status[0]['argv'] == ['calendar', 'add', '2010-10-09 20:00:00+2h', 'testing testing']
+        assert status[2]['argv'] is None and 'quotation' in status[2]['error']
+        out = capsys.readouterr().out
+        assert 'SUMMARY:testing testing' in out
+        assert 'SUMMARY:testing again' in out
+
+class TestBulk:
+    def test_run_concurrently(self):
+        def func(x):
+            if x == 3:
+                raise ValueError("three")
+        results = dict(run_concurrently(iter(range(10)), func, 4))
+        assert sorted(results) == list(range(10))
+        assert isinstance(results[3], ValueError)
+        assert all(results[x] is None for x in results if x != 3)
+
+    def test_resume_from_progress_file(self, tmp_path):
+        progress_file = str(tmp_path / 'progress')
+        report = BulkReport(progress_file)
+        report.record('uid1', 'ok')
+        report.record('uid2', 'failed', ValueError("oops"))
+        report.close()
+        assert report.failed() == 1
+
+        report = BulkReport(progress_file)
+        assert report.skip('uid1')
+        assert not report.skip('uid2')
+        report.record('uid2', 'ok')
+        report.close()
+        assert not report.failed()
+        assert BulkReport(progress_file).done == {'uid1', 'uid2'}
+
+    def test_todo_bulk_reports_conflicts(self, monkeypatch, capsys):
+        import caldav.lib.error
+        from calendar_cli import legacy
+        records = [Namespace(uid=x, task=x) for x in ('ok1', 'conflict', 'ok2', 'broken')]
+        monkeypatch.setattr(legacy, 'todo_select', lambda caldav_conn, args: records)
+        def update(task):
+            if task == 'conflict':
+                raise caldav.lib.error.ETagMismatchError("412 Precondition Failed")
+            if task == 'broken':
+                raise caldav.lib.error.PutError("500 Internal Server Error")
+        with pytest.raises(SystemExit):
+            _todo_bulk(None, Namespace(jobs=3), update)
+        assert capsys.readouterr().err.endswith("conflict: 1, failed: 1, ok: 2\n")
+
+class TestIcsSplitter:
+    ics = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example//Test//EN
+BEGIN:VTIMEZONE
+TZID:Europe/Oslo
+BEGIN:STANDARD
+DTSTART:19701025T030000
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+END:STANDARD
+END:VTIMEZONE
+BEGIN:VEVENT
+UID:recurring
+DTSTART;TZID=Europe/Oslo:20240102T100000
+RRULE:FREQ=DAILY
+SUMMARY:a summary folded over
+  two lines
+BEGIN:VALARM
+UID:not-the-event-uid
+ACTION:DISPLAY
+TRIGGER:-PT5M
+END:VALARM
+END:VEVENT
+BEGIN:VTIMEZONE
+TZID:America/New_York
+BEGIN:STANDARD
+DTSTART:19701101T020000
+TZOFFSETFROM:-0400
+TZOFFSETTO:-0500
+END:STANDARD
+END:VTIMEZONE
+BEGIN:VEVENT
+UID:single
+DTSTART:20240102T100000Z
+SUMMARY:single
+END:VEVENT
+BEGIN:VEVENT
+UID:recurring
+RECURRENCE-ID;TZID=Europe/Oslo:20240103T100000
+DTSTART;TZID=Europe/Oslo:20240103T110000
+SUMMARY:moved
+END:VEVENT
+END:VCALENDAR
+"""
+
+    def test_unfolding(self):
+        lines = list(unfolded_lines(["SUMMARY:foo\r\n", " bar\r\n", "\tbaz\r\n", "UID:x\r\n"]))
+        assert lines == [("SUMMARY:foobarbaz", "SUMMARY:foo\r\n bar\r\n\tbaz"), ("UID:x", "UID:x")]
+
+    def test_split_seekable(self):
+        import io
+        objects = dict(split_calendar(io.StringIO(self.ics)))
+        assert sorted(objects) == ['recurring', 'single']
+        for uid in objects:
+            cal = Calendar.from_ical(objects[uid])
+            assert {str(x['UID']) for x in cal.subcomponents if x.name == 'VEVENT'} == {uid}
+        assert objects['recurring'].count('BEGIN:VEVENT') == 2
+        ## only the time zones referenced should be included
+        assert objects['recurring'].count('BEGIN:VTIMEZONE') == 1
+        assert 'TZID:Europe/Oslo' in objects['recurring']
+        assert not 'VTIMEZONE' in objects['single']
+        assert 'folded over\r\n  two lines' in objects['recurring']
+
+    def test_split_stream(self):
+        ## Without the possibility to seek, components with the same
+        ## UID are assumed to be adjacent
+        objects = split_calendar(iter(self.ics.split("\n")))
+        assert next(objects)[0] == 'recurring'
+        with pytest.raises(ValueError):
+            next(objects)
+
+    def test_parse_calendar(self):
+        cal = parse_calendar(self.ics.replace("SUMMARY:single", "SUMMARY:single\\, escaped\nCATEGORIES:a\\,b,c"))
+        (event, single, moved) = [x for x in cal.components() if x.name == 'VEVENT']
+        assert event.summary.value == 'a summary folded over two lines'
+        assert event.dtstart.value.isoformat() == '2024-01-02T10:00:00+01:00'
+        assert event.rrule.value == 'FREQ=DAILY'
+        assert event.valarm.trigger.value == '-PT5M'
+        assert single.dtstart.value == datetime(2024, 1, 2, 10, 0, tzinfo=timezone.utc)
+        assert single.summary.value == 'single, escaped'
+        assert single.categories.value == ['a,b', 'c']
+        assert moved.recurrence_id.params == {'TZID': ['Europe/Oslo']}
+        assert not hasattr(single, 'rrule')
+        with pytest.raises(ValueError):
+            parse_calendar(self.ics.replace('Europe/Oslo', 'Nowhere/Special'))
+
+class TestOffline:
+    todos = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example//Test//EN
+BEGIN:VTODO
+UID:done
+SUMMARY:done already
+STATUS:COMPLETED
+END:VTODO
+BEGIN:VTODO
+UID:later
+SUMMARY:later
+DUE:20300101T100000Z
+CATEGORIES:home
+END:VTODO
+BEGIN:VTODO
+UID:soon
+SUMMARY:soon
+DUE:20200101T100000Z
+CATEGORIES:work
+END:VTODO
+END:VCALENDAR
+"""
+
+    def run(self, tmp_path, monkeypatch, capsys, ics, argv):
+        ics_file = tmp_path / 'input.ics'
+        ics_file.write_text(ics)
+        monkeypatch.setattr(sys, 'argv', ['calendar-cli', '--config-file', str(tmp_path / 'nonexistent'), '--nocaldav', '--icalendar', '--icalendar-file', str(ics_file), '--timezone', 'UTC'] + argv)
+        main()
+        return capsys.readouterr().out.split("\n")[:-1]
+
+    def test_agenda(self, tmp_path, monkeypatch, capsys):
+        out = self.run(tmp_path, monkeypatch, capsys, TestIcsSplitter.ics, ['calendar', 'agenda', '--from-time', '2024-01-02 08:00', '--agenda-days', '3', '--event-template', '{dtstart} {summary}', '--timestamp-format', '%F %H:%M'])
+        assert out == ['2024-01-02 09:00 a summary folded over two lines', '2024-01-02 10:00 single', '2024-01-03 10:00 moved', '2024-01-04 09:00 a summary folded over two lines']
+
+    def test_todo_list(self, tmp_path, monkeypatch, capsys):
+        assert self.run(tmp_path, monkeypatch, capsys, self.todos, ['todo', 'list', '--todo-template', '{summary}']) == ['soon', 'later']
+        assert self.run(tmp_path, monkeypatch, capsys, self.todos, ['todo', '--categories', 'home', 'list', '--todo-template', '{summary}']) == ['later']
+
+    def test_jsonl(self, tmp_path, monkeypatch, capsys):
+        out = [json.loads(x) for x in self.run(tmp_path, monkeypatch, capsys, self.todos, ['todo', 'list', '--format', 'jsonl'])]
+        assert [(x['uid'], x['due'], x['categories']) for x in out] == [('soon', '2020-01-01T10:00:00+00:00', ['work']), ('later', '2030-01-01T10:00:00+00:00', ['home'])]
+        out = self.run(tmp_path, monkeypatch, capsys, self.todos, ['todo', '--limit', '1', 'list', '--format', 'jsonl', '--no-sort'])
+        assert [json.loads(x)['uid'] for x in out] == ['later']
+        out = self.run(tmp_path, monkeypatch, capsys, TestIcsSplitter.ics, ['calendar', 'agenda', '--from-time', '2024-01-02 08:00', '--agenda-days', '1', '--format', 'jsonl'])
+        assert [(x['type'], x['summary'], x['dtstart'], x['all_day']) for x in map(json.loads, out)] == [('event', 'a summary folded over two lines', '2024-01-02T10:00:00+01:00', False), ('event', 'single', '2024-01-02T10:00:00+00:00', False)]
+
+    def test_todo_tree(self, tmp_path, monkeypatch, capsys):
+        ## the tree subcommand has no --expand option
+        assert self.run(tmp_path, monkeypatch, capsys, self.todos, ['todo', 'tree', '--todo-template', '{summary}']) == ['soon', 'later']
+
+    def test_todo_tree_indent(self, tmp_path, monkeypatch, capsys):
+        ics = self.todos.replace("END:VCALENDAR", """BEGIN:VTODO
+UID:parent
+SUMMARY:parent
+RELATED-TO;RELTYPE=CHILD:child
+END:VTODO
+BEGIN:VTODO
+UID:child
+SUMMARY:child
+END:VTODO
+BEGIN:VTODO
+UID:grandchild
+SUMMARY:grandchild
+RELATED-TO;RELTYPE=PARENT:child
+END:VTODO
+END:VCALENDAR""")
+        out = self.run(tmp_path, monkeypatch, capsys, ics, ['todo', 'tree', '--todo-template', '{summary}', '--indent', '  '])
+        assert out[out.index('parent'):out.index('parent')+3] == ['parent', '  child', '    grandchild']
+        out = self.run(tmp_path, monkeypatch, capsys, ics, ['todo', '--descendants-of', 'parent', 'tree', '--todo-template', '{summary}', '--indent', '  '])
+        assert out == ['child', '  grandchild']
+
+    def test_expand_keeps_overdue_occurrence(self, tmp_path, monkeypatch, capsys):
+        import calendar_cli.legacy
+        monkeypatch.setattr(calendar_cli.legacy, '_now', lambda: datetime(2024, 1, 10, 12, tzinfo=timezone.utc))
+        ics = self.todos.replace("END:VCALENDAR", "BEGIN:VTODO\nUID:weekly\nSUMMARY:weekly\nDTSTART:20240108T090000Z\nDUE:20240108T100000Z\nRRULE:FREQ=WEEKLY\nEND:VTODO\nEND:VCALENDAR")
+        out = [json.loads(x) for x in self.run(tmp_path, monkeypatch, capsys, ics, ['todo', 'list', '--expand', '14', '--format', 'jsonl'])]
+        assert [(x['uid'], x['due']) for x in out if x['uid'] == 'weekly'] == [
+            ('weekly', '2024-01-08T10:00:00+00:00'), ('weekly', '2024-01-15T10:00:00+00:00'), ('weekly', '2024-01-22T10:00:00+00:00')]
+
+class TestPrefilter:
+    def test_scan_properties(self):
+        props = scan_properties(TestIcsSplitter.ics, 'VEVENT', ('UID', 'SUMMARY', 'DTSTART'))
+        ## the UID of the VALARM is not the UID of the event
+        assert props == {'UID': [({}, 'recurring')], 'SUMMARY': [({}, 'a summary folded over two lines')],
+                         'DTSTART': [({'TZID': 'Europe/Oslo'}, '20240102T100000')]}
+        assert scan_properties(TestIcsSplitter.ics, 'VTODO', ('UID',)) is None
+
+    def test_tasks(self):
+        import io
+        from calendar_cli.legacy import _prefilter_tasks
+        objects = [Namespace(id=uid, data=data) for (uid, data) in split_calendar(io.StringIO(TestOffline.todos))]
+        now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        def select(**kwargs):
+            args = Namespace(**dict(dict(todo_uid=None, categories=None, overdue=False, hide_future=False, expand=None), **kwargs))
+            return [x.id for x in _prefilter_tasks(objects, args, now)]
+        assert select() == ['later', 'soon']
+        assert select(categories='home') == ['later']
+        assert select(overdue=True) == ['soon']
+        assert select(todo_uid='done') == ['done']
+
+class TestAgendaWindows:
+    def test_windows_are_merged_in_order(self, monkeypatch):
+        import calendar_cli.legacy
+        from datetime import timedelta
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        ## a daily event and a long one, overlapping all the windows
+        daily = [start + timedelta(x) for x in range(400)]
+        windows = []
+        def instances(caldav_conn, args, search_dtstart, search_dtend):
+            windows.append((search_dtstart, search_dtend))
+            events = [('long', start - timedelta(hours=1))] + [('daily', x) for x in daily if search_dtstart <= x < search_dtend]
+            for (uid, dtstart) in reversed(events):
+                instance = parse_calendar("BEGIN:VCALENDAR\nBEGIN:VEVENT\nUID:%s\nDTSTART:%s\nEND:VEVENT\nEND:VCALENDAR\n" % (uid, dtstart.strftime('%Y%m%dT%H%M%SZ')))
+                yield {'dtstart': dtstart, 'instance': next(instance.components()), 'object': None}
+        monkeypatch.setattr(calendar_cli.legacy, '_agenda_instances', instances)
+        monkeypatch.setattr(calendar_cli.legacy, 'find_calendar', lambda *largs: None)
+        args = Namespace(nocaldav=False, icalendar=False, vdir=None, sync_cache=False, from_time='2024-01-01', to_time=None, agenda_mins=None, agenda_days=400, timezone='UTC', window_days=10, jobs=3)
+        events = calendar_cli.legacy._agenda_events(None, args)
+        assert [x[1]-x[0] for x in sorted(windows)] == [timedelta(x) for x in (10, 20, 40, 80, 120, 120, 10)]
+        assert [(x['instance'].uid.value, x['dtstart']) for x in events] == [('long', start - timedelta(hours=1))] + [('daily', x) for x in daily]
+
+    @pytest.mark.parametrize('option', [('--window-days', '-1'), ('--jobs', '0')])
+    def test_invalid_options(self, monkeypatch, capsys, option):
+        monkeypatch.setattr(sys, 'argv', ['calendar-cli', '--nocaldav', 'calendar', 'agenda'] + list(option))
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 2
+        assert 'must be at least' in capsys.readouterr().err
+
+class TestRecurrence:
+    ics = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example//Test//EN
+BEGIN:VEVENT
+UID:weekly
+DTSTART;TZID=Europe/Oslo:20240321T090000
+DTEND;TZID=Europe/Oslo:20240321T100000
+RRULE:FREQ=WEEKLY;UNTIL=20240411T070000Z
+EXDATE;TZID=Europe/Oslo:20240328T090000
+RDATE;TZID=Europe/Oslo:20240413T120000
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly
+RECURRENCE-ID;TZID=Europe/Oslo:20240404T090000
+DTSTART;TZID=Europe/Oslo:20240404T150000
+DTEND;TZID=Europe/Oslo:20240404T160000
+END:VEVENT
+END:VCALENDAR
+"""
+
+    @pytest.mark.parametrize('light', [True, False])
+    def test_expand(self, light):
+        import pytz
+        import vobject
+        from calendar_cli.recurrence import expand, next_occurrence
+        tzinfo = pytz.timezone('Europe/Oslo')
+        cal = parse_calendar(self.ics) if light else vobject.readOne(self.ics)
+        comps = [x for x in cal.components() if x.name == 'VEVENT']
+        instances = expand(comps, datetime(2024, 3, 1, tzinfo=timezone.utc), datetime(2024, 5, 1, tzinfo=timezone.utc), tzinfo)
+        ## 09:00 local time on both sides of the DST change, except the
+        ## excluded, the overridden and the extra occurrence
+        assert sorted(x.dtstart.value.astimezone(timezone.utc) for x in instances) == [
+            datetime(2024, 3, 21, 8, tzinfo=timezone.utc), datetime(2024, 4, 4, 13, tzinfo=timezone.utc),
+            datetime(2024, 4, 11, 7, tzinfo=timezone.utc), datetime(2024, 4, 13, 10, tzinfo=timezone.utc)]
+        assert next_occurrence(comps[0], datetime(2024, 4, 1, tzinfo=timezone.utc), tzinfo) == tzinfo.localize(datetime(2024, 4, 4, 9))
+
+    class StubTodo:
+        """
+        Stand-in for a caldav Todo, recording what is saved
+        """
+        def __init__(self, data):
+            import vobject
+            self.instance = vobject.readOne(data)
+            self.saved = []
+            self.completed = False
+
+        def copy(self):
+            return self.__class__(self.instance.serialize())
+
+        def save(self, only_this_recurrence=True):
+            self.saved.append(only_this_recurrence)
+
+        def complete(self):
+            self.completed = True
+
+    def test_complete(self):
+        import pytz
+        from calendar_cli.legacy import _complete_task
+        tasks = []
+        class Todo(self.StubTodo):
+            def copy(self):
+                tasks.append(super().copy())
+                return tasks[-1]
+        task = Todo("BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//Example//Test//EN\nBEGIN:VTODO\nUID:weekly\nDTSTAMP:20240101T000000Z\n"
+                    "DTSTART:20240108T090000Z\nDUE:20240108T100000Z\nRRULE:FREQ=WEEKLY;COUNT=5\nSUMMARY:weekly\nEND:VTODO\nEND:VCALENDAR\n")
+        _complete_task(task, pytz.utc, datetime(2024, 1, 10, tzinfo=timezone.utc))
+
+        ## the task itself moves on to the next occurrence, replacing the object
+        vtodo = task.instance.vtodo
+        assert task.saved == [False] and not task.completed
+        assert (vtodo.dtstart.value, vtodo.due.value) == (datetime(2024, 1, 15, 9, tzinfo=timezone.utc), datetime(2024, 1, 15, 10, tzinfo=timezone.utc))
+        assert vtodo.recurrence_id.value == vtodo.dtstart.value
+        assert vtodo.recurrence_id.params['RANGE'] == ['THISANDFUTURE']
+        assert vtodo.rrule.value == 'FREQ=WEEKLY;COUNT=4'
+
+        ## while a non-recurring copy is completed
+        (completed,) = tasks
+        assert completed.completed and completed.saved == []
+        assert not 'rrule' in completed.instance.vtodo.contents
+        assert not 'recurrence-id' in completed.instance.vtodo.contents
+
+        ## older caldav versions don't take only_this_recurrence
+        class OldTodo(self.StubTodo):
+            def save(self):
+                self.saved.append(None)
+        task = OldTodo(task.instance.serialize())
+        _complete_task(task, pytz.utc, datetime(2024, 1, 10, tzinfo=timezone.utc))
+        assert task.saved == [None]
+        assert task.instance.vtodo.rrule.value == 'FREQ=WEEKLY;COUNT=3'
+
+class TestVdir:
+    def make_vdir(self, tmp_path):
+        import io
+        (tmp_path / 'vdir').mkdir()
+        vdir = Vdir(str(tmp_path / 'vdir'), str(tmp_path / 'cache'))
+        for (uid, ics) in split_calendar(io.StringIO(TestIcsSplitter.ics)):
+            vdir.add_event(ics)
+        for (uid, ics) in split_calendar(io.StringIO(TestOffline.todos)):
+            vdir.add_event(ics)
+        return vdir
+
+    def test_index(self, tmp_path):
+        vdir = self.make_vdir(tmp_path)
+        assert sorted(x.id for x in vdir.events(datetime(2023, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 2, tzinfo=timezone.utc))) == ['recurring']
+        assert sorted(x.id for x in vdir.events(datetime(2024, 1, 2, tzinfo=timezone.utc), datetime(2024, 1, 3, tzinfo=timezone.utc))) == ['recurring', 'single']
+        assert sorted(x.id for x in vdir.todos()) == ['later', 'soon']
+        assert [x.id for x in vdir.todos(category='home')] == ['later']
+        assert [x.id for x in vdir.todos(due_before=datetime(2025, 1, 1, tzinfo=timezone.utc))] == ['soon']
+        assert [x.id for x in vdir.todos(uid='done')] == ['done']
+
+        ## a new instance reuses the index, except for changed files
+        (tmp_path / 'vdir' / 'soon.ics').write_text(TestOffline.todos.split("BEGIN:VTODO")[0] + "BEGIN:VTODO\nUID:soon\nSTATUS:COMPLETED\nEND:VTODO\nEND:VCALENDAR\n")
+        vdir = Vdir(str(tmp_path / 'vdir'), str(tmp_path / 'cache'))
+        assert [x.id for x in vdir.todos()] == ['later']
+
+    def test_conflict(self, tmp_path):
+        import caldav.lib.error
+        vdir = self.make_vdir(tmp_path)
+        task = vdir.todo_by_uid('later')
+        task.instance.vtodo.summary.value = 'edited'
+        task.save()
+        other = Vdir(str(tmp_path / 'vdir'), str(tmp_path / 'cache')).todo_by_uid('later')
+        assert other.instance.vtodo.summary.value == 'edited'
+        task.instance.vtodo.summary.value = 'edited again'
+        task.save()
+        with pytest.raises(caldav.lib.error.ETagMismatchError):
+            other.delete()
+        vdir.todo_by_uid('later').delete()
+        with pytest.raises(caldav.lib.error.NotFoundError):
+            vdir.todo_by_uid('later')
+
+class TestColumnIndex:
+    def make_cache(self, tmp_path):
+        import io
+        cache = SyncCache(str(tmp_path), 'section', 'http://example.com/cal/')
+        for ics in (TestIcsSplitter.ics, TestOffline.todos):
+            for (uid, data) in split_calendar(io.StringIO(ics)):
+                cache.objects['/cal/%s.ics' % uid] = {'etag': '"1"', 'data': data}
+        return cache
+
+    @pytest.mark.parametrize('vectorized', [True, False])
+    def test_index(self, tmp_path, monkeypatch, vectorized):
+        import calendar_cli.columns
+        from calendar_cli.columns import ColumnIndex
+        if vectorized:
+            pytest.importorskip('numpy')
+        else:
+            monkeypatch.setattr(calendar_cli.columns, '_numpy', lambda: None)
+        cache = self.make_cache(tmp_path)
+        index = ColumnIndex.update(cache)
+        assert sorted(index.events(datetime(2023, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 2, tzinfo=timezone.utc))) == ['/cal/recurring.ics']
+        assert sorted(index.events(datetime(2024, 1, 2, tzinfo=timezone.utc), datetime(2024, 1, 3, tzinfo=timezone.utc))) == ['/cal/recurring.ics', '/cal/single.ics']
+        assert sorted(index.todos()) == ['/cal/later.ics', '/cal/soon.ics']
+        assert index.todos(category='home') == ['/cal/later.ics']
+        assert index.todos(category='nosuch') == []
+        assert index.todos(due_before=datetime(2025, 1, 1, tzinfo=timezone.utc)) == ['/cal/soon.ics']
+        assert index.todos(uid='done') == ['/cal/done.ics']
+        index.close()
+
+        ## a new index reuses the rows, except for changed objects
+        parsed = []
+        import calendar_cli.vdir
+        index_entry = calendar_cli.vdir._index_entry
+        monkeypatch.setattr(calendar_cli.vdir, '_index_entry', lambda data: parsed.append(data) or index_entry(data))
+        cache.objects['/cal/soon.ics'] = {'etag': '"2"', 'data': TestOffline.todos.split("BEGIN:VTODO")[0] + "BEGIN:VTODO\nUID:soon\nSTATUS:COMPLETED\nEND:VTODO\nEND:VCALENDAR\n"}
+        index = ColumnIndex.update(cache)
+        assert len(parsed) == 1
+        assert index.todos() == ['/cal/later.ics']
+        assert index.todos(category='home') == ['/cal/later.ics']
+        index.close()
+
+class TestSearch:
+    def test_incremental_update_and_queries(self, tmp_path):
+        import io
+        objects = dict(split_calendar(io.StringIO(TestIcsSplitter.ics)))
+        objects.update(split_calendar(io.StringIO(TestOffline.todos.replace("SUMMARY:soon", "SUMMARY:soon\nDESCRIPTION:single"))))
+        loaded = []
+        def load(hrefs):
+            loaded.extend(hrefs)
+            return ((x, objects[x]) for x in hrefs)
+        index = SearchIndex(str(tmp_path), 'default', 'http://example.com/cal/')
+        assert index.update({x: '1' for x in objects}, load) == (5, 0)
+        assert index.update({x: '1' for x in objects}, load) == (0, 0)
+        assert len(loaded) == 5
+
+        ## ranked - the summary match goes before the description match
+        assert [x['uid'] for x in index.search('single')] == ['single', 'soon']
+        assert [x['uid'] for x in index.search('summary:single')] == ['single']
+        assert [x['uid'] for x in index.search('mov*')] == ['recurring']
+        assert [x['uid'] for x in index.search('categories:home')] == ['later']
+        assert [x['uid'] for x in index.search('single', ['VTODO'])] == ['soon']
+        with pytest.raises(ValueError):
+            index.search('"unterminated')
+
+        objects['later'] = objects['later'].replace('CATEGORIES:home', 'CATEGORIES:work')
+        del objects['single']
+        versions = {x: '1' for x in objects}
+        versions['later'] = '2'
+        assert index.update(versions, load) == (1, 1)
+        assert index.search('categories:home') == []
+        assert [x['uid'] for x in index.search('single')] == ['soon']
+        index.close()
+
+class TestConfigSections:
+    config = {
+        'default': {'caldav_url': 'http://example.com/'},
+        'work_a': {'inherits': 'default', 'calendar_url': 'a'},
+        'work_b': {'inherits': 'default', 'calendar_url': 'b'},
+        'old': {'inherits': 'default', 'calendar_url': 'c', 'disable': True},
+        'all': {'contains': ['work_*', 'old', 'default']},
+    }
+
+    def test_plain_section(self):
+        assert _config_sections(self.config, 'work_a') == ['work_a']
+        assert _config_sections(self.config, 'nonexistent') == ['nonexistent']
+
+    def test_glob_and_meta_sections(self):
+        assert _config_sections(self.config, 'work_*') == ['work_a', 'work_b']
+        assert _config_sections(self.config, 'all') == ['default', 'work_a', 'work_b']
+        assert _config_sections(self.config, '*') == ['default', 'work_a', 'work_b']
+
+class TestTaskRecord:
+    def _record(self, vtodo, light=False):
+        import caldav, pytz
+        data = "BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//Example//Test//EN\nBEGIN:VTODO\n%sEND:VTODO\nEND:VCALENDAR\n" % vtodo
+        return TaskRecord(caldav.Todo(data=data), pytz.timezone('Europe/Oslo'), parse_calendar(data).vtodo if light else None)
+
+    @pytest.mark.parametrize("light", [False, True])
+    def test_normalized_properties(self, light):
+        task = self._record("""UID:parent
+DTSTART;VALUE=DATE:20300101
+DUE;TZID=Europe/Oslo:20300102T120000
+PRIORITY:2
+CATEGORIES:foo,bar
+CATEGORIES:baz
+RELATED-TO;RELTYPE=CHILD:child1
+RELATED-TO;RELTYPE=CHILD:child2
+LOCATION:home
+""", light)
+        assert task.uid == 'parent'
+        assert task.dtstart == datetime(2029, 12, 31, 23, 0, tzinfo=timezone.utc)
+        assert task.due == datetime(2030, 1, 2, 11, 0, tzinfo=timezone.utc)
+        assert task.due_value.hour == 12
+        assert task.priority == 2
+        assert task.categories == ('foo', 'bar', 'baz')
+        assert task.related_to == [('CHILD', 'child1'), ('CHILD', 'child2')]
+        assert task.location == 'home'
+        assert task.description is None
+        assert task.is_pending()
+
+    def test_sorting(self):
+        now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        tasks = [self._record("UID:nodue\n"),
+                 self._record("UID:future\nDTSTART:20300101T000000Z\n"),
+                 self._record("UID:overdue\nDUE:20200101T000000Z\n"),
+                 self._record("UID:due\nDUE:20260101T000000Z\n")]
+        tasks.sort(key=lambda x: x.sort_key(now))
+        assert [x.uid for x in tasks] == ['overdue', 'due', 'nodue', 'future']
+        assert not self._record("UID:done\nSTATUS:COMPLETED\n").is_pending()
+
+class TestTaskGraph:
+    def _graph(self, *relations):
+        ## relations are (uid, [(reltype, uid), ...])
+        return TaskGraph([Namespace(uid=uid, related_to=related_to) for (uid, related_to) in relations])
+
+    def test_relations_from_both_sides(self):
+        graph = self._graph(
+            ('root', [('CHILD', 'a')]),
+            ('a', [('PARENT', 'root')]),
+            ('b', [('PARENT', 'root'), ('PARENT', 'a'), ('PARENT', 'missing')]),
+            ('loose', [('SIBLING', 'a')]))
+        assert graph.descendants('root') == {'a', 'b'}
+        assert graph.has_parents('b') and not graph.has_parents('loose')
+        assert not graph.has_children('b')
+        assert [(depth, x.uid) for (depth, x) in graph.walk()] == [
+            (0, 'root'), (1, 'a'), (1, 'b'), (0, 'loose')]
+
+    def test_cycles(self):
+        graph = self._graph(('a', [('PARENT', 'c')]), ('b', [('PARENT', 'a')]), ('c', [('PARENT', 'b')]))
+        assert graph.descendants('a') == {'a', 'b', 'c'}
+        assert [(depth, x.uid) for (depth, x) in graph.walk()] == [(0, 'a'), (1, 'b'), (2, 'c')]
+
+class TestProfile:
+    def test_nested_phases_are_exclusive(self):
+        import time
+        profile = Profile()
+        with profile.phase('fetch'):
+            time.sleep(0.02)
+            with profile.phase('parse'):
+                time.sleep(0.05)
+        with profile.phase('parse'):
+            pass
+        assert profile.phases['parse']['count'] == 2
+        assert 0.05 <= profile.phases['parse']['wall'] < 0.07
+        assert 0.02 <= profile.phases['fetch']['wall'] < 0.04
+
+    def test_requests(self):
+        profile = Profile()
+        profile.add_request('REPORT', 207, 700, 1500, 0.1)
+        profile.add_request('REPORT', 207, 700, 500, 0.1)
+        profile.add_request('PUT', 412, 300, 0, 0.05)
+        report = json.loads(json.dumps(profile.report()))
+        assert report['requests']['REPORT']['count'] == 2
+        assert report['requests']['REPORT']['bytes_received'] == 2000
+        assert report['requests']['PUT']['status'] == {'412': 1}
+        assert report['requests']['total'] == {'count': 3, 'bytes_sent': 1700, 'bytes_received': 2000}
+
+class TestTransport:
+    def test_retries(self):
+        import caldav, threading
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        requests = []
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self):
+                requests.append(self.command)
+                self.send_response(503 if len(requests) in (1, 2, 4) else 200)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            do_PROPFIND = do_MKCALENDAR = reply
+            def log_message(self, *largs):
+                pass
+        server = HTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = 'http://localhost:%i/' % server.server_port
+            conn = caldav.DAVClient(url=url)
+            configure(conn, 3, 0.01)
+            limit = concurrency_limit(conn, 4)
+            ## idempotent requests are retried ...
+            assert conn.session.request('PROPFIND', url).status_code == 200
+            assert requests == ['PROPFIND']*3
+            ## halved once for the two retries, and grown after the success
+            assert limit.limit == 2.5
+            ## ... others are not
+            assert conn.session.request('MKCALENDAR', url).status_code == 503
+            assert requests == ['PROPFIND']*3 + ['MKCALENDAR']
+        finally:
+            server.shutdown()
+
+    def test_adaptive_limit(self):
+        limit = AdaptiveLimit(8)
+        limit.throttled()
+        limit.throttled()
+        assert limit.limit == 4
+        ## grows by about one for each round of successes
+        for i in range(4+5+6):
+            limit.succeeded()
+        assert 6.5 < limit.limit < 7
+        for i in range(100):
+            limit.succeeded()
+        assert limit.limit == 8
+
+class TestStartup:
+    """
+    calendar-cli is a command line tool, so the startup time matters.
+    The heavy libraries should only be imported when needed.
+    """
+    heavy_modules = ('caldav', 'vobject', 'icalendar', 'dateutil', 'pytz', 'tzlocal', 'urllib3', 'yaml')
+    budget_us = 200000
+
+    def _importtime(self, *argv):
+        import os, subprocess
+        code = "import sys; sys.argv = %r\nimport calendar_cli.legacy\ntry:\n    calendar_cli.legacy.main()\nexcept SystemExit:\n    pass" % (['calendar-cli'] + list(argv),)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, capture_output=True, text=True)
+        imports = {}
+        for line in proc.stderr.split("\n"):
+            if line.startswith('import time:') and not 'self [us]' in line:
+                (_, cumulative, module) = line.split('|')
+                imports[module.strip()] = int(cumulative)
+        return imports
+
+    @pytest.mark.parametrize('argv', [('--help',), ('todo', '--help'), ('calendar', 'agenda', '--help')])
+    def test_help_does_not_import_heavy_libraries(self, argv):
+        imports = self._importtime(*argv)
+        assert 'calendar_cli.legacy' in imports
+        assert [x for x in imports if x.split('.')[0] in self.heavy_modules] == []
+        assert imports['calendar_cli.legacy'] < self.budget_us